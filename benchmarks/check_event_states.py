@@ -0,0 +1,142 @@
+"""
+Check that events changing a state back within one message are not skipped
+
+An event is set to a state by a first message, after which a second message changes
+it to another state and back again (A, B, A). The message is processed by
+main.main() with the event state index enabled, with and without coalescing and
+asynchronous processing, each in its own process against an in-memory Firestore and
+a local ArcGIS stub. The script exits with status 1 if the stored event state,
+aggregate or host status differs from the last state.
+
+    python benchmarks/check_event_states.py
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTION_DIR = os.path.join(ROOT, "functions", "arcgis")
+
+# States of the host event per message, the last one is expected to be stored
+SEQUENCES = [[[2], [0, 2]], [[0], [2, 0]], [[1], [1, 2, 1]]]
+
+PATHS = {
+    "normal": {"coalescing": False, "use_async": False},
+    "coalescing": {"coalescing": True, "use_async": False},
+    "async": {"coalescing": False, "use_async": True},
+    "async-coalescing": {"coalescing": True, "use_async": True},
+}
+
+
+def process(path):
+    """
+    Process all sequences in this process and print the stored states as JSON
+
+    :param path: Processing path, see PATHS
+    """
+
+    sys.path.insert(0, FUNCTION_DIR)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import run_benchmark
+    from fake_firestore import FakeFirestore
+    from stub_arcgis import StubArcGIS
+
+    stub = StubArcGIS(latency=0).start()
+    run_benchmark.load_config(
+        stub,
+        argparse.Namespace(
+            workers=1,
+            streaming=False,
+            batch_size=500,
+            pull_batch_records=1000,
+            deduplication=False,
+            **PATHS[path],
+        ),
+    )
+
+    import main
+
+    db_client = FakeFirestore()
+    main._db_client = db_client
+    main._arcgis_secret = "check"
+
+    run_benchmark.seed_hosts(db_client, len(SEQUENCES))
+    stub.features["4"] = {
+        -(index + 1): {"attributes": {"objectid": -(index + 1)}}
+        for index in range(len(SEQUENCES))
+    }
+
+    second = 0
+    for index, sequence in enumerate(SEQUENCES):
+        for states in sequence:
+            events = []
+            for state in states:
+                second += 1
+                events.append(run_benchmark.make_event(index, "", state, second))
+
+            main.main(
+                run_benchmark.Request(
+                    run_benchmark.SUBS["event"], {"ns_tcc_events": events}
+                )
+            )
+
+    stub.stop()
+
+    print(
+        json.dumps(
+            [
+                {
+                    "event": db_client.read(f"events/site_host{index}_")["eventstate"],
+                    "aggregate": db_client.read(f"host_states/site_host{index}")[
+                        "host_state"
+                    ],
+                    "host": db_client.read(f"hosts/site_host{index}")["status"],
+                }
+                for index in range(len(SEQUENCES))
+            ]
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--path", choices=list(PATHS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.path:
+        logging.basicConfig(level=logging.ERROR)
+        process(args.path)
+        return
+
+    failures = 0
+    for path in PATHS:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--path", path],
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+        ).stdout
+
+        for sequence, stored in zip(SEQUENCES, json.loads(output)):
+            expected = sequence[-1][-1]
+            if any(state != expected for state in stored.values()):
+                failures += 1
+                print(f"{path}: states {sequence} stored as {stored}")
+
+    if failures:
+        print(f"{failures} event state sequences were stored incorrectly")
+        sys.exit(1)
+
+    print(
+        f"All {len(SEQUENCES)} event state sequences were stored correctly "
+        f"in {len(PATHS)} processing paths"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Check that synchronous and asynchronous processing give the same results
+
+The same messages with synthetic events are processed by main.main() with and
+without ASYNC_PROCESSING, each in its own process against an in-memory Firestore
+and a local ArcGIS stub. The resulting documents and open host features are
+compared, and the script exits with status 1 if they differ.
+
+    python benchmarks/check_parity.py --records 500 --messages 4
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTION_DIR = os.path.join(ROOT, "functions", "arcgis")
+
+COLLECTIONS = ["hosts", "events", "host_states"]
+
+
+def get_state(db_client, stub):
+    """
+    Get the results of processing that do not depend on the order of ArcGIS adds
+
+    :param db_client: Fake Firestore client
+    :param stub: ArcGIS stub
+
+    :return: Documents per collection and open host features per host name
+    """
+
+    documents = {collection: {} for collection in COLLECTIONS}
+    for collection in COLLECTIONS:
+        for path, data in db_client.items(collection):
+            # Object IDs are assigned in the order in which features are added
+            documents[collection][path] = {
+                key: value for key, value in data.items() if key != "objectId"
+            }
+
+    features = {}
+    for feature in stub.features.get("4", {}).values():
+        attributes = dict(feature["attributes"])
+        if attributes.pop("endtime", None) is None and "hostname" in attributes:
+            attributes.pop("objectid")
+            features[attributes["hostname"]] = attributes
+
+    return {"documents": documents, "features": features}
+
+
+def process(args):
+    """
+    Process the messages in this process and print the resulting state as JSON
+
+    :param args: Command line arguments
+    """
+
+    sys.path.insert(0, FUNCTION_DIR)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import run_benchmark
+    from fake_firestore import FakeFirestore
+    from stub_arcgis import StubArcGIS
+
+    stub = StubArcGIS(latency=args.latency).start()
+    run_benchmark.load_config(
+        stub,
+        argparse.Namespace(
+            workers=args.workers,
+            coalescing=args.coalescing,
+            use_async=args.mode == "async",
+            streaming=False,
+            batch_size=500,
+            pull_batch_records=1000,
+            deduplication=False,
+        ),
+    )
+
+    import main
+
+    db_client = FakeFirestore()
+    main._db_client = db_client
+    main._arcgis_secret = "parity"
+
+    run_benchmark.seed_hosts(db_client, args.hosts)
+    stub.features["4"] = {
+        -(index + 1): {"attributes": {"objectid": -(index + 1)}}
+        for index in range(args.hosts)
+    }
+
+    rng = random.Random(args.seed)
+    for message in range(args.messages):
+        payload = {
+            "ns_tcc_events": run_benchmark.generate_events(
+                args, rng, message * args.records
+            )
+        }
+        response = main.main(
+            run_benchmark.Request(run_benchmark.SUBS["event"], payload)
+        )
+        if response != ("OK", 204):
+            logging.error(f"Message {message} returned {response}")
+
+    stub.stop()
+
+    print(json.dumps(get_state(db_client, stub), sort_keys=True))
+
+
+def run_mode(mode, args):
+    """
+    Process the messages in a separate process
+
+    :param mode: Processing mode ("sync" or "async")
+    :param args: Command line arguments
+
+    :return: Resulting state
+    """
+
+    command = [sys.executable, os.path.abspath(__file__), "--mode", mode]
+    for name, value in vars(args).items():
+        if name == "mode" or value is False:
+            continue
+        command.append(f"--{name.replace('_', '-')}")
+        if value is not True:
+            command.append(str(value))
+
+    output = subprocess.run(
+        command, check=True, stdout=subprocess.PIPE, text=True
+    ).stdout
+
+    return json.loads(output)
+
+
+def compare(expected, actual, path=""):
+    """
+    Get the differences between two states
+
+    :param expected: State of synchronous processing
+    :param actual: State of asynchronous processing
+    :param path: Path of the compared values
+
+    :return: List of differences
+    """
+
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        return [
+            difference
+            for key in sorted(set(expected) | set(actual))
+            for difference in compare(
+                expected.get(key), actual.get(key), f"{path}/{key}"
+            )
+        ]
+
+    return [] if expected == actual else [f"{path}: {expected!r} != {actual!r}"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=500, help="Events per message")
+    parser.add_argument("--messages", type=int, default=4)
+    parser.add_argument("--hosts", type=int, default=50)
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf skew of hosts")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--coalescing", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--mode", choices=["sync", "async"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        logging.basicConfig(level=logging.ERROR)
+        process(args)
+        return
+
+    expected = run_mode("sync", args)
+    differences = compare(expected, run_mode("async", args))
+
+    for difference in differences[:20]:
+        print(difference)
+
+    if differences:
+        print(f"Asynchronous processing differs in {len(differences)} values")
+        sys.exit(1)
+
+    print(
+        f"Synchronous and asynchronous processing agree on "
+        f"{sum(len(documents) for documents in expected['documents'].values())} "
+        f"documents and {len(expected['features'])} open host features"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Benchmark the encoding of applyEdits request bodies
+
+Batches of host feature adds and updates are encoded as the former Python literal
+and as the compact JSON sent by the function, after which the encode time and the
+request bytes with and without gzip compression are reported.
+
+    python benchmarks/encode_edits.py --features 1000 10000
+"""
+
+import argparse
+import gzip
+import json
+import os
+import statistics
+import sys
+import time
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+from urllib.parse import parse_qs, urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTION_DIR = os.path.join(ROOT, "functions", "arcgis")
+
+
+def load_config():
+    """
+    Load config.py.example as the config module
+
+    :return: Config module
+    """
+
+    loader = SourceFileLoader("config", os.path.join(FUNCTION_DIR, "config.py.example"))
+    config = module_from_spec(spec_from_loader("config", loader))
+    loader.exec_module(config)
+
+    sys.modules["config"] = config
+
+    return config
+
+
+def make_edits(count):
+    """
+    Get host feature edits as applied when events change the status of hosts
+
+    :param count: Number of features
+
+    :return: ArcGIS edits per function
+    """
+
+    import geometry
+
+    adds, updates = [], []
+
+    for index in range(count):
+        timestamp = 1622541600000 + index * 1000
+
+        adds.append(
+            {
+                "geometry": geometry.make_point(
+                    4 + index % 100 / 100, 52 + index % 100 / 100
+                ),
+                "attributes": {
+                    "sitename": "site",
+                    "hostname": f"host{index}",
+                    "hostgroups": [f"group{index % 10}"],
+                    "bssglobalcoverage": "global",
+                    "bsshwfamily": "family",
+                    "bsslifecyclestatus": "production",
+                    "giskleur": index % 4,
+                    "status": index % 4,
+                    "type": "HOST",
+                    "event_output": f"PING OK - RTA = {index % 50} ms",
+                    "starttime": timestamp,
+                },
+            }
+        )
+        updates.append({"attributes": {"objectid": index + 1, "endtime": timestamp}})
+
+    return {"adds": adds, "updates": updates}
+
+
+def encode_literal(edits):
+    return urlencode(
+        {function: str(values) for function, values in edits.items()}
+    ).encode("utf-8")
+
+
+def encode_json(edits):
+    import utils
+
+    body, _ = utils.encode_form(
+        {function: utils.encode_edits(values) for function, values in edits.items()}
+    )
+
+    return body
+
+
+def measure(encode, edits, repeat):
+    """
+    Measure the encoding of a request body
+
+    :param encode: Function encoding the edits as form body
+    :param edits: ArcGIS edits per function
+    :param repeat: Number of measurements
+
+    :return: Median encode time and request bytes
+    """
+
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = encode(edits)
+        durations.append(time.perf_counter() - start)
+
+    return {
+        "encode_ms": round(statistics.median(durations) * 1000, 2),
+        "bytes": len(body),
+        "gzip_bytes": len(gzip.compress(body)),
+        "valid_json": is_valid_json(body),
+    }
+
+
+def is_valid_json(body):
+    """
+    Check if all edit functions of a form body are valid JSON
+
+    :param body: Form body
+
+    :return: True if ArcGIS can parse the edits strictly
+    """
+
+    try:
+        for values in parse_qs(body.decode("utf-8")).values():
+            json.loads(values[0])
+    except json.decoder.JSONDecodeError:
+        return False
+
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--features", type=int, nargs="+", default=[1000, 10000], help="Batch sizes"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, FUNCTION_DIR)
+    load_config()
+
+    results = {}
+    for count in args.features:
+        edits = make_edits(count)
+        results[count] = {
+            "literal": measure(encode_literal, edits, args.repeat),
+            "json": measure(encode_json, edits, args.repeat),
+        }
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""In-memory stand-in for the parts of the Firestore client used by the function."""
+
+import copy
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition
+from google.cloud.firestore_v1 import Increment
+from google.cloud.firestore_v1.field_path import parse_field_path
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data, update_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = copy.deepcopy(data)
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class FakeDocumentReference:
+    def __init__(self, client, collection, document_id):
+        self.client = client
+        self.collection = collection
+        self.id = document_id
+        self.path = f"{collection}/{document_id}"
+
+    def get(self):
+        self.client.count("get")
+        return FakeDocumentSnapshot(self, *self.client.read_with_time(self.path))
+
+    def set(self, data, merge=False):
+        self.client.count("set")
+        self.client.write_set(self.path, data, merge)
+
+    def update(self, data):
+        self.client.count("update")
+        self.client.write_update(self.path, data)
+
+
+class FakeQuery:
+    def __init__(self, client, collection, filters=(), order=None, limit=None):
+        self.client = client
+        self.collection = collection
+        self.filters = filters
+        self.order = order
+        self.max_results = limit
+        self.start = None
+
+    def where(self, field, op, value):
+        if op != "==":
+            raise NotImplementedError(f"Operator {op} is not supported")
+
+        return self.copy(filters=self.filters + ((field, value),))
+
+    def order_by(self, field):
+        return self.copy(order=field)
+
+    def limit(self, count):
+        return self.copy(limit=count)
+
+    def start_after(self, snapshot):
+        query = self.copy()
+        query.start = snapshot
+        return query
+
+    def copy(self, **kwargs):
+        query = FakeQuery(
+            self.client,
+            kwargs.get("collection", self.collection),
+            kwargs.get("filters", self.filters),
+            kwargs.get("order", self.order),
+            kwargs.get("limit", self.max_results),
+        )
+        query.start = self.start
+        return query
+
+    def stream(self):
+        self.client.count("stream")
+
+        documents = []
+        for path, data in self.client.items(self.collection):
+            if all(data.get(field) == value for field, value in self.filters):
+                documents.append((path, data))
+
+        if self.order == "__name__" or self.order is None:
+            documents.sort(key=lambda item: item[0])
+        else:
+            documents = [item for item in documents if self.order in item[1]]
+            documents.sort(key=lambda item: item[1][self.order])
+
+        if self.start is not None:
+            start_key = self.sort_key(self.start.reference.path, self.start.to_dict())
+            documents = [item for item in documents if self.sort_key(*item) > start_key]
+
+        if self.max_results is not None:
+            documents = documents[: self.max_results]
+
+        for path, data in documents:
+            document_id = path.split("/", 1)[1]
+            yield FakeDocumentSnapshot(
+                FakeDocumentReference(self.client, self.collection, document_id),
+                data,
+                self.client.update_times.get(path),
+            )
+
+    def sort_key(self, path, data):
+        if self.order == "__name__" or self.order is None:
+            return path
+
+        return data[self.order]
+
+
+class FakeCollectionReference(FakeQuery):
+    def document(self, document_id):
+        return FakeDocumentReference(self.client, self.collection, document_id)
+
+
+class FakeWriteResult:
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+class FakeWriteOption:
+    def __init__(self, last_update_time):
+        self.last_update_time = last_update_time
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append(("set", ref.path, data, merge, None))
+
+    def create(self, ref, data):
+        self.writes.append(("create", ref.path, data, False, None))
+
+    def update(self, ref, data, option=None):
+        self.writes.append(("update", ref.path, data, None, option))
+
+    def commit(self):
+        self.client.count("commit")
+
+        with self.client.lock:
+            # A batch is applied completely or not at all
+            for operation, path, _, _, option in self.writes:
+                if operation == "create" and path in self.client.documents:
+                    raise AlreadyExists(f"Document already exists: {path}")
+                if (
+                    option is not None
+                    and self.client.update_times.get(path) != option.last_update_time
+                ):
+                    raise FailedPrecondition(f"Document was updated: {path}")
+
+            for operation, path, data, merge, _ in self.writes:
+                if operation == "update":
+                    self.client.write_update(path, data)
+                else:
+                    self.client.write_set(path, data, merge)
+
+            # All writes of a batch are committed at the same time
+            update_time = self.client.tick()
+            for _, path, _, _, _ in self.writes:
+                self.client.update_times[path] = update_time
+
+        return [FakeWriteResult(update_time) for _ in self.writes]
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.documents = {}
+        self.update_times = {}
+        self.clock = 0
+        self.calls = Counter()
+        self.lock = threading.RLock()
+
+    def tick(self):
+        """
+        Get a new update time, which is unique within the client
+        """
+
+        with self.lock:
+            self.clock += 1
+            return datetime(2021, 1, 1, tzinfo=timezone.utc) + timedelta(
+                microseconds=self.clock
+            )
+
+    def count(self, call):
+        with self.lock:
+            self.calls[call] += 1
+
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        self.count("get_all")
+
+        for reference in list(references):
+            yield FakeDocumentSnapshot(reference, *self.read_with_time(reference.path))
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    @staticmethod
+    def write_option(last_update_time):
+        return FakeWriteOption(last_update_time)
+
+    def read(self, path):
+        with self.lock:
+            return copy.deepcopy(self.documents.get(path))
+
+    def read_with_time(self, path):
+        with self.lock:
+            return self.read(path), self.update_times.get(path)
+
+    def items(self, collection):
+        with self.lock:
+            return [
+                (path, copy.deepcopy(data))
+                for path, data in self.documents.items()
+                if path.split("/", 1)[0] == collection
+            ]
+
+    def write_set(self, path, data, merge):
+        with self.lock:
+            self.update_times[path] = self.tick()
+            if merge and path in self.documents:
+                self.documents[path].update(copy.deepcopy(data))
+            else:
+                self.documents[path] = copy.deepcopy(data)
+
+    def write_update(self, path, data):
+        with self.lock:
+            if path not in self.documents:
+                raise KeyError(f"No document to update: {path}")
+
+            self.update_times[path] = self.tick()
+
+            for field, value in data.items():
+                target = self.documents[path]
+                parts = parse_field_path(field)
+
+                for part in parts[:-1]:
+                    target = target.setdefault(part, {})
+
+                if isinstance(value, Increment):
+                    target[parts[-1]] = target.get(parts[-1], 0) + value.value
+                else:
+                    target[parts[-1]] = copy.deepcopy(value)
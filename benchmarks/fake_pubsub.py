@@ -0,0 +1,100 @@
+"""In-memory stand-in for the parts of the Pub/Sub subscriber client used by the function."""
+
+import threading
+from collections import Counter, deque
+from itertools import count
+
+
+class FakeMessage:
+    def __init__(self, message_id, data):
+        self.message_id = message_id
+        self.data = data
+
+
+class FakeReceivedMessage:
+    def __init__(self, ack_id, message):
+        self.ack_id = ack_id
+        self.message = message
+
+
+class FakePullResponse:
+    def __init__(self, received_messages):
+        self.received_messages = received_messages
+
+
+class FakeSubscriber:
+    def __init__(self):
+        """
+        Subscriber holding published messages per subscription path until they are
+        acknowledged. Messages of which the ack deadline is set to 0 are queued again.
+        """
+
+        self.queues = {}
+        self.outstanding = {}
+        self.acked = []
+        self.ids = count(1)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def subscription_path(project, subscription):
+        return f"projects/{project}/subscriptions/{subscription}"
+
+    def publish(self, path, data):
+        """
+        Add a message to a subscription
+
+        :param path: Subscription path
+        :param data: Message data as bytes
+        """
+
+        with self.lock:
+            message_id = str(next(self.ids))
+            self.queues.setdefault(path, deque()).append(FakeMessage(message_id, data))
+
+    def pull(self, request, timeout=None):
+        with self.lock:
+            self.calls["pull"] += 1
+            queue = self.queues.setdefault(request["subscription"], deque())
+
+            received = []
+            while queue and len(received) < request["max_messages"]:
+                message = queue.popleft()
+                ack_id = (
+                    f"{request['subscription']}/{message.message_id}/{next(self.ids)}"
+                )
+                self.outstanding[ack_id] = (request["subscription"], message)
+                received.append(FakeReceivedMessage(ack_id, message))
+
+        return FakePullResponse(received)
+
+    def acknowledge(self, request):
+        with self.lock:
+            self.calls["acknowledge"] += 1
+            for ack_id in request["ack_ids"]:
+                _, message = self.outstanding.pop(ack_id)
+                self.acked.append(message)
+
+    def modify_ack_deadline(self, request):
+        with self.lock:
+            self.calls["modify_ack_deadline"] += 1
+            if request["ack_deadline_seconds"] > 0:
+                return
+
+            for ack_id in request["ack_ids"]:
+                path, message = self.outstanding.pop(ack_id)
+                self.queues[path].append(message)
+
+    def pending(self, path):
+        """
+        Count the messages of a subscription that are not acknowledged
+
+        :param path: Subscription path
+
+        :return: Number of messages
+        """
+
+        with self.lock:
+            return len(self.queues.get(path, ())) + sum(
+                1 for queued_path, _ in self.outstanding.values() if queued_path == path
+            )
@@ -0,0 +1,421 @@
+"""
+Benchmark the ArcGIS function offline
+
+Messages with synthetic hosts or events are processed by main.main() against an
+in-memory Firestore and a local ArcGIS stub, after which throughput, per-record
+latency and the number of Firestore and ArcGIS calls are reported. With --pull the
+messages are published to an in-memory subscriber first and consumed by main.pull().
+
+    python benchmarks/run_benchmark.py --records 1000 --latency 0.02 --output before.json
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from functools import wraps
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTION_DIR = os.path.join(ROOT, "functions", "arcgis")
+
+SUBS = {"host": "benchmark-hosts", "event": "benchmark-events"}
+SERVICES = ["cpu", "disk", "memory", "ping", "ntp", "swap", "load", "uptime"]
+
+
+class Request:
+    def __init__(self, subscription, payload):
+        self.data = json.dumps(
+            {
+                "message": {
+                    "data": base64.b64encode(json.dumps(payload).encode()).decode(),
+                    "messageId": str(time.monotonic_ns()),
+                },
+                "subscription": f"projects/benchmark/subscriptions/{subscription}",
+            }
+        ).encode()
+        self.headers = {}
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.latencies = []
+
+    def wrap(self, function, count=lambda *args: 1):
+        """
+        Record the duration of every call of a function per handled record
+
+        :param function: Function to time
+        :param count: Function returning the number of records of a call
+        """
+
+        @wraps(function)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                records = count(*args) or 1
+                self.latencies.extend(
+                    [(time.perf_counter() - started) / records] * records
+                )
+
+        return timed
+
+    def percentile(self, percentile):
+        if not self.latencies:
+            return None
+
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+
+        return latencies[index] * 1000
+
+
+def load_config(stub, args):
+    """
+    Load config.py.example as the config module, pointed at the ArcGIS stub
+
+    :param stub: ArcGIS stub
+    :param args: Command line arguments
+
+    :return: Config module
+    """
+
+    loader = SourceFileLoader("config", os.path.join(FUNCTION_DIR, "config.py.example"))
+    config = module_from_spec(spec_from_loader("config", loader))
+    loader.exec_module(config)
+
+    config.OAUTH_URL = stub.oauth_url
+    config.SERVICE_URL = stub.service_url
+    config.SUBS = SUBS
+    config.PROCESSING_WORKERS = args.workers
+    config.EVENT_COALESCING = args.coalescing
+    config.ASYNC_PROCESSING = args.use_async
+    config.STREAMING_DECODE = args.streaming
+    config.STREAMING_BATCH_SIZE = args.batch_size
+    config.PULL_BATCH_RECORDS = args.pull_batch_records
+    config.DEDUPLICATION = args.deduplication
+
+    sys.modules["config"] = config
+
+    return config
+
+
+def get_weights(count, skew):
+    """
+    Get Zipf weights of records, a skew of 0 spreads records evenly
+
+    :param count: Number of hosts
+    :param skew: Zipf exponent
+
+    :return: List of weights
+    """
+
+    return [1 / (rank + 1) ** skew for rank in range(count)]
+
+
+def make_host(index, decommissioned=False, generation=0):
+    return {
+        "id": f"site_host{index}",
+        "sitename": "site",
+        "hostname": f"host{index}",
+        "decommissioned": decommissioned,
+        "host_groups": [f"group{generation}"],
+        "bss_global_coverage": {"realvalue": "global"},
+        "bss_hw_family": {"value": "family"},
+        "bss_lifecycle_status": {"realvalue": "production"},
+        "timestamp": f"2021-06-01T10:{generation % 60:02d}:00Z",
+        "longitude": {"value": str(4 + index % 100 / 100)},
+        "latitude": {"value": str(52 + index % 100 / 100)},
+    }
+
+
+def make_event(index, service, state, second):
+    return {
+        "id": f"event{index}_{service}_{second}",
+        "sitename": "site",
+        "hostname": f"host{index}",
+        "type": "SERVICE" if service else "HOST",
+        "service_description": service,
+        "state_type": "HARD",
+        "output": f"{service or 'host'} state {state}",
+        "long_output": "",
+        "event_state": state,
+        "timestamp": f"2021-06-01T{10 + second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}Z",
+    }
+
+
+def generate_hosts(args, rng, generation):
+    weights = get_weights(args.hosts, args.skew)
+    indexes = rng.choices(range(args.hosts), weights=weights, k=args.records)
+
+    return [
+        make_host(
+            index,
+            decommissioned=rng.random() < args.decommissioned,
+            generation=generation + rng.randrange(2),
+        )
+        for index in indexes
+    ]
+
+
+def generate_events(args, rng, offset):
+    weights = get_weights(args.hosts, args.skew)
+    indexes = rng.choices(range(args.hosts), weights=weights, k=args.records)
+
+    return [
+        make_event(
+            index,
+            rng.choice(SERVICES + [""]),
+            rng.choice([0, 0, 0, 1, 2]),
+            offset + second,
+        )
+        for second, index in enumerate(indexes)
+    ]
+
+
+def seed_hosts(db_client, count):
+    """
+    Store active hosts in Firestore so events can be applied to them
+
+    :param db_client: Firestore client
+    :param count: Number of hosts
+    """
+
+    for index in range(count):
+        host = make_host(index)
+        db_client.collection("hosts").document(host["id"]).set(
+            {
+                "id": host["id"],
+                "sitename": host["sitename"],
+                "hostname": host["hostname"],
+                "decommissioned": False,
+                "hostgroups": host["host_groups"],
+                "bssglobalcoverage": "global",
+                "bsshwfamily": "family",
+                "bsslifecyclestatus": "production",
+                "status": 0,
+                "giskleur": 0,
+                "type": "HOST",
+                "event_output": "Initial display - NS-TCC-GIS",
+                "starttime": 0,
+                "longitude": host["longitude"]["value"],
+                "latitude": host["latitude"]["value"],
+                "objectId": -(index + 1),
+            }
+        )
+
+    db_client.calls.clear()
+
+
+def run(args):
+    sys.path.insert(0, FUNCTION_DIR)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    from fake_firestore import FakeFirestore
+    from fake_pubsub import FakeSubscriber
+    from stub_arcgis import StubArcGIS
+
+    stub = StubArcGIS(
+        latency=args.latency,
+        failure_rate=args.failure_rate,
+        throttle_rate=args.throttle_rate,
+    ).start()
+    load_config(stub, args)
+
+    import main
+
+    db_client = FakeFirestore()
+    main._db_client = db_client
+    main._arcgis_secret = "benchmark"
+    subscriber = FakeSubscriber()
+    main._subscriber_client = subscriber
+    os.environ.setdefault("PROJECT_ID", "benchmark")
+
+    # Processing a record includes waiting for earlier edits of its host, the
+    # asynchronous processors await those before handling the record
+    recorder = LatencyRecorder()
+    method = "handle" if args.use_async else "process"
+    for processor in [main.HostProcessor, main.EventProcessor]:
+        setattr(processor, method, recorder.wrap(getattr(processor, method)))
+    main.EventProcessor.handle_coalesced = recorder.wrap(
+        main.EventProcessor.handle_coalesced, lambda self, events: len(events)
+    )
+
+    rng = random.Random(args.seed)
+
+    if args.kind == "events":
+        seed_hosts(db_client, args.hosts)
+        # Hosts in Firestore refer to features that exist in ArcGIS
+        stub.features["4"] = {
+            -(index + 1): {"attributes": {"objectid": -(index + 1)}}
+            for index in range(args.hosts)
+        }
+
+    message_times = []
+    peak_memory = 0
+    for message in range(args.messages):
+        if args.kind == "hosts":
+            subscription = SUBS["host"]
+            payload = {"ns_tcc_hosts": generate_hosts(args, rng, message)}
+        else:
+            subscription = SUBS["event"]
+            payload = {
+                "ns_tcc_events": generate_events(args, rng, message * args.records)
+            }
+
+        # Redelivered messages are published again or sent with the same message ID
+        deliveries = 2 if args.redeliver and rng.random() < args.redeliver else 1
+
+        if args.pull:
+            for _ in range(deliveries):
+                subscriber.publish(
+                    subscriber.subscription_path(
+                        os.environ["PROJECT_ID"], subscription
+                    ),
+                    json.dumps(payload).encode(),
+                )
+            continue
+
+        request = Request(subscription, payload)
+        for _ in range(deliveries):
+            if args.trace_memory:
+                tracemalloc.start()
+
+            started = time.perf_counter()
+            response = main.main(request)
+            message_times.append(time.perf_counter() - started)
+
+            if args.trace_memory:
+                peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+
+            if response != ("OK", 204):
+                logging.error(f"Message {message} returned {response}")
+
+    if args.pull:
+        if args.trace_memory:
+            tracemalloc.start()
+
+        started = time.perf_counter()
+        response = main.pull(None)
+        message_times.append(time.perf_counter() - started)
+
+        if args.trace_memory:
+            peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        if response != ("OK", 204):
+            logging.error(f"Pull returned {response}")
+
+    stub.stop()
+
+    total_time = sum(message_times)
+    total_records = args.records * args.messages
+
+    return {
+        "parameters": vars(args),
+        "records": total_records,
+        "seconds": total_time,
+        "records_per_second": total_records / total_time if total_time else None,
+        "message_seconds": {
+            "mean": statistics.mean(message_times),
+            "max": max(message_times),
+        },
+        "record_latency_ms": {
+            "p50": recorder.percentile(50),
+            "p99": recorder.percentile(99),
+        },
+        "peak_memory_bytes": peak_memory if args.trace_memory else None,
+        "firestore_calls": dict(db_client.calls),
+        "arcgis_calls": dict(stub.calls),
+        "pubsub_calls": dict(subscriber.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--kind", choices=["hosts", "events"], default="events")
+    parser.add_argument("--records", type=int, default=500, help="Records per message")
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument(
+        "--hosts", type=int, default=200, help="Number of distinct hosts"
+    )
+    parser.add_argument(
+        "--skew", type=float, default=1.0, help="Zipf exponent of records per host"
+    )
+    parser.add_argument(
+        "--decommissioned",
+        type=float,
+        default=0.05,
+        help="Share of decommissioned hosts",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.01, help="ArcGIS stub latency in seconds"
+    )
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.0, help="Share of failing edits"
+    )
+    parser.add_argument(
+        "--throttle-rate", type=float, default=0.0, help="Share of throttled requests"
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--coalescing", action="store_true")
+    parser.add_argument("--async", dest="use_async", action="store_true")
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument(
+        "--batch-size", type=int, default=500, help="Records per streamed batch"
+    )
+    parser.add_argument(
+        "--deduplication",
+        action="store_true",
+        help="Skip redelivered messages and events",
+    )
+    parser.add_argument(
+        "--redeliver",
+        type=float,
+        default=0.0,
+        help="Share of messages that is delivered a second time",
+    )
+    parser.add_argument(
+        "--pull",
+        action="store_true",
+        help="Publish all messages first and consume them with the pull entry point",
+    )
+    parser.add_argument(
+        "--pull-batch-records",
+        type=int,
+        default=1000,
+        help="Records per pulled micro-batch",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Report the peak memory allocated while processing a message",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    results = run(args)
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
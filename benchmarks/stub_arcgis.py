@@ -0,0 +1,213 @@
+"""Local stand-in for the ArcGIS token and feature service REST endpoints."""
+
+import ast
+import copy
+import gzip
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+EDIT_RESULT_KEYS = {
+    "adds": "addResults",
+    "updates": "updateResults",
+    "deletes": "deleteResults",
+}
+OBJECT_ID_PATTERN = re.compile(r"objectid > (\d+)")
+ENDTIME_PATTERN = re.compile(r"endtime < TIMESTAMP '([^']+)'")
+
+
+class StubArcGIS:
+    def __init__(
+        self, latency=0.0, failure_rate=0.0, throttle_rate=0.0, host="127.0.0.1", port=0
+    ):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(0)
+        self.calls = Counter()
+        self.features = {}
+        self.next_object_id = 1
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer((host, port), self.get_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def oauth_url(self):
+        return f"{self.url}/sharing/rest/generateToken"
+
+    @property
+    def service_url(self):
+        return f"{self.url}/rest/services/hosts/FeatureServer"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.handle_request(dict(parse_qsl(urlparse(self.path).query)))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+
+                self.handle_request(dict(parse_qsl(body.decode("utf-8"))))
+
+            def handle_request(self, form):
+                time.sleep(stub.latency)
+
+                path = urlparse(self.path).path
+                response = stub.handle(path, form)
+                content = json.dumps(response).encode("utf-8")
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        return Handler
+
+    def handle(self, path, form):
+        with self.lock:
+            if path.endswith("/generateToken"):
+                self.calls["token"] += 1
+                return {"token": "stub-token", "expires": (time.time() + 3600) * 1000}
+
+            layer = path.rstrip("/").split("/")[-2]
+            endpoint = path.rstrip("/").split("/")[-1]
+            self.calls[endpoint] += 1
+
+            if endpoint == "applyEdits":
+                if self.random.random() < self.throttle_rate:
+                    self.calls["throttled"] += 1
+                    return {"error": {"code": 429, "message": "Too many requests"}}
+
+                return self.apply_edits(layer, form)
+            if endpoint == "query":
+                return self.query(layer, form)
+
+            return {"error": {"code": 400, "message": f"Unknown endpoint {path}"}}
+
+    def apply_edits(self, layer, form):
+        features = self.features.setdefault(layer, {})
+        snapshot = copy.deepcopy(features)
+        response = {}
+
+        for function, result_key in EDIT_RESULT_KEYS.items():
+            if function not in form:
+                continue
+
+            results = []
+            for edit in self.decode(form[function]):
+                if self.random.random() < self.failure_rate:
+                    self.calls["failed"] += 1
+                    results.append(self.failed_result(None, 503, "Service unavailable"))
+                    continue
+
+                if function == "adds":
+                    object_id = self.next_object_id
+                    self.next_object_id += 1
+                    features[object_id] = edit
+                    edit["attributes"]["objectid"] = object_id
+                elif function == "updates":
+                    object_id = edit["attributes"]["objectid"]
+                    if object_id not in features:
+                        results.append(self.failed_result(object_id))
+                        continue
+                    features[object_id]["attributes"].update(edit["attributes"])
+                    if "geometry" in edit:
+                        features[object_id]["geometry"] = edit["geometry"]
+                else:
+                    object_id = edit
+                    if features.pop(object_id, None) is None:
+                        results.append(self.failed_result(object_id))
+                        continue
+
+                results.append({"objectId": object_id, "success": True})
+
+            response[result_key] = results
+
+        failed = any(
+            not result["success"] for results in response.values() for result in results
+        )
+        if failed and form.get("rollbackOnFailure", "true") == "true":
+            self.features[layer] = snapshot
+            for results in response.values():
+                for result in results:
+                    result["success"] = False
+
+        return response
+
+    def query(self, layer, form):
+        features = self.features.get(layer, {})
+        where = form.get("where", "objectid > 0")
+        after = int(OBJECT_ID_PATTERN.search(where).group(1))
+        count = int(form.get("resultRecordCount", 1000))
+
+        # Only the clauses of the reconciliation and compaction queries are supported
+        ended_before = ENDTIME_PATTERN.search(where)
+        if ended_before:
+            cutoff = datetime.strptime(ended_before.group(1), "%Y-%m-%d %H:%M:%S")
+            cutoff = cutoff.replace(tzinfo=timezone.utc).timestamp() * 1000
+
+        object_ids = sorted(
+            object_id
+            for object_id, feature in features.items()
+            if object_id > after
+            and (
+                not ended_before
+                or feature["attributes"].get("endtime") is not None
+                and feature["attributes"]["endtime"] < cutoff
+            )
+        )
+        if form.get("orderByFields", "").endswith("DESC"):
+            object_ids.reverse()
+        page = object_ids[:count]
+
+        return {
+            "features": [features[object_id] for object_id in page],
+            "exceededTransferLimit": len(object_ids) > count,
+        }
+
+    @staticmethod
+    def decode(value):
+        # Edits may be sent as JSON or as a Python literal
+        try:
+            return json.loads(value)
+        except ValueError:
+            return ast.literal_eval(value)
+
+    @staticmethod
+    def failed_result(object_id, code=1019, description="Object is missing."):
+        return {
+            "objectId": object_id,
+            "success": False,
+            "error": {"code": code, "description": description},
+        }
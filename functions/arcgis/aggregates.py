@@ -0,0 +1,167 @@
+import logging
+
+from firestore_utils import WriteBuffer
+
+COLLECTION = "host_states"
+
+
+def new_aggregate(event_info):
+    """
+    Get an empty host aggregate
+
+    :param event_info: Event information of an event of the host
+
+    :return: Host aggregate
+    """
+
+    return {
+        "sitename": event_info["sitename"],
+        "hostname": event_info["hostname"],
+        "host_state": 0,
+        "host_output": "",
+        "state_counts": {},
+        "services": {},
+    }
+
+
+def build_aggregate(event_infos):
+    """
+    Build a host aggregate from all events of a host
+
+    :param event_infos: Event information of all events of the host
+
+    :return: Host aggregate
+    """
+
+    aggregate = None
+
+    for event_info in event_infos:
+        if aggregate is None:
+            aggregate = new_aggregate(event_info)
+
+        _, aggregate = apply_event(aggregate, event_info, None)
+
+    return aggregate
+
+
+def apply_event(aggregate, event_info, old_state):
+    """
+    Apply a changed event state to a host aggregate
+
+    :param aggregate: Host aggregate
+    :param event_info: Event information with the new state
+    :param old_state: Previous state of the event, None for a new event
+
+    :return: Firestore field updates, Updated host aggregate
+    """
+
+    # Imported on first use, as loading the Firestore library slows down cold starts
+    from google.cloud.firestore_v1 import Increment
+    from google.cloud.firestore_v1.field_path import FieldPath
+
+    aggregate = dict(aggregate)
+    state = event_info["eventstate"]
+
+    if event_info["servicedescription"] == "":
+        updates = {"host_state": state, "host_output": event_info["output"]}
+        aggregate.update(updates)
+        return updates, aggregate
+
+    service = event_info["servicedescription"]
+    state_counts = dict(aggregate["state_counts"])
+    services = dict(aggregate["services"])
+
+    updates = {
+        FieldPath("services", service).to_api_repr(): {
+            "state": state,
+            "output": event_info["output"],
+        },
+        FieldPath("state_counts", str(state)).to_api_repr(): Increment(1),
+    }
+    state_counts[str(state)] = state_counts.get(str(state), 0) + 1
+
+    if old_state is not None:
+        updates[FieldPath("state_counts", str(old_state)).to_api_repr()] = Increment(-1)
+        state_counts[str(old_state)] = state_counts.get(str(old_state), 0) - 1
+
+    services[service] = {"state": state, "output": event_info["output"]}
+    aggregate.update({"state_counts": state_counts, "services": services})
+
+    return updates, aggregate
+
+
+def get_worst_states(aggregate):
+    """
+    Return current "worst" states from a host aggregate
+
+    :param aggregate: Host aggregate
+
+    :return: Event status, Host event output, Host status, Service event output
+    """
+
+    event_status = max(
+        (int(state) for state, count in aggregate["state_counts"].items() if count > 0),
+        default=0,
+    )
+    service_event_output = ""
+
+    if event_status > 0:
+        # The alphabetically first service with the worst state, like the first event
+        # in document ID order, as the order of the services depends on how the
+        # aggregate was read
+        services = aggregate["services"]
+        name = min(
+            (
+                name
+                for name, service in services.items()
+                if service["state"] == event_status
+            ),
+            default=None,
+        )
+        if name is not None:
+            service_event_output = services[name]["output"]
+
+    return (
+        event_status,
+        aggregate["host_output"],
+        aggregate["host_state"],
+        service_event_output,
+    )
+
+
+def rebuild_aggregates(db_client):
+    """
+    Recompute all host aggregates from the events collection
+
+    :param db_client: Firestore client
+
+    :return: Number of rebuilt host aggregates
+    """
+
+    aggregates = {}
+
+    for doc in db_client.collection("events").stream():
+        event_info = doc.to_dict()
+        unique_id_host = f"{event_info['sitename']}_{event_info['hostname']}"
+
+        aggregate = aggregates.get(unique_id_host) or new_aggregate(event_info)
+        _, aggregates[unique_id_host] = apply_event(aggregate, event_info, None)
+
+    writes = WriteBuffer(db_client)
+    for unique_id_host, aggregate in aggregates.items():
+        writes.set(db_client.collection(COLLECTION).document(unique_id_host), aggregate)
+
+    failed_paths = writes.commit()
+    if failed_paths:
+        logging.error(f"Failed to rebuild {len(failed_paths)} host aggregates")
+
+    return len(aggregates) - len(failed_paths)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    from google.cloud import firestore_v1
+
+    count = rebuild_aggregates(firestore_v1.Client())
+    logging.info(f"Rebuilt {count} host aggregates")
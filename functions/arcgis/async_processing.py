@@ -0,0 +1,571 @@
+import asyncio
+import json
+import logging
+from contextlib import contextmanager
+
+import aiohttp
+import config
+import main
+import metrics
+import throttling
+import utils
+from firestore_utils import DocumentCache, WriteBuffer
+
+
+class AsyncArcGISProcessor(main.ArcGISProcessor):
+    def __init__(self):
+        """
+        Asynchronous ArcGIS processor, which requests the token on creation and is
+        therefore created in an executor, see open for the parts bound to the loop
+        """
+
+        super().__init__()
+        self.client_session = None
+        self.requests = None
+        self.edit_completed = None
+        self.flush_needed = None
+        self.flushing = None
+        self.flusher = None
+        # Groups of records being processed that do not wait for their edits
+        self.running = 0
+
+    async def open(self):
+        """
+        Open the HTTP session used for ArcGIS REST traffic
+        """
+
+        self.requests = asyncio.Semaphore(getattr(config, "ASYNC_CONCURRENCY", 10))
+        self.edit_completed = asyncio.Event()
+        self.flush_needed = asyncio.Event()
+        self.flushing = asyncio.Lock()
+        self.flusher = asyncio.ensure_future(self.run_flusher())
+
+        connect_timeout, read_timeout = getattr(config, "HTTP_TIMEOUT", (10, 60))
+
+        self.client_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=getattr(config, "HTTP_POOL_MAXSIZE", 10)
+            ),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=connect_timeout, sock_read=read_timeout
+            ),
+        )
+
+    async def close(self):
+        """
+        Close the HTTP session used for ArcGIS REST traffic
+        """
+
+        if self.flusher:
+            self.flusher.cancel()
+            try:
+                await self.flusher
+            except asyncio.CancelledError:
+                pass
+            self.flusher = None
+
+        if self.client_session:
+            await self.client_session.close()
+            self.client_session = None
+
+    async def apply_edits(self, edits, layer, rollback=False):
+        """
+        Apply ArcGIS edits, refreshing the token once when ArcGIS rejects it
+
+        :param edits: ArcGIS edits per function ("adds", "updates" and/or "deletes")
+        :param layer: ArcGIS layer
+        :param rollback: Apply none of the edits if one of them fails
+        """
+
+        response = await self.post_edits(edits, layer, rollback)
+
+        if utils.is_invalid_token_response(response):
+            logging.info("ArcGIS token was rejected, requesting a new token")
+            self.arcgis_access_token = await asyncio.get_event_loop().run_in_executor(
+                None, self.get_token, self.arcgis_access_token
+            )
+
+            if self.arcgis_access_token:
+                response = await self.post_edits(edits, layer, rollback)
+
+        return response
+
+    async def post_edits(self, edits, layer, rollback=False):
+        """
+        Post ArcGIS edits to the applyEdits endpoint of a layer
+
+        :param edits: ArcGIS edits per function ("adds", "updates" and/or "deletes")
+        :param layer: ArcGIS layer
+        :param rollback: Apply none of the edits if one of them fails
+        """
+
+        body, headers = utils.encode_form(self.get_edits_form(edits, rollback))
+
+        if self.rate_limiter:
+            await asyncio.sleep(self.rate_limiter.reserve())
+
+        async with self.requests:
+            with metrics.timed(
+                "arcgis.apply_edits",
+                edits=sum(len(values) for values in edits.values()),
+                request_bytes=len(body),
+            ) as sizes:
+                async with self.client_session.post(
+                    config.SERVICE_URL + f"/{layer}/applyEdits",
+                    data=body,
+                    headers=headers,
+                ) as r:
+                    status_code = r.status
+                    content = await r.read()
+
+                sizes["response_bytes"] = len(content)
+
+        try:
+            response_json = json.loads(content)
+        except json.decoder.JSONDecodeError as e:
+            logging.error(
+                f"An error occurred when applying edits (status-code: {status_code}): {str(e)}"
+            )
+            response_json = utils.get_error_response(status_code, str(e))
+
+        self.on_response(response_json)
+
+        return response_json
+
+    async def add_feature(self, x, y, attributes, layer):
+        """
+        Add ArcGIS Feature
+
+        :param x: X-coordinate
+        :param y: Y-coordinate
+        :param attributes: Feature attributes
+        :param layer: Feature layer
+
+        :return: ArcGIS feature ID
+        """
+
+        adds = [self.get_feature(x, y, attributes)]
+
+        res = await self.apply_edits({"adds": adds}, layer)
+
+        if res and "addResults" in res:
+            return res["addResults"][0]
+
+        return res
+
+    async def update_feature(self, x, y, attributes, layer):
+        """
+        Update ArcGIS Feature
+
+        :param x: X-coordinate
+        :param y: Y-coordinate
+        :param attributes: Feature attributes
+        :param layer: Feature layer
+
+        :return: ArcGIS feature ID
+        """
+
+        updates = [self.get_feature(x, y, attributes)]
+
+        res = await self.apply_edits({"updates": updates}, layer)
+
+        if res and "updateResults" in res:
+            return res["updateResults"][0]
+
+        return res
+
+    async def delete_feature(self, object_id, layer):
+        """
+        Delete ArcGIS feature
+
+        :param object_id: Feature ID
+        :param layer: Feature layer
+
+        :return: ArcGIS feature ID
+        """
+
+        res = await self.apply_edits({"deletes": [object_id]}, layer)
+
+        if res and "deleteResults" in res:
+            return res["deleteResults"][0]
+
+        return res
+
+    @contextmanager
+    def processing(self):
+        """
+        Count a group of records as running while it is processed, as queued edits are
+        only flushed once no group is running
+        """
+
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.request_flush()
+
+    def request_flush(self):
+        """
+        Wake up the flusher once all running groups wait for their edits or are done
+        """
+
+        if self.running <= 0:
+            self.flush_needed.set()
+
+    async def run_flusher(self):
+        """
+        Flush the queued edits of all records together whenever the flusher is woken
+        up, so the edits of concurrently processed records share applyEdits calls
+        """
+
+        while True:
+            await self.flush_needed.wait()
+            self.flush_needed.clear()
+            await self.flush()
+
+    async def complete_pending(self, key):
+        """
+        Wait until the queued edits of a record are applied by the flusher
+
+        :param key: Key of the record
+        """
+
+        while self.has_pending(key):
+            self.running -= 1
+            self.request_flush()
+            try:
+                await self.edit_completed.wait()
+            finally:
+                self.running += 1
+
+    async def flush(self):
+        """
+        Apply all queued edits in concurrent chunked applyEdits calls per layer
+
+        Edits queued by callbacks during the flush are applied as well. A flush waits
+        for a flush in progress, so all queued edits are completed on return.
+        """
+
+        async with self.flushing:
+            while True:
+                with self.lock:
+                    if not self.pending_edits:
+                        return
+
+                    pending_edits, self.pending_edits = self.pending_edits, {}
+
+                await asyncio.gather(
+                    *(
+                        self.apply_chunk(chunk, layer)
+                        for layer, layer_edits in pending_edits.items()
+                        for chunk in self.chunk_edits(layer_edits)
+                    )
+                )
+
+    async def apply_chunk(self, chunk, layer, attempt=0):
+        """
+        Apply a chunk of queued edits and hand the results to their callbacks,
+        retrying edits that failed for a transient reason
+
+        :param chunk: List of queued edits
+        :param layer: Feature layer
+        :param attempt: Number of times the edits were retried before
+        """
+
+        rollback = self.use_rollback(chunk)
+        unprepared = False
+
+        try:
+            response = await self.apply_edits(
+                self.get_chunk_edits(chunk), layer, rollback
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"An error occurred when applying edits: {str(e)}")
+            response = utils.get_error_response(
+                None, str(e), sent=not isinstance(e, aiohttp.ClientConnectorError)
+            )
+        except Exception as e:
+            if len(chunk) == 1:
+                # Completed with an error, so its record does not wait for it forever
+                logging.exception(f"An error occurred when preparing edits: {str(e)}")
+            response = utils.get_error_response(400, str(e))
+            unprepared = True
+
+        if unprepared and len(chunk) > 1:
+            # Such as an edit that cannot be encoded, which is isolated by halving
+            await asyncio.gather(
+                *(self.apply_chunk(half, layer, attempt) for half in self.halve(chunk))
+            )
+            return
+
+        if rollback and len(chunk) > 1 and self.is_rolled_back(response):
+            # A single failing edit rolled back the whole chunk
+            await asyncio.gather(
+                *(
+                    self.apply_chunk(retry_chunk, layer, attempt)
+                    for retry_chunk in self.split_rolled_back(chunk)
+                )
+            )
+            return
+
+        retries = self.complete_chunk(chunk, response, attempt)
+
+        if retries:
+            delay = throttling.get_backoff_delay(attempt + 1)
+            logging.warning(f"Retrying {len(retries)} failed edits in {delay:.1f}s")
+            metrics.record("arcgis.retry_backoff", delay, edits=len(retries))
+
+            await asyncio.sleep(delay)
+            await self.apply_chunk(retries, layer, attempt + 1)
+
+    def complete_edit(self, result, callback, key):
+        """
+        Hand the results of queued edits to their callback and wake up waiting records
+
+        :param result: ArcGIS edit results per function
+        :param callback: Callback of the edits
+        :param key: Key of the record the edits belong to
+        """
+
+        super().complete_edit(result, callback, key)
+
+        self.edit_completed.set()
+        self.edit_completed = asyncio.Event()
+
+
+class AsyncHostProcessor(main.HostProcessor):
+    async def process_all(self, hosts):
+        """
+        Process hosts concurrently, keeping hosts with the same ID in order
+
+        :param hosts: List of host data
+        """
+
+        await process_grouped(
+            hosts, lambda host: host["id"], self.process, self.arcgis_processor
+        )
+
+    async def process(self, host):
+        """
+        Process each host data
+
+        :param host: Host data
+        """
+
+        try:
+            # Make sure earlier edits for this host are applied before reading it
+            await self.arcgis_processor.complete_pending(host["id"])
+
+            self.handle(host)
+        except Exception as e:
+            logging.exception(f"Error when processing host '{host['id']}': {e}")
+
+
+class AsyncEventProcessor(main.EventProcessor):
+    async def process_all(self, events):
+        """
+        Process events concurrently, keeping events of the same host in order
+
+        :param events: List of event data
+        """
+
+        await process_grouped(
+            events,
+            lambda event: self.make_unique_identifier(event)[1],
+            self.process,
+            self.arcgis_processor,
+        )
+
+    async def process(self, event):
+        """
+        Process each event data
+
+        :param event: Event data
+        """
+
+        try:
+            _, unique_id_host = self.make_unique_identifier(event)
+
+            # Make sure earlier edits for this host are applied before reading it
+            await self.arcgis_processor.complete_pending(unique_id_host)
+
+            # Handling an event may read the current host and the events of its host
+            await asyncio.get_event_loop().run_in_executor(None, self.handle, event)
+        except Exception as e:
+            logging.exception(f"Error when processing event: {event['id']}: {e}")
+
+    async def process_coalesced(self, events):
+        """
+        Process events grouped per host concurrently, publishing the host status once
+        per host
+
+        :param events: List of event data
+        """
+
+        await asyncio.gather(
+            *(
+                self.process_host_events(unique_id_host, host_events)
+                for unique_id_host, host_events in self.group_by_host(events).items()
+            )
+        )
+
+    async def process_host_events(self, unique_id_host, host_events):
+        """
+        Process the events of one host
+
+        :param unique_id_host: Unique ID host
+        :param host_events: List of event data of the host
+        """
+
+        with self.arcgis_processor.processing():
+            await self.arcgis_processor.complete_pending(unique_id_host)
+
+            # Handling events may read the current host and the events of the host
+            await asyncio.get_event_loop().run_in_executor(
+                None, self.handle_coalesced, host_events
+            )
+
+
+async def process_grouped(records, get_key, process, arcgis_processor):
+    """
+    Process records concurrently, keeping records with the same key in order
+
+    :param records: List of records
+    :param get_key: Function returning the key of a record
+    :param process: Coroutine function processing a single record
+    :param arcgis_processor: Asynchronous ArcGIS processor the records queue edits on
+    """
+
+    groups = {}
+    for record in records:
+        try:
+            key = get_key(record)
+        except (TypeError, KeyError):
+            key = None  # Invalid records are logged by the processor
+
+        groups.setdefault(key, []).append(record)
+
+    async def process_group(group):
+        with arcgis_processor.processing():
+            for record in group:
+                await process(record)
+
+    await asyncio.gather(*(process_group(group) for group in groups.values()))
+
+
+async def process_batches(subscription, batches, db_client):
+    """
+    Process the records of a message asynchronously one batch after another
+
+    :param subscription: Subscription the message was received from
+    :param batches: Iterable of lists of records
+    :param db_client: Firestore client
+
+    :return: Response
+    """
+
+    # Requesting the token blocks, so the processor is created outside the event loop
+    arcgis_processor = await asyncio.get_event_loop().run_in_executor(
+        None, AsyncArcGISProcessor
+    )
+    if not arcgis_processor.arcgis_access_token:
+        return "Error", 500
+
+    await arcgis_processor.open()
+    try:
+        for records in batches:
+            with metrics.timed("batch", records=len(records)):
+                await process_batch(subscription, arcgis_processor, records, db_client)
+    finally:
+        await arcgis_processor.close()
+
+    return "OK", 204
+
+
+async def process_batch(subscription, arcgis_processor, records, db_client):
+    """
+    Process a batch of records asynchronously, all edits and writes are completed on
+    return
+
+    :param subscription: Subscription the message was received from
+    :param arcgis_processor: Asynchronous ArcGIS processor
+    :param records: List of host or event data
+    :param db_client: Firestore client
+    """
+
+    loop = asyncio.get_event_loop()
+
+    documents = DocumentCache(db_client, {"hosts": main.get_host_cache()})
+    writes = WriteBuffer(db_client, documents)
+    deduplicator = main.get_deduplicator(documents)
+
+    if subscription == config.SUBS["host"]:
+        host_processor = AsyncHostProcessor(
+            arcgis_processor=arcgis_processor, documents=documents, writes=writes
+        )
+        await loop.run_in_executor(None, host_processor.prefetch, records)
+
+        await host_processor.process_all(records)
+    elif subscription == config.SUBS["event"]:
+        if deduplicator:
+            records = await loop.run_in_executor(
+                None,
+                deduplicator.skip_processed,
+                "event",
+                records,
+                main.EventProcessor.make_delivery_key,
+            )
+
+        event_processor = AsyncEventProcessor(
+            arcgis_processor=arcgis_processor,
+            documents=documents,
+            writes=writes,
+            event_states=main.get_event_state_cache(),
+        )
+        records = await loop.run_in_executor(
+            None, event_processor.skip_unchanged, records
+        )
+        await loop.run_in_executor(None, event_processor.prefetch, records)
+
+        if getattr(config, "EVENT_COALESCING", False):
+            process_events = event_processor.process_coalesced
+        else:
+            process_events = event_processor.process_all
+
+        await process_events(records)
+
+    await arcgis_processor.flush()
+    failed_paths = await loop.run_in_executor(None, writes.commit)
+
+    # Events of which documents changed concurrently are read and applied again
+    if subscription == config.SUBS["event"]:
+        for _ in range(getattr(config, "FIRESTORE_CONFLICT_RETRIES", 3)):
+            conflicted = event_processor.take_conflicted(records)
+            if not conflicted:
+                break
+
+            logging.warning(
+                f"Applying {len(conflicted)} events again after conflicting writes"
+            )
+            retried_paths = set(writes.conflicted_paths)
+            await loop.run_in_executor(None, event_processor.prefetch, conflicted)
+            await process_events(conflicted)
+
+            await arcgis_processor.flush()
+            failed_paths = [
+                path for path in failed_paths if path not in retried_paths
+            ] + await loop.run_in_executor(None, writes.commit)
+
+    if subscription == config.SUBS["host"]:
+        host_processor.report.log()
+    elif subscription == config.SUBS["event"]:
+        event_processor.report.log()
+
+        failed_keys = main.get_failed_keys(arcgis_processor, failed_paths)
+        event_processor.store_event_states(failed_keys)
+
+        if deduplicator:
+            await loop.run_in_executor(
+                None, main.mark_processed_events, deduplicator, records, failed_keys
+            )
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize, ttl, fingerprint=None):
+        """
+        Bounded least-recently-used cache of which entries expire after a TTL
+
+        :param maxsize: Maximum number of entries, 0 disables the cache
+        :param ttl: Seconds after which an entry expires
+        :param fingerprint: Function returning the fingerprint of a value
+        """
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.fingerprint = fingerprint
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def lookup(self, key):
+        """
+        Look up the entry of a key, counting a hit or miss
+
+        :param key: Key
+
+        :return: Value, Fingerprint or None if the key is not cached
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and entry[2] <= time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[0], entry[1]
+
+    def get(self, key):
+        """
+        Get a cached value
+
+        :param key: Key
+
+        :return: Value or None if the key is not cached
+        """
+
+        entry = self.lookup(key)
+
+        return entry[0] if entry is not None else None
+
+    def get_fingerprint(self, key):
+        """
+        Get the fingerprint of a cached value
+
+        :param key: Key
+
+        :return: Fingerprint or None if the key is not cached
+        """
+
+        entry = self.lookup(key)
+
+        return entry[1] if entry is not None else None
+
+    def put(self, key, value):
+        """
+        Cache a value, evicting the least recently used entry when the cache is full
+
+        :param key: Key
+        :param value: Value
+        """
+
+        if self.maxsize <= 0:
+            return
+
+        fingerprint = self.fingerprint(value) if self.fingerprint else None
+
+        with self.lock:
+            self.entries[key] = (value, fingerprint, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        """
+        Remove a cached value
+
+        :param key: Key
+        """
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        """
+        Get the counters of this cache
+
+        :return: Counters
+        """
+
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -0,0 +1,300 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
+import config
+import main
+import utils
+
+
+class CompactionError(Exception):
+    pass
+
+
+class Compactor:
+    def __init__(
+        self,
+        arcgis_processor,
+        db_client,
+        archive_path,
+        retention_days=None,
+        page_size=None,
+        checkpoint_path=None,
+        dry_run=False,
+    ):
+        """
+        Compaction of the hosts layer, which gains a closed feature for every status
+        change of a host
+
+        Closed features that ended before the retention window are read in pages
+        ordered by object ID, appended to a gzipped newline-delimited JSON archive and
+        then deleted in chunked applyEdits calls. After every page the last handled
+        object ID is written to a checkpoint, from which an interrupted run resumes.
+        The checkpoint is removed once a run completes, as features with a lower
+        object ID may be closed later. Features of the page that was interrupted, or
+        that failed to be deleted, are archived again by the next run.
+
+        :param arcgis_processor: ArcGIS processor
+        :param db_client: Firestore client
+        :param archive_path: Path of the archive the features are appended to
+        :param retention_days: Number of days closed features are kept
+        :param page_size: Number of features read per page
+        :param checkpoint_path: Path of the checkpoint, next to the archive by default
+        :param dry_run: Only count the features without archiving or deleting them
+        """
+
+        self.arcgis_processor = arcgis_processor
+        self.db_client = db_client
+        self.archive_path = archive_path
+        self.retention_days = retention_days or getattr(
+            config, "COMPACTION_RETENTION_DAYS", 90
+        )
+        self.page_size = page_size or getattr(config, "COMPACTION_PAGE_SIZE", 1000)
+        self.checkpoint_path = checkpoint_path or f"{archive_path}.checkpoint.json"
+        self.dry_run = dry_run
+        self.layer = config.LAYER["hosts"]
+        self.counts = Counter()
+
+    def run(self):
+        """
+        Archive and delete all closed features that ended before the retention window
+
+        :return: Number of features per outcome
+        """
+
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.retention_days)
+        after = self.read_checkpoint()
+        referenced = self.get_referenced_object_ids()
+
+        logging.info(
+            f"Compacting features that ended before {cutoff:%Y-%m-%d %H:%M:%S} "
+            f"with an object ID above {after}"
+        )
+
+        for features in self.iter_closed_pages(cutoff, after):
+            last_object_id = features[-1]["attributes"]["objectid"]
+
+            # Decommissioned hosts still refer to their closed feature
+            compacted = [
+                feature
+                for feature in features
+                if feature["attributes"]["objectid"] not in referenced
+            ]
+            self.counts["referenced"] += len(features) - len(compacted)
+
+            if self.dry_run:
+                self.counts["compactable"] += len(compacted)
+                continue
+
+            if compacted:
+                self.archive(compacted)
+                self.delete(compacted)
+
+            self.write_checkpoint(last_object_id)
+
+        if not self.dry_run and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        return dict(self.counts)
+
+    def get_referenced_object_ids(self):
+        """
+        Get the object IDs of the features that hosts refer to
+
+        :return: Set of object IDs
+        """
+
+        return {
+            snapshot.to_dict().get("objectId")
+            for snapshot in self.db_client.collection("hosts").stream()
+        }
+
+    def iter_closed_pages(self, cutoff, after):
+        """
+        Read the closed features that ended before a time in pages ordered by object ID
+
+        :param cutoff: Features that ended before this time are read
+        :param after: Only features with a higher object ID are read
+
+        :return: Generator of lists of ArcGIS features
+        """
+
+        where = (
+            f"endtime IS NOT NULL AND endtime < TIMESTAMP '{cutoff:%Y-%m-%d %H:%M:%S}'"
+        )
+
+        while True:
+            response = self.arcgis_processor.query(
+                self.layer,
+                {
+                    "where": f"objectid > {after} AND {where}",
+                    "outFields": "*",
+                    "orderByFields": "objectid ASC",
+                    "resultRecordCount": self.page_size,
+                    "returnGeometry": "true",
+                },
+            )
+
+            if not isinstance(response, dict) or "features" not in response:
+                raise CompactionError(
+                    f"Querying features after {after} failed: {response}"
+                )
+
+            if not response["features"]:
+                return
+
+            self.counts["features"] += len(response["features"])
+            yield response["features"]
+
+            after = response["features"][-1]["attributes"]["objectid"]
+
+    def archive(self, features):
+        """
+        Append features to the archive, which is synced to disk before the features
+        are deleted
+
+        :param features: ArcGIS features
+        """
+
+        with open(self.archive_path, "ab") as f:
+            with gzip.GzipFile(fileobj=f, mode="ab") as archive:
+                for feature in features:
+                    archive.write(utils.encode_edits(feature).encode("utf-8"))
+                    archive.write(b"\n")
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.counts["archived"] += len(features)
+
+    def delete(self, features):
+        """
+        Delete features in chunked applyEdits calls
+
+        :param features: ArcGIS features
+        """
+
+        for feature in features:
+            object_id = feature["attributes"]["objectid"]
+            self.arcgis_processor.queue_delete(
+                object_id, self.layer, callback=partial(self.on_deleted, object_id)
+            )
+
+        self.arcgis_processor.flush()
+        self.arcgis_processor.take_failed_keys()
+
+    def on_deleted(self, object_id, response):
+        """
+        Handle the ArcGIS result of deleting a feature
+
+        :param object_id: Object ID
+        :param response: ArcGIS delete result
+        """
+
+        if utils.is_edit_success(response):
+            self.counts["deleted"] += 1
+        else:
+            # The feature is read again by the next run
+            self.counts["failed"] += 1
+            logging.error(f"Failed to delete feature {object_id}: {response}")
+
+    def read_checkpoint(self):
+        """
+        Read the object ID after which an interrupted run resumes
+
+        :return: Object ID, 0 without a checkpoint
+        """
+
+        if not os.path.exists(self.checkpoint_path):
+            return 0
+
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+
+        logging.info(f"Resuming compaction from checkpoint {checkpoint}")
+
+        return checkpoint["after"]
+
+    def write_checkpoint(self, last_object_id):
+        """
+        Write the object ID after which an interrupted run resumes
+
+        :param last_object_id: Last object ID that was handled
+        """
+
+        checkpoint = {
+            "after": last_object_id,
+            "updated": int(time.time() * 1000),
+            "counts": dict(self.counts),
+        }
+
+        # Replaced atomically, so an interrupted write keeps the previous checkpoint
+        with open(f"{self.checkpoint_path}.tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(f"{self.checkpoint_path}.tmp", self.checkpoint_path)
+
+
+def compact(
+    archive_path,
+    retention_days=None,
+    page_size=None,
+    checkpoint_path=None,
+    dry_run=False,
+):
+    """
+    Compact the hosts layer
+
+    :param archive_path: Path of the archive the features are appended to
+    :param retention_days: Number of days closed features are kept
+    :param page_size: Number of features read per page
+    :param checkpoint_path: Path of the checkpoint, next to the archive by default
+    :param dry_run: Only count the features without archiving or deleting them
+
+    :return: Number of features per outcome, None if no token was retrieved
+    """
+
+    arcgis_processor = main.ArcGISProcessor()
+    if not arcgis_processor.arcgis_access_token:
+        return None
+
+    compactor = Compactor(
+        arcgis_processor,
+        main.get_db_client(),
+        archive_path,
+        retention_days,
+        page_size,
+        checkpoint_path,
+        dry_run,
+    )
+
+    return compactor.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Archive and delete closed features of the hosts layer"
+    )
+    parser.add_argument("archive", help="Gzipped newline-delimited JSON archive")
+    parser.add_argument("--retention-days", type=int, help="Days features are kept")
+    parser.add_argument("--page-size", type=int, help="Features per page")
+    parser.add_argument("--checkpoint", help="Checkpoint to resume from")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only count the compactable features"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    counts = compact(
+        args.archive, args.retention_days, args.page_size, args.checkpoint, args.dry_run
+    )
+    if counts is None:
+        logging.error("Compaction failed, no ArcGIS token retrieved")
+    else:
+        logging.info(f"Compacted hosts layer: {counts}")
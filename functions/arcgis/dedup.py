@@ -0,0 +1,150 @@
+import hashlib
+import logging
+from datetime import datetime, timedelta, timezone
+
+import config
+import metrics
+from firestore_utils import WriteBuffer
+
+
+class Deduplicator:
+    def __init__(self, client, processed, documents=None):
+        """
+        Detection of messages and records that were processed before, such as
+        redelivered Pub/Sub messages
+
+        Processed work is marked in Firestore with a marker document that expires after
+        DEDUPLICATION_TTL seconds, and in a cache kept between messages.
+
+        :param client: Firestore client
+        :param processed: LRU cache of marker IDs known to be processed
+        :param documents: Firestore documents of the message, to read markers in bulk
+        """
+
+        self.client = client
+        self.processed = processed
+        self.documents = documents
+        self.collection = getattr(config, "DEDUPLICATION_COLLECTION", "processed")
+        self.ttl = getattr(config, "DEDUPLICATION_TTL", 7 * 24 * 3600)
+
+    @staticmethod
+    def get_marker_id(kind, key):
+        """
+        Get the marker document ID of processed work
+
+        :param kind: Kind of work ("message" or "event")
+        :param key: Key of the work, such as the message ID
+
+        :return: Marker document ID
+        """
+
+        # Keys may contain characters that are not allowed in document IDs
+        return f"{kind}_{hashlib.sha1(str(key).encode('utf-8')).hexdigest()}"
+
+    def get_reference(self, kind, key):
+        """
+        Get the Firestore reference of the marker of processed work
+
+        :param kind: Kind of work ("message" or "event")
+        :param key: Key of the work
+
+        :return: Firestore document reference
+        """
+
+        return self.client.collection(self.collection).document(
+            self.get_marker_id(kind, key)
+        )
+
+    def is_processed(self, kind, key):
+        """
+        Check if work was processed before
+
+        :param kind: Kind of work ("message" or "event")
+        :param key: Key of the work
+
+        :return: True if the work was processed before
+        """
+
+        marker_id = self.get_marker_id(kind, key)
+        if self.processed.get(marker_id):
+            return True
+
+        ref = self.get_reference(kind, key)
+        if self.documents is not None:
+            marker = self.documents.get(ref)
+        else:
+            with metrics.timed("firestore.get", documents=1):
+                snapshot = ref.get()
+            marker = snapshot.to_dict() if snapshot.exists else None
+
+        # Expired markers may not be removed by the TTL policy yet
+        if marker is None or marker["expires"] <= datetime.now(timezone.utc):
+            return False
+
+        self.processed.put(marker_id, True)
+
+        return True
+
+    def skip_processed(self, kind, records, get_key):
+        """
+        Remove records that were processed before or occur earlier in the same list
+
+        :param kind: Kind of work ("message" or "event")
+        :param records: List of records
+        :param get_key: Function returning the key of a record
+
+        :return: List of records that were not processed before
+        """
+
+        with metrics.timed("deduplication", records=len(records)) as sizes:
+            keys = []
+            for record in records:
+                try:
+                    keys.append(get_key(record))
+                except (TypeError, KeyError):
+                    keys.append(None)  # Invalid records are logged by the processor
+
+            if self.documents is not None:
+                self.documents.prefetch(
+                    self.get_reference(kind, key)
+                    for key in keys
+                    if key is not None
+                    and not self.processed.get(self.get_marker_id(kind, key))
+                )
+
+            unprocessed, seen = [], set()
+            for record, key in zip(records, keys):
+                if key is None:
+                    unprocessed.append(record)
+                elif key not in seen and not self.is_processed(kind, key):
+                    seen.add(key)
+                    unprocessed.append(record)
+
+            sizes["skipped"] = len(records) - len(unprocessed)
+
+        if sizes["skipped"]:
+            logging.info(
+                f"Skipped {sizes['skipped']} {kind} records that were processed before"
+            )
+
+        return unprocessed
+
+    def mark_processed(self, kind, keys):
+        """
+        Mark work as processed
+
+        :param kind: Kind of work ("message" or "event")
+        :param keys: Keys of the processed work
+        """
+
+        expires = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        writes = WriteBuffer(self.client)
+
+        for key in keys:
+            self.processed.put(self.get_marker_id(kind, key), True)
+            writes.set(self.get_reference(kind, key), {"expires": expires})
+
+        failed_paths = writes.commit()
+
+        for path in failed_paths:
+            self.processed.pop(path.split("/", 1)[1])
@@ -0,0 +1,572 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+import metrics
+import throttling
+
+
+def get_commit_errors():
+    """
+    Get the errors of a failed commit, which are imported on first use as loading the
+    Google API libraries slows down cold starts
+
+    :return: Errors of which a precondition or create did not hold, errors that may
+        succeed when the batch is committed again, all API errors
+    """
+
+    from google.api_core import exceptions
+
+    return (
+        (exceptions.AlreadyExists, exceptions.FailedPrecondition),
+        (
+            exceptions.Aborted,
+            exceptions.DeadlineExceeded,
+            exceptions.InternalServerError,
+            exceptions.ServiceUnavailable,
+            exceptions.TooManyRequests,
+        ),
+        exceptions.GoogleAPICallError,
+    )
+
+
+class DocumentCache:
+    def __init__(self, client, shared=None):
+        """
+        Firestore documents read and written while processing a message
+
+        :param client: Firestore client
+        :param shared: LRU caches per collection that are kept between messages
+        """
+
+        self.client = client
+        self.shared = shared or {}
+        self.chunk_size = getattr(config, "FIRESTORE_READ_CHUNK_SIZE", 300)
+        self.documents = {}
+        self.versions = {}
+        # Documents read from Firestore or written while processing this message
+        self.fresh_paths = set()
+        self.lock = threading.Lock()
+
+    def get_shared(self, ref):
+        """
+        Get the LRU cache kept between messages of the collection of a document
+
+        :param ref: Firestore document reference
+
+        :return: LRU cache or None if the collection is not cached between messages
+        """
+
+        return self.shared.get(ref.path.split("/", 1)[0])
+
+    def load_shared(self, ref):
+        """
+        Take a document from the LRU cache kept between messages
+
+        :param ref: Firestore document reference
+
+        :return: True if the document was cached
+        """
+
+        shared = self.get_shared(ref)
+        document = shared.get(ref.path) if shared is not None else None
+
+        if document is None:
+            return False
+
+        with self.lock:
+            self.documents.setdefault(ref.path, dict(document))
+
+        return True
+
+    def store_shared(self, path, document):
+        """
+        Keep a document in the LRU cache kept between messages
+
+        :param path: Firestore document path
+        :param document: Document data
+        """
+
+        shared = self.shared.get(path.split("/", 1)[0])
+
+        if shared is not None and document is not None:
+            shared.put(path, dict(document))
+
+    def get_fingerprint(self, ref):
+        """
+        Get the fingerprint of a document kept between messages
+
+        :param ref: Firestore document reference
+
+        :return: Fingerprint or None if the document is not cached
+        """
+
+        shared = self.get_shared(ref)
+
+        return shared.get_fingerprint(ref.path) if shared is not None else None
+
+    def discard(self, paths):
+        """
+        Remove documents from the LRU caches kept between messages, for example when
+        writing them failed
+
+        :param paths: Firestore document paths
+        """
+
+        for path in paths:
+            shared = self.shared.get(path.split("/", 1)[0])
+            if shared is not None:
+                shared.pop(path)
+
+    def prefetch(self, refs):
+        """
+        Read Firestore documents in chunked get_all calls
+
+        :param refs: Firestore document references
+        """
+
+        refs = list(
+            {
+                ref.path: ref
+                for ref in refs
+                if ref.path not in self.documents and not self.load_shared(ref)
+            }.values()
+        )
+
+        for i in range(0, len(refs), self.chunk_size):
+            chunk = refs[i : i + self.chunk_size]
+
+            for ref in chunk:
+                self.documents[ref.path] = None
+                self.fresh_paths.add(ref.path)
+
+            with metrics.timed("firestore.get_all", documents=len(chunk)):
+                for snapshot in self.client.get_all(chunk):
+                    if snapshot.exists:
+                        self.documents[snapshot.reference.path] = snapshot.to_dict()
+                        self.versions[snapshot.reference.path] = snapshot.update_time
+                        self.store_shared(snapshot.reference.path, snapshot.to_dict())
+
+    def get(self, ref):
+        """
+        Get a Firestore document, reading it when it was not prefetched
+
+        :param ref: Firestore document reference
+
+        :return: Document data or None if the document does not exist
+        """
+
+        if ref.path not in self.documents and not self.load_shared(ref):
+            with metrics.timed("firestore.get", documents=1):
+                snapshot = ref.get()
+            with self.lock:
+                self.documents.setdefault(
+                    ref.path, snapshot.to_dict() if snapshot.exists else None
+                )
+                self.fresh_paths.add(ref.path)
+                if snapshot.exists:
+                    self.versions.setdefault(ref.path, snapshot.update_time)
+
+            if snapshot.exists:
+                self.store_shared(ref.path, snapshot.to_dict())
+
+        with self.lock:
+            document = self.documents[ref.path]
+
+            return dict(document) if document is not None else None
+
+    def get_fresh(self, ref):
+        """
+        Get a Firestore document, reading it again when it was taken from the LRU
+        cache kept between messages, which misses recent writes of other instances
+
+        :param ref: Firestore document reference
+
+        :return: Document data or None if the document does not exist
+        """
+
+        if ref.path not in self.fresh_paths:
+            self.forget([ref.path])
+
+        return self.get(ref)
+
+    def get_version(self, path):
+        """
+        Get the update time of a document as read from or committed to Firestore by
+        this message
+
+        :param path: Firestore document path
+
+        :return: Update time or None if the document was not read from Firestore, for
+            example when it was taken from the LRU cache kept between messages
+        """
+
+        with self.lock:
+            return self.versions.get(path)
+
+    def put_version(self, path, update_time):
+        """
+        Keep the update time of a document committed to Firestore
+
+        :param path: Firestore document path
+        :param update_time: Update time of the commit
+        """
+
+        with self.lock:
+            self.versions[path] = update_time
+
+    def read_versions(self, refs, field_paths=None):
+        """
+        Read the current update times of Firestore documents, bypassing all caches
+
+        :param refs: Firestore document references
+        :param field_paths: Fields to read, a small field when only the update times
+            are needed
+
+        :return: Update time per document path, None for documents that do not exist
+        """
+
+        refs = list({ref.path: ref for ref in refs}.values())
+        versions = {}
+
+        for i in range(0, len(refs), self.chunk_size):
+            chunk = refs[i : i + self.chunk_size]
+
+            with metrics.timed("firestore.get_all", documents=len(chunk)):
+                for snapshot in self.client.get_all(chunk, field_paths=field_paths):
+                    versions[snapshot.reference.path] = (
+                        snapshot.update_time if snapshot.exists else None
+                    )
+
+        return versions
+
+    def forget(self, paths):
+        """
+        Remove documents from all caches, so they are read from Firestore again
+
+        :param paths: Firestore document paths
+        """
+
+        with self.lock:
+            for path in paths:
+                self.documents.pop(path, None)
+                self.versions.pop(path, None)
+
+        self.discard(paths)
+
+    def put(self, ref, data, merge=False):
+        """
+        Keep a document up to date with a write to Firestore
+
+        :param ref: Firestore document reference
+        :param data: Written data
+        :param merge: Merge the data into the existing document
+        """
+
+        with self.lock:
+            document = self.documents.get(ref.path)
+
+            if merge and document is not None:
+                document.update(data)
+            else:
+                self.documents[ref.path] = dict(data)
+            self.fresh_paths.add(ref.path)
+
+            if merge and document is None:
+                # Only the merged fields are known, so the shared document is outdated
+                self.discard([ref.path])
+            else:
+                self.store_shared(ref.path, self.documents[ref.path])
+
+
+class WriteBuffer:
+    def __init__(self, client, documents=None):
+        self.client = client
+        self.documents = documents
+        self.batch_size = getattr(config, "FIRESTORE_BATCH_SIZE", 500)
+        self.writes = []
+        self.pending_paths = set()
+        self.conflicted_paths = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def set(self, ref, data, merge=False):
+        """
+        Buffer a Firestore set operation
+
+        :param ref: Firestore document reference
+        :param data: Document data
+        :param merge: Merge the data into the existing document
+        """
+
+        self.add_write("set", ref, data, merge)
+
+    def create(self, ref, data):
+        """
+        Buffer a Firestore create operation, which fails if the document exists
+
+        :param ref: Firestore document reference
+        :param data: Document data
+        """
+
+        self.add_write("create", ref, data, False)
+
+    def update(self, ref, data, document=None, last_update_time=None):
+        """
+        Buffer a Firestore update operation
+
+        :param ref: Firestore document reference
+        :param data: Updated fields
+        :param document: Resulting document to cache, for updates that cannot be merged
+            locally such as field paths and transforms
+        :param last_update_time: Update time the document must still have, which is
+            only checked for the first buffered write of a document
+        """
+
+        self.add_write("update", ref, data, True, document, last_update_time)
+
+    def add_write(
+        self, operation, ref, data, merge, document=None, last_update_time=None
+    ):
+        """
+        Buffer a Firestore write and apply it to the cached document
+
+        :param operation: Write operation ("set", "create" or "update")
+        :param ref: Firestore document reference
+        :param data: Written data
+        :param merge: Merge the data into the existing document
+        :param document: Resulting document to cache instead of the merged data
+        :param last_update_time: Update time the document must still have
+        """
+
+        group = getattr(self.local, "group", None)
+
+        with self.lock:
+            # A buffered write changes the document after it was read
+            if ref.path in self.pending_paths:
+                last_update_time = None
+
+            write = (operation, ref, data, merge, last_update_time)
+
+            if group is not None:
+                group.append(write)
+            else:
+                self.writes.append([write])
+
+            self.pending_paths.add(ref.path)
+
+        if self.documents is None:
+            return
+
+        if document is not None:
+            self.documents.put(ref, document)
+        else:
+            self.documents.put(ref, data, merge=merge)
+
+    @contextmanager
+    def atomic(self):
+        """
+        Buffer all writes made within this context in the same WriteBatch
+        """
+
+        if getattr(self.local, "group", None) is not None:
+            yield
+            return
+
+        self.local.group = []
+        try:
+            yield
+        finally:
+            with self.lock:
+                if self.local.group:
+                    self.writes.append(self.local.group)
+            self.local.group = None
+
+    def pending_documents(self, collection):
+        """
+        Get documents of a collection with buffered writes
+
+        :param collection: Collection name
+
+        :return: Generator of document path and document data
+        """
+
+        with self.lock:
+            pending_paths = list(self.pending_paths)
+
+        for path in pending_paths:
+            if path.split("/", 1)[0] == collection:
+                yield path, self.documents.documents.get(path)
+
+    def commit(self):
+        """
+        Commit all buffered writes in WriteBatches of at most the batch size
+
+        Batches failing for a transient reason are retried with backoff. A batch that
+        still fails is committed again group by group, so only the groups that cannot
+        be written fail.
+
+        Paths of groups that failed because a document changed since it was read are
+        kept in conflicted_paths, so their records can be processed again. Groups
+        writing a conflicted document later on are not committed, as they were based
+        on the write that failed.
+
+        :return: Paths of the documents whose writes failed to commit
+        """
+
+        with self.lock:
+            writes, self.writes = self.writes, []
+            self.pending_paths = set()
+
+        self.conflicted_paths = []
+        failed_paths = []
+
+        for groups in self.chunk_writes(writes):
+            failed_paths.extend(self.commit_groups(groups))
+
+        # Cached documents of failed writes no longer match Firestore
+        if self.documents is not None:
+            self.documents.discard(failed_paths)
+
+        return failed_paths
+
+    def commit_groups(self, groups):
+        """
+        Commit groups of writes in a single WriteBatch, splitting it up when it fails
+
+        :param groups: Groups of buffered writes
+
+        :return: Paths of the documents whose writes failed to commit
+        """
+
+        # Writes following a conflicted write of the same document depend on it
+        blocked = [
+            group
+            for group in groups
+            if any(write[1].path in self.conflicted_paths for write in group)
+        ]
+        if blocked:
+            groups = [group for group in groups if group not in blocked]
+            paths = sorted({write[1].path for group in blocked for write in group})
+            self.conflicted_paths.extend(
+                path for path in paths if path not in self.conflicted_paths
+            )
+            logging.warning(
+                f"Skipped {len(blocked)} groups of Firestore writes depending on "
+                f"conflicted writes for documents {paths}"
+            )
+            if not groups:
+                return paths
+
+            return paths + self.commit_groups(groups)
+
+        chunk = [write for group in groups for write in group]
+        conflict_errors, transient_errors, api_errors = get_commit_errors()
+
+        try:
+            results = self.commit_batch(chunk)
+        except api_errors as e:
+            if len(groups) > 1 and not isinstance(e, transient_errors):
+                logging.warning(
+                    f"Failed to commit batch of {len(chunk)} Firestore writes, "
+                    f"committing its {len(groups)} groups separately: {str(e)}"
+                )
+                return [
+                    path for group in groups for path in self.commit_groups([group])
+                ]
+
+            paths = sorted({write[1].path for write in chunk})
+            if isinstance(e, conflict_errors):
+                self.conflicted_paths.extend(paths)
+                logging.warning(
+                    f"Writes for documents {paths} conflict with a concurrent change: "
+                    f"{str(e)}"
+                )
+                return paths
+
+            logging.error(
+                f"Failed to commit batch of {len(chunk)} Firestore writes for documents {paths}: {str(e)}"
+            )
+            return paths
+
+        self.store_versions(chunk, results)
+
+        return []
+
+    def commit_batch(self, chunk):
+        """
+        Commit writes in a WriteBatch, retrying transient errors with backoff
+
+        :param chunk: Buffered writes
+
+        :return: Write results
+        """
+
+        retries = getattr(config, "FIRESTORE_COMMIT_RETRIES", 3)
+        _, transient_errors, _ = get_commit_errors()
+
+        for attempt in range(retries + 1):
+            batch = self.client.batch()
+
+            for operation, ref, data, merge, last_update_time in chunk:
+                if operation == "set":
+                    batch.set(ref, data, merge=merge)
+                elif operation == "create":
+                    batch.create(ref, data)
+                elif last_update_time is not None:
+                    option = self.client.write_option(last_update_time=last_update_time)
+                    batch.update(ref, data, option=option)
+                else:
+                    batch.update(ref, data)
+
+            try:
+                with metrics.timed("firestore.commit", writes=len(chunk)):
+                    return batch.commit()
+            except transient_errors as e:
+                if attempt == retries:
+                    raise
+
+                delay = throttling.get_backoff_delay(attempt + 1)
+                logging.warning(
+                    f"Retrying commit of {len(chunk)} Firestore writes in {delay:.1f}s: {str(e)}"
+                )
+                time.sleep(delay)
+
+    def store_versions(self, chunk, results):
+        """
+        Keep the update times of committed writes with the cached documents
+
+        :param chunk: Committed writes
+        :param results: Write results of the commit, in the order of the writes
+        """
+
+        if self.documents is None or not results:
+            return
+
+        for write, result in zip(chunk, results):
+            self.documents.put_version(write[1].path, result.update_time)
+
+    def chunk_writes(self, writes):
+        """
+        Split groups of writes into chunks of at most the batch size without
+        splitting a group
+
+        :param writes: Groups of buffered writes
+
+        :return: Generator of lists of groups of writes
+        """
+
+        chunk, chunk_size = [], 0
+
+        for group in writes:
+            if chunk and chunk_size + len(group) > self.batch_size:
+                yield chunk
+                chunk, chunk_size = [], 0
+
+            chunk.append(group)
+            chunk_size += len(group)
+
+        if chunk:
+            yield chunk
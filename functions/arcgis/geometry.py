@@ -0,0 +1,163 @@
+import logging
+import math
+from functools import lru_cache
+
+import config
+
+WGS84 = 4326
+WEB_MERCATOR = (3857, 102100)
+EARTH_RADIUS = 6378137.0
+MAX_MERCATOR_LATITUDE = 85.0511287798
+
+
+def parse_coordinate(value):
+    """
+    Convert a coordinate of a record to a float
+
+    :param value: Coordinate as number or string
+
+    :return: Coordinate
+    :rtype: float
+    """
+
+    coordinate = float(value)
+
+    if not math.isfinite(coordinate):
+        raise ValueError(f"Coordinate {value} is not finite")
+
+    return coordinate
+
+
+def parse_longitude(value):
+    """
+    Convert a longitude of a record to a float
+
+    :param value: Longitude as number or string
+
+    :return: Longitude
+    :rtype: float
+    """
+
+    longitude = parse_coordinate(value)
+
+    if not -180 <= longitude <= 180:
+        raise ValueError(f"Longitude {value} is out of range")
+
+    return longitude
+
+
+def parse_latitude(value):
+    """
+    Convert a latitude of a record to a float
+
+    :param value: Latitude as number or string
+
+    :return: Latitude
+    :rtype: float
+    """
+
+    latitude = parse_coordinate(value)
+
+    if not -90 <= latitude <= 90:
+        raise ValueError(f"Latitude {value} is out of range")
+
+    return latitude
+
+
+@lru_cache(maxsize=None)
+def get_output_wkid():
+    """
+    Get the spatial reference in which points are sent to ArcGIS, which is the native
+    spatial reference of the layers when that is projected client-side
+
+    :return: Well-known ID
+    :rtype: int
+    """
+
+    wkid = getattr(config, "ARCGIS_LAYER_WKID", None)
+
+    if wkid is None or wkid == WGS84:
+        return WGS84
+
+    if wkid in WEB_MERCATOR:
+        return wkid
+
+    logging.warning(f"Projecting to wkid {wkid} is not supported, sending WGS84")
+    return WGS84
+
+
+def make_point(x, y):
+    """
+    Get an ArcGIS point geometry of a longitude and latitude
+
+    :param x: Longitude
+    :param y: Latitude
+
+    :return: ArcGIS point geometry
+    :rtype: dict
+    """
+
+    x, y = parse_longitude(x), parse_latitude(y)
+
+    wkid = get_output_wkid()
+    if wkid in WEB_MERCATOR:
+        x, y = project_web_mercator(x, y)
+
+    return {"x": x, "y": y, "spatialReference": {"wkid": wkid}}
+
+
+def project_web_mercator(x, y):
+    """
+    Project a longitude and latitude to Web Mercator
+
+    :param x: Longitude
+    :param y: Latitude
+
+    :return: X, Y in meters
+    :rtype: tuple
+    """
+
+    y = max(-MAX_MERCATOR_LATITUDE, min(MAX_MERCATOR_LATITUDE, y))
+
+    return (
+        EARTH_RADIUS * math.radians(x),
+        EARTH_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(y) / 2)),
+    )
+
+
+def quantize(x, y):
+    """
+    Round a longitude and latitude to the resolution at which locations are compared
+
+    :param x: Longitude
+    :param y: Latitude
+
+    :return: Quantized longitude and latitude, None if a coordinate is invalid
+    :rtype: tuple
+    """
+
+    resolution = getattr(config, "ARCGIS_XY_RESOLUTION", 1e-7)
+
+    try:
+        return (
+            round(parse_coordinate(x) / resolution),
+            round(parse_coordinate(y) / resolution),
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+def has_moved(record, stored):
+    """
+    Check if the location of a record differs from the stored location
+
+    :param record: Record with longitude and latitude
+    :param stored: Stored record with longitude and latitude
+
+    :return: True if the quantized locations differ
+    :rtype: bool
+    """
+
+    return quantize(record.get("longitude"), record.get("latitude")) != quantize(
+        stored.get("longitude"), stored.get("latitude")
+    )
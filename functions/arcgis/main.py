@@ -1,123 +1,1019 @@
+import time
+
+# Wall time at which importing this module started, logged once the import finished
+_import_started = time.perf_counter()
+
+import asyncio
 import base64
 import json
 import logging
-import operator
-from functools import reduce
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import aggregates
+import cache
+import config
+import dedup
+import geometry
+import metrics
+import requests
+import schema
+import secretmanager
+import streaming
+import throttling
+import utils
+from firestore_utils import DocumentCache, WriteBuffer
+
+_db_client = None
+_arcgis_secret = None
+_host_cache = None
+_processed_cache = None
+_event_state_cache = None
+_subscriber_client = None
+_init_lock = threading.Lock()
+
+
+def get_db_client():
+    """
+    Get the Firestore client, creating it on first use
+
+    :return: Firestore client
+    """
+
+    global _db_client
+
+    if _db_client is None:
+        with _init_lock:
+            if _db_client is None:
+                started = time.monotonic()
+
+                from google.cloud import firestore_v1
+
+                _db_client = firestore_v1.Client()
+                logging.info(
+                    f"Initialised Firestore client in {time.monotonic() - started:.3f}s"
+                )
+
+    return _db_client
+
+
+def get_arcgis_secret(refresh=False):
+    """
+    Get the ArcGIS secret, reading it from Secret Manager on first use
+
+    :param refresh: Read the secret again, for example after an authentication failure
+
+    :return: ArcGIS secret
+    """
+
+    global _arcgis_secret
+
+    if _arcgis_secret is None or refresh:
+        with _init_lock:
+            if _arcgis_secret is None or refresh:
+                started = time.monotonic()
+
+                _arcgis_secret = secretmanager.get_secret_token()
+                logging.info(
+                    f"Read ArcGIS secret from Secret Manager in {time.monotonic() - started:.3f}s"
+                )
+
+    return _arcgis_secret
+
+
+def get_subscriber_client():
+    """
+    Get the Pub/Sub subscriber client used by the pull entry point, creating it on
+    first use
+
+    :return: Subscriber client
+    """
+
+    global _subscriber_client
+
+    if _subscriber_client is None:
+        with _init_lock:
+            if _subscriber_client is None:
+                started = time.monotonic()
+
+                from google.cloud import pubsub_v1
+
+                _subscriber_client = pubsub_v1.SubscriberClient()
+                logging.info(
+                    f"Initialised Pub/Sub subscriber client in {time.monotonic() - started:.3f}s"
+                )
+
+    return _subscriber_client
+
+
+def get_host_cache():
+    """
+    Get the cache of host documents kept between messages on a warm instance
+
+    :return: LRU cache of host documents
+    """
+
+    global _host_cache
+
+    if _host_cache is None:
+        with _init_lock:
+            if _host_cache is None:
+                _host_cache = cache.LRUCache(
+                    maxsize=getattr(config, "HOST_CACHE_SIZE", 10000),
+                    ttl=getattr(config, "HOST_CACHE_TTL", 60),
+                    fingerprint=HostProcessor.get_fingerprint,
+                )
+
+    return _host_cache
+
+
+def get_event_state_cache():
+    """
+    Get the index of known event states kept between messages on a warm instance
+
+    :return: LRU cache of event state and timestamp per unique event ID
+    """
+
+    global _event_state_cache
+
+    if _event_state_cache is None:
+        with _init_lock:
+            if _event_state_cache is None:
+                _event_state_cache = cache.LRUCache(
+                    maxsize=getattr(config, "EVENT_STATE_CACHE_SIZE", 100000),
+                    ttl=getattr(config, "EVENT_STATE_CACHE_TTL", 60),
+                )
+
+    return _event_state_cache
+
+
+def get_processed_cache():
+    """
+    Get the cache of work known to be processed, kept between messages on a warm
+    instance
+
+    :return: LRU cache of marker IDs
+    """
+
+    global _processed_cache
+
+    if _processed_cache is None:
+        with _init_lock:
+            if _processed_cache is None:
+                _processed_cache = cache.LRUCache(
+                    maxsize=getattr(config, "DEDUPLICATION_CACHE_SIZE", 100000),
+                    ttl=getattr(config, "DEDUPLICATION_TTL", 7 * 24 * 3600),
+                )
+
+    return _processed_cache
+
+
+def get_deduplicator(documents=None):
+    """
+    Get the deduplicator of redelivered work, if deduplication is enabled
+
+    :param documents: Firestore documents of the message, to read markers in bulk
+
+    :return: Deduplicator or None
+    """
+
+    if not getattr(config, "DEDUPLICATION", False):
+        return None
+
+    return dedup.Deduplicator(get_db_client(), get_processed_cache(), documents)
+
+
+EDIT_RESULT_KEYS = {
+    "adds": "addResults",
+    "updates": "updateResults",
+    "deletes": "deleteResults",
+}
+
+
+class ArcGISProcessor:
+    def __init__(self):
+        self.session = utils.get_http_session()
+        self.arcgis_access_token = self.get_token()
+        self.edit_chunk_size = getattr(config, "ARCGIS_EDIT_CHUNK_SIZE", 500)
+        self.rollback_on_failure = getattr(config, "ARCGIS_ROLLBACK_ON_FAILURE", True)
+        self.rate_limiter = throttling.get_rate_limiter()
+        self.max_retries = getattr(config, "ARCGIS_EDIT_RETRIES", 3)
+        self.retry_budget = getattr(config, "ARCGIS_RETRY_BUDGET", 100)
+        self.pending_edits = {}
+        self.pending_keys = Counter()
+        self.failed_keys = set()
+        self.lock = threading.RLock()
+        self.edits_completed = threading.Condition(self.lock)
+
+    def reset_retry_budget(self):
+        """
+        Allow the configured number of retries again, for the next message or pulled
+        micro-batch processed with this processor
+        """
+
+        with self.lock:
+            self.retry_budget = getattr(config, "ARCGIS_RETRY_BUDGET", 100)
+
+    @staticmethod
+    def get_token(invalid_token=None):
+        """
+        Get the ArcGIS token, reading the secret again when no token can be retrieved
+
+        :param invalid_token: Token rejected by ArcGIS
+
+        :return: ArcGIS token
+        """
+
+        token = utils.get_feature_service_token(get_arcgis_secret(), invalid_token)
+
+        if not token:
+            # The secret may have been rotated since it was read
+            logging.info("Retrieving ArcGIS token failed, reading the secret again")
+            token = utils.get_feature_service_token(
+                get_arcgis_secret(refresh=True), invalid_token
+            )
+
+        return token
+
+    def apply_edits(self, edits, layer, rollback=False):
+        """
+        Apply ArcGIS edits, refreshing the token once when ArcGIS rejects it
+
+        :param edits: ArcGIS edits per function ("adds", "updates" and/or "deletes")
+        :param layer: ArcGIS layer
+        :param rollback: Apply none of the edits if one of them fails
+        """
+
+        response = self.post_edits(edits, layer, rollback)
+
+        if utils.is_invalid_token_response(response):
+            logging.info("ArcGIS token was rejected, requesting a new token")
+            self.arcgis_access_token = self.get_token(
+                invalid_token=self.arcgis_access_token
+            )
+
+            if self.arcgis_access_token:
+                response = self.post_edits(edits, layer, rollback)
+
+        return response
+
+    def post_edits(self, edits, layer, rollback=False):
+        """
+        Post ArcGIS edits to the applyEdits endpoint of a layer
+
+        :param edits: ArcGIS edits per function ("adds", "updates" and/or "deletes")
+        :param layer: ArcGIS layer
+        :param rollback: Apply none of the edits if one of them fails
+        """
+
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+
+        with metrics.timed(
+            "arcgis.apply_edits", edits=sum(len(values) for values in edits.values())
+        ) as sizes:
+            r = utils.post_form(
+                self.session,
+                config.SERVICE_URL + f"/{layer}/applyEdits",
+                self.get_edits_form(edits, rollback),
+            )
+            sizes.update(
+                request_bytes=len(r.request.body), response_bytes=len(r.content)
+            )
+
+        try:
+            response_json = r.json()
+        except json.decoder.JSONDecodeError as e:
+            logging.error(
+                f"An error occurred when applying edits (status-code: {r.status_code}): {str(e)}"
+            )
+            response_json = utils.get_error_response(r.status_code, str(e))
+
+        self.on_response(response_json)
+
+        return response_json
+
+    def query(self, layer, params):
+        """
+        Query the features of a layer, refreshing the token once when ArcGIS rejects it
+
+        :param layer: ArcGIS layer
+        :param params: Query parameters, such as where and outFields
+
+        :return: ArcGIS response
+        """
+
+        response = self.post_query(layer, params)
+
+        if utils.is_invalid_token_response(response):
+            logging.info("ArcGIS token was rejected, requesting a new token")
+            self.arcgis_access_token = self.get_token(
+                invalid_token=self.arcgis_access_token
+            )
+
+            if self.arcgis_access_token:
+                response = self.post_query(layer, params)
+
+        return response
+
+    def post_query(self, layer, params):
+        """
+        Post a query to the query endpoint of a layer
+
+        :param layer: ArcGIS layer
+        :param params: Query parameters, such as where and outFields
+
+        :return: ArcGIS response
+        """
+
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+
+        with metrics.timed("arcgis.query") as sizes:
+            r = utils.post_form(
+                self.session,
+                config.SERVICE_URL + f"/{layer}/query",
+                {**params, "f": "json", "token": self.arcgis_access_token},
+            )
+            sizes["response_bytes"] = len(r.content)
+
+        try:
+            response_json = r.json()
+        except json.decoder.JSONDecodeError as e:
+            logging.error(
+                f"An error occurred when querying features (status-code: {r.status_code}): {str(e)}"
+            )
+            response_json = utils.get_error_response(r.status_code, str(e))
+
+        self.on_response(response_json)
+
+        return response_json
+
+    def on_response(self, response):
+        """
+        Adapt the request rate to whether ArcGIS throttled a request
+
+        :param response: ArcGIS response
+        """
+
+        if not self.rate_limiter:
+            return
+
+        if utils.is_throttled_response(response):
+            logging.warning("ArcGIS throttled applyEdits, lowering the request rate")
+            self.rate_limiter.on_throttled()
+        else:
+            self.rate_limiter.on_success()
+
+    def get_edits_form(self, edits, rollback=False):
+        """
+        Get the form data of an applyEdits request
+
+        :param edits: ArcGIS edits per function ("adds", "updates" and/or "deletes")
+        :param rollback: Apply none of the edits if one of them fails
+
+        :return: Form data
+        """
+
+        data = {
+            function: utils.encode_edits(values) for function, values in edits.items()
+        }
+        data.update(
+            {
+                "f": "json",
+                "token": self.arcgis_access_token,
+                "rollbackOnFailure": json.dumps(rollback),
+            }
+        )
+
+        return data
+
+    @staticmethod
+    def get_feature(x, y, attributes):
+        """
+        Get ArcGIS feature
+
+        :param x: X-coordinate, None for a feature without geometry
+        :param y: Y-coordinate, None for a feature without geometry
+        :param attributes: Feature attributes
+
+        :return: ArcGIS feature
+        """
+
+        if x is None or y is None:
+            # Updates without geometry keep the stored geometry
+            return {"attributes": attributes}
+
+        return {"geometry": geometry.make_point(x, y), "attributes": attributes}
+
+    def add_feature(self, x, y, attributes, layer):
+        """
+        Add ArcGIS Feature
+
+        :param x: X-coordinate
+        :param y: Y-coordinate
+        :param attributes: Feature attributes
+        :param layer: Feature layer
+
+        :return: ArcGIS feature ID
+        """
+
+        adds = [self.get_feature(x, y, attributes)]
+
+        res = self.apply_edits({"adds": adds}, layer)
+
+        if res and "addResults" in res:
+            return res["addResults"][0]
+
+        return res
+
+    def update_feature(self, x, y, attributes, layer):
+        """
+        Update ArcGIS Feature
+
+        :param x: X-coordinate, None to keep the geometry
+        :param y: Y-coordinate, None to keep the geometry
+        :param attributes: Feature attributes
+        :param layer: Feature layer
+
+        :return: ArcGIS feature ID
+        """
+
+        updates = [self.get_feature(x, y, attributes)]
+
+        res = self.apply_edits({"updates": updates}, layer)
+
+        if res and "updateResults" in res:
+            return res["updateResults"][0]
+
+        return res
+
+    def delete_feature(self, object_id, layer):
+        """
+        Delete ArcGIS feature
+
+        :param object_id: Feature ID
+        :param layer: Feature layer
+
+        :return: ArcGIS feature ID
+        """
+
+        data = [object_id]
+
+        res = self.apply_edits({"deletes": data}, layer)
+
+        if res and "deleteResults" in res:
+            return res["deleteResults"][0]
+
+        return res
+
+    def queue_add(self, x, y, attributes, layer, callback=None, key=None):
+        """
+        Queue the addition of an ArcGIS feature until the next flush
+
+        :param x: X-coordinate
+        :param y: Y-coordinate
+        :param attributes: Feature attributes
+        :param layer: Feature layer
+        :param callback: Called with the add result of this feature
+        :param key: Key of the record the edit belongs to
+        """
+
+        feature = self.get_feature(x, y, attributes)
+        self.queue_edit("adds", feature, layer, callback, key)
+
+    def queue_update(self, x, y, attributes, layer, callback=None, key=None):
+        """
+        Queue the update of an ArcGIS feature until the next flush
+
+        :param x: X-coordinate, None to keep the geometry
+        :param y: Y-coordinate, None to keep the geometry
+        :param attributes: Feature attributes
+        :param layer: Feature layer
+        :param callback: Called with the update result of this feature
+        :param key: Key of the record the edit belongs to
+        """
+
+        feature = self.get_feature(x, y, attributes)
+        self.queue_edit("updates", feature, layer, callback, key)
+
+    def queue_delete(self, object_id, layer, callback=None, key=None):
+        """
+        Queue the deletion of an ArcGIS feature until the next flush
+
+        :param object_id: Feature ID
+        :param layer: Feature layer
+        :param callback: Called with the delete result of this feature
+        :param key: Key of the record the edit belongs to
+        """
+
+        self.queue_edit("deletes", object_id, layer, callback, key)
+
+    def queue_replace(
+        self, x, y, update_attributes, add_attributes, layer, callback=None, key=None
+    ):
+        """
+        Queue the update of an ArcGIS feature and the addition of its successor, which
+        are applied together in the same applyEdits request
+
+        :param x: X-coordinate
+        :param y: Y-coordinate
+        :param update_attributes: Attributes of the updated feature
+        :param add_attributes: Attributes of the added feature
+        :param layer: Feature layer
+        :param callback: Called with the update and add results per function
+        :param key: Key of the record the edits belong to
+        """
+
+        # The successor is added at the same location, so the update keeps its geometry
+        edits = {
+            "adds": [self.get_feature(x, y, add_attributes)],
+            "updates": [self.get_feature(None, None, update_attributes)],
+        }
+        self.queue_edits(edits, layer, callback, key)
+
+    def queue_edit(self, function, edit, layer, callback=None, key=None):
+        """
+        Queue an ArcGIS edit until the next flush
+
+        :param function: Function ("adds", "updates" or "deletes")
+        :param edit: ArcGIS edit
+        :param layer: Feature layer
+        :param callback: Called with the result of this edit
+        :param key: Key of the record the edit belongs to
+        """
+
+        if callback:
+            callback = partial(self.call_with_result, function, callback)
+
+        self.queue_edits({function: [edit]}, layer, callback, key)
+
+    def queue_edits(self, edits, layer, callback=None, key=None):
+        """
+        Queue ArcGIS edits that are applied in the same applyEdits request until the
+        next flush
+
+        :param edits: ArcGIS edits per function ("adds", "updates" and/or "deletes")
+        :param layer: Feature layer
+        :param callback: Called with the results of these edits per function
+        :param key: Key of the record the edits belong to
+        """
+
+        with self.lock:
+            self.pending_edits.setdefault(layer, []).append((edits, callback, key))
+
+            if key is not None:
+                self.pending_keys[key] += 1
+
+    @staticmethod
+    def call_with_result(function, callback, results):
+        """
+        Call the callback of a single edit with its result
+
+        :param function: Function of the edit
+        :param callback: Callback of the edit
+        :param results: Results per function
+        """
+
+        callback(results[function][0])
+
+    def take_failed_keys(self):
+        """
+        Get the keys of records with edits that failed for a transient reason since the
+        last call
+
+        :return: Set of keys
+        """
+
+        with self.lock:
+            failed_keys, self.failed_keys = self.failed_keys, set()
+
+        return failed_keys
+
+    def has_pending(self, key):
+        """
+        Check if a record still has queued or unfinished edits
+
+        :param key: Key of the record
+
+        :return: True if edits for this record are not completed yet
+        """
+
+        with self.lock:
+            return self.pending_keys[key] > 0
+
+    def complete_pending(self, key):
+        """
+        Apply the queued edits of a record and wait until all of them are completed
+
+        :param key: Key of the record
+        """
+
+        if not self.has_pending(key):
+            return
+
+        self.flush()
+
+        # Edits of this record may still be applied by a flush in another thread
+        with self.edits_completed:
+            self.edits_completed.wait_for(lambda: self.pending_keys[key] <= 0)
+
+    def flush(self):
+        """
+        Apply all queued edits in chunked applyEdits calls per layer
+
+        Edits queued by callbacks during the flush are applied as well.
+        """
+
+        while True:
+            with self.lock:
+                if not self.pending_edits:
+                    return
+
+                pending_edits, self.pending_edits = self.pending_edits, {}
+
+            for layer, layer_edits in pending_edits.items():
+                for chunk in self.chunk_edits(layer_edits):
+                    self.apply_chunk(chunk, layer)
+
+    def chunk_edits(self, layer_edits):
+        """
+        Split the queued edits of a layer into chunks of at most the edit chunk size,
+        without splitting edits that are queued together
+
+        :param layer_edits: Queued edits
+
+        :return: Generator of lists of queued edits
+        """
+
+        chunk, chunk_size = [], 0
+
+        for entry in layer_edits:
+            size = self.get_size(entry)
+
+            if chunk and chunk_size + size > self.edit_chunk_size:
+                yield chunk
+                chunk, chunk_size = [], 0
+
+            chunk.append(entry)
+            chunk_size += size
+
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def get_size(entry):
+        """
+        Get the number of edits of a queued entry
+
+        :param entry: Queued edits
+
+        :return: Number of edits
+        """
+
+        return sum(len(edits) for edits in entry[0].values())
+
+    @staticmethod
+    def get_chunk_edits(chunk):
+        """
+        Combine the queued edits of a chunk per function
+
+        :param chunk: List of queued edits
+
+        :return: ArcGIS edits per function
+        """
+
+        edits = {}
+        for function in EDIT_RESULT_KEYS:
+            for entry_edits, _, _ in chunk:
+                edits.setdefault(function, []).extend(entry_edits.get(function, []))
+
+        return {function: values for function, values in edits.items() if values}
+
+    def use_rollback(self, chunk):
+        """
+        Check if a chunk is applied with rollback on failure, which is done when it
+        contains edits that are queued together and the service supports it
+
+        :param chunk: List of queued edits
+
+        :return: True if the chunk is applied with rollback on failure
+        """
+
+        return self.rollback_on_failure and any(
+            self.get_size(entry) > 1 for entry in chunk
+        )
+
+    def apply_chunk(self, chunk, layer, attempt=0):
+        """
+        Apply a chunk of queued edits and hand the results to their callbacks,
+        retrying edits that failed for a transient reason
+
+        :param chunk: List of queued edits
+        :param layer: Feature layer
+        :param attempt: Number of times the edits were retried before
+        """
 
-import config
-import requests
-import secretmanager
-import utils
-import zulu
-from google.cloud import firestore_v1
+        rollback = self.use_rollback(chunk)
+        unprepared = False
+
+        try:
+            response = self.apply_edits(self.get_chunk_edits(chunk), layer, rollback)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"An error occurred when applying edits: {str(e)}")
+            response = utils.get_error_response(
+                None, str(e), sent=not utils.is_connect_error(e)
+            )
+        except Exception as e:
+            if len(chunk) == 1:
+                # Completed with an error, so its record does not wait for it forever
+                logging.exception(f"An error occurred when preparing edits: {str(e)}")
+            response = utils.get_error_response(400, str(e))
+            unprepared = True
+
+        if unprepared and len(chunk) > 1:
+            # Such as an edit that cannot be encoded, which is isolated by halving
+            for half in self.halve(chunk):
+                self.apply_chunk(half, layer, attempt)
+            return
 
-db_client = firestore_v1.Client()
-arcgis_secret = secretmanager.get_secret_token()
+        if rollback and len(chunk) > 1 and self.is_rolled_back(response):
+            # A single failing edit rolled back the whole chunk
+            for retry_chunk in self.split_rolled_back(chunk):
+                self.apply_chunk(retry_chunk, layer, attempt)
+            return
 
+        retries = self.complete_chunk(chunk, response, attempt)
 
-class ArcGISProcessor:
-    def __init__(self):
-        self.arcgis_access_token = utils.get_feature_service_token(arcgis_secret)
+        if retries:
+            delay = throttling.get_backoff_delay(attempt + 1)
+            logging.warning(f"Retrying {len(retries)} failed edits in {delay:.1f}s")
+            metrics.record("arcgis.retry_backoff", delay, edits=len(retries))
 
-    def apply_edits(self, function, data, layer):
+            time.sleep(delay)
+            self.apply_chunk(retries, layer, attempt + 1)
+
+    @staticmethod
+    def is_rolled_back(response):
         """
-        Apply ArcGIS edits
+        Check if ArcGIS rolled back the edits of a request because one of them failed
 
-        :param function: Function
-        :param data: ArcGIS data
-        :param layer: ArcGIS layer
+        :param response: ArcGIS response
+
+        :return: True if the request returned edit results of which some failed
         """
 
-        data = {function: str(data), "f": "json", "token": self.arcgis_access_token}
+        return (
+            isinstance(response, dict)
+            and "error" not in response
+            and not utils.is_edits_response_success(response)
+        )
 
-        r = requests.post(config.SERVICE_URL + f"/{layer}/applyEdits", data=data)
+    def split_rolled_back(self, chunk):
+        """
+        Split a rolled back chunk, so the other edits are applied together without
+        rollback and the edits queued together are bisected until the failing ones
+        are applied on their own
 
-        try:
-            response_json = r.json()
-        except json.decoder.JSONDecodeError as e:
-            logging.error(
-                f"An error occurred when applying edits (status-code: {r.status_code}): {str(e)}"
-            )
-            return str(e)
-        else:
-            return response_json
+        :param chunk: List of queued edits
 
-    def add_feature(self, x, y, attributes, layer):
+        :return: List of chunks
         """
-        Add ArcGIS Feature
 
-        :param x: X-coordinate
-        :param y: Y-coordinate
-        :param attributes: Feature attributes
-        :param layer: Feature layer
+        singles = [entry for entry in chunk if self.get_size(entry) == 1]
+        groups = [entry for entry in chunk if self.get_size(entry) > 1]
 
-        :return: ArcGIS feature ID
+        chunks = self.halve(groups) if len(groups) > 1 else [groups]
+
+        return [chunk for chunk in chunks + [singles] if chunk]
+
+    @staticmethod
+    def halve(chunk):
         """
+        Split a chunk into two halves
 
-        adds = [
-            {
-                "geometry": {
-                    "x": float(x),
-                    "y": float(y),
-                    "spatalReference": {"wkid": 4326},
-                },
-                "attributes": attributes,
-            }
-        ]
+        :param chunk: List of queued edits
 
-        res = self.apply_edits("adds", adds, layer)
+        :return: List of chunks
+        """
 
-        if res and "addResults" in res:
-            return res["addResults"][0]
+        middle = len(chunk) // 2
 
-        return res
+        return [chunk[:middle], chunk[middle:]]
 
-    def update_feature(self, x, y, attributes, layer):
+    def complete_chunk(self, chunk, response, attempt=None):
         """
-        Update ArcGIS Feature
+        Hand the results of an applyEdits response to the callbacks of a chunk
 
-        :param x: X-coordinate
-        :param y: Y-coordinate
-        :param attributes: Feature attributes
-        :param layer: Feature layer
+        :param chunk: List of queued edits
+        :param response: ArcGIS response
+        :param attempt: Number of times the edits were retried before, None to
+            complete all edits without retrying
 
-        :return: ArcGIS feature ID
+        :return: List of queued edits to retry
         """
 
-        updates = [
-            {"geometry": {"x": float(x), "y": float(y)}, "attributes": attributes}
-        ]
+        retries = []
 
-        res = self.apply_edits("updates", updates, layer)
+        for entry, results in zip(chunk, self.get_results(chunk, response)):
+            if attempt is not None and self.should_retry(results, attempt):
+                retries.append(entry)
+            else:
+                self.complete_edit(results, entry[1], entry[2])
 
-        if res and "updateResults" in res:
-            return res["updateResults"][0]
+        return retries
 
-        return res
+    @staticmethod
+    def get_results(chunk, response):
+        """
+        Get the results per function of each queued edit of a chunk
 
-    def delete_feature(self, object_id, layer):
+        :param chunk: List of queued edits
+        :param response: ArcGIS response
+
+        :return: Generator of results per function
         """
-        Delete ArcGIS feature
 
-        :param object_id: Feature ID
-        :param layer: Feature layer
+        offsets = dict.fromkeys(EDIT_RESULT_KEYS, 0)
 
-        :return: ArcGIS feature ID
+        for entry_edits, _, _ in chunk:
+            results = {}
+
+            for function in EDIT_RESULT_KEYS:
+                if function not in entry_edits:
+                    continue
+
+                function_results = None
+                if isinstance(response, dict):
+                    function_results = response.get(EDIT_RESULT_KEYS[function])
+
+                results[function] = []
+                for index in range(
+                    offsets[function], offsets[function] + len(entry_edits[function])
+                ):
+                    # Results are returned in the same order as the submitted edits
+                    if function_results and index < len(function_results):
+                        results[function].append(function_results[index])
+                    else:
+                        results[function].append(response)
+
+                offsets[function] += len(entry_edits[function])
+
+            yield results
+
+    def should_retry(self, results, attempt):
         """
+        Check if queued edits are retried, which is done when all of them failed for a
+        transient reason and the retry budget is not used up
 
-        data = [object_id]
+        :param results: ArcGIS results per function of the queued edits
+        :param attempt: Number of times the edits were retried before
 
-        res = self.apply_edits("deletes", data, layer)
+        :return: True if the edits are retried
+        """
 
-        if res and "deleteResults" in res:
-            return res["deleteResults"][0]
+        if attempt >= self.max_retries:
+            return False
 
-        return res
+        adds = bool(results.get("adds"))
+        results = [
+            result
+            for function_results in results.values()
+            for result in function_results
+        ]
+
+        # Edits queued together are only retried when none of them was applied or
+        # failed permanently, edits rolled back because of another one are retried too
+        if not any(
+            utils.is_retryable_result(result, adds) for result in results
+        ) or not all(
+            utils.is_retryable_result(result, adds)
+            or utils.is_rolled_back_result(result)
+            for result in results
+        ):
+            return False
+
+        with self.lock:
+            if self.retry_budget <= 0:
+                logging.warning("Retry budget of applyEdits is used up")
+                return False
+
+            self.retry_budget -= 1
+
+        return True
+
+    def complete_edit(self, result, callback, key):
+        """
+        Hand the results of queued edits to their callback
+
+        :param result: ArcGIS edit results per function
+        :param callback: Callback of the edits
+        :param key: Key of the record the edits belong to
+        """
+
+        try:
+            if callback:
+                callback(result)
+        except Exception as e:
+            logging.exception(f"Error when processing edit result for '{key}': {e}")
+        finally:
+            if key is not None:
+                with self.edits_completed:
+                    if any(
+                        utils.is_retryable_result(
+                            function_result, bool(result.get("adds"))
+                        )
+                        for function_results in result.values()
+                        for function_result in function_results
+                    ):
+                        self.failed_keys.add(key)
+
+                    self.pending_keys[key] -= 1
+                    if self.pending_keys[key] <= 0:
+                        del self.pending_keys[key]
+                        self.edits_completed.notify_all()
 
 
 class HostProcessor:
-    def __init__(self, arcgis_processor):
+    COMPARED_KEYS = [
+        "hostgroups",
+        "bssglobalcoverage",
+        "bsshwfamily",
+        "bsslifecyclestatus",
+    ]
+
+    SCHEMA = schema.Schema(
+        "host",
+        [
+            schema.Field("id"),
+            schema.Field("sitename"),
+            schema.Field("hostname"),
+            schema.Field("decommissioned"),
+            schema.Field("hostgroups", "host_groups"),
+            schema.Field(
+                "bssglobalcoverage",
+                "bss_global_coverage/realvalue",
+                "bss_global_coverage/value",
+            ),
+            schema.Field(
+                "bsshwfamily", "bss_hw_family/realvalue", "bss_hw_family/value"
+            ),
+            schema.Field(
+                "bsslifecyclestatus",
+                "bss_lifecycle_status/realvalue",
+                "bss_lifecycle_status/value",
+            ),
+            schema.Field("status", value=0),  # OK
+            schema.Field("giskleur", value=0),  # GREEN
+            schema.Field("type", value="HOST"),
+            schema.Field("event_output", value="Initial display - NS-TCC-GIS"),
+            schema.Field("starttime", "timestamp", converter=utils.parse_timestamp),
+            schema.Field(
+                "longitude",
+                "longitude/value",
+                converter=geometry.parse_longitude,
+                nullable=False,
+            ),
+            schema.Field(
+                "latitude",
+                "latitude/value",
+                converter=geometry.parse_latitude,
+                nullable=False,
+            ),
+        ],
+    )
+
+    def __init__(self, arcgis_processor, documents, writes):
         self.arcgis_processor = arcgis_processor
+        self.documents = documents
+        self.writes = writes
+        self.report = schema.ValidationReport("host")
+
+    def prefetch(self, hosts):
+        """
+        Read the Firestore documents of all hosts in bulk
+
+        :param hosts: List of host data
+        """
+
+        self.documents.prefetch(
+            get_db_client().collection("hosts").document(host["id"])
+            for host in hosts
+            if isinstance(host, dict) and "id" in host
+        )
+
+    def process_all(self, hosts):
+        """
+        Process hosts in order
+
+        :param hosts: List of host data
+        """
+
+        for host in hosts:
+            self.process(host)
 
     def process(self, host):
         """
@@ -127,34 +1023,51 @@ class HostProcessor:
         """
 
         try:
-            # Check if host is already posted on ArcGIS
-            host_ref = db_client.collection("hosts").document(host["id"])
-            host_doc = host_ref.get()
+            # Make sure earlier edits for this host are applied before reading it
+            self.arcgis_processor.complete_pending(host["id"])
 
-            host_formatted = self.get_host_object(host)  # Get formatted host object
-
-            if not host_formatted:
-                return
-
-            if not host_doc.exists:
-                self.add_new_host(host_formatted, host_ref)
-            else:
-                self.update_existing_host(host_formatted, host_doc, host_ref)
+            self.handle(host)
         except Exception as e:
             logging.exception(f"Error when processing host '{host['id']}': {e}")
 
-    def update_existing_host(self, host, host_doc, host_ref):
+    def handle(self, host):
+        """
+        Handle host data of which all earlier edits are completed
+
+        :param host: Host data
+        """
+
+        host_ref = get_db_client().collection("hosts").document(host["id"])
+        host_formatted = self.get_host_object(host)  # Get formatted host object
+
+        if not host_formatted:
+            return
+
+        # Unchanged hosts are recognised from the cached fingerprint without a read
+        if not host_formatted["decommissioned"] and self.documents.get_fingerprint(
+            host_ref
+        ) == self.get_fingerprint(host_formatted):
+            logging.info(f"Host with id {host['id']} was already added")
+            return
+
+        # Check if host is already posted on ArcGIS
+        host_info = self.documents.get(host_ref)
+
+        if host_info is None:
+            self.add_new_host(host_formatted, host_ref)
+        else:
+            self.update_existing_host(host_formatted, host_info, host_ref)
+
+    def update_existing_host(self, host, host_info, host_ref):
         """
         Check and update existing host
 
         :param host: Host data
-        :param host_doc: Host Firestore document
+        :param host_info: Host information
         :param host_ref: Host Firestore reference
         """
 
         # Document exists so check if info from document and host data is the same
-        host_info = host_doc.to_dict()
-
         # Check if host is decommissioned and then update
         if host["decommissioned"]:
             self.update_existing_decommissioned_host(host, host_info, host_ref)
@@ -170,17 +1083,13 @@ class HostProcessor:
         :param host_ref: Host Firestore reference
         """
 
-        keys = [
-            "hostgroups",
-            "bssglobalcoverage",
-            "bsshwfamily",
-            "bsslifecyclestatus",
-        ]
+        keys = self.COMPARED_KEYS
 
         doc_info_parsed = {k: host_info[k] for k in keys}
         host_parsed = {k: host[k] for k in keys}
+        moved = geometry.has_moved(host, host_info)
 
-        if doc_info_parsed == host_parsed:
+        if doc_info_parsed == host_parsed and not moved:
             logging.info(f"Host with id {host['id']} was already added")
             return
 
@@ -190,24 +1099,53 @@ class HostProcessor:
             if host_info[key] != host[key]:
                 attributes[key] = host[key]
 
-        host_ref.update(attributes)
+        # Only the changed attributes are sent
+        arcgis_updates = {"objectid": host_info["objectId"], **attributes}
 
-        arcgis_updates = {
-            "objectid": host_info["objectId"],
-            "hostgroups": host["hostgroups"],
-            "bssglobalcoverage": host["bssglobalcoverage"],
-            "bsshwfamily": host["bsshwfamily"],
-            "bsslifecyclestatus": host["bsslifecyclestatus"],
-        }
+        # Geometry is only sent when the host moved
+        x, y = None, None
+        if moved:
+            x, y = host["longitude"], host["latitude"]
+            attributes.update(longitude=x, latitude=y)
 
-        response = self.arcgis_processor.update_feature(
-            host_info["longitude"],
-            host_info["latitude"],
+        self.writes.update(host_ref, attributes)
+
+        self.arcgis_processor.queue_update(
+            x,
+            y,
             arcgis_updates,
             config.LAYER["hosts"],
+            callback=partial(self.on_active_host_updated, host_info),
+            key=host["id"],
+        )
+
+    @classmethod
+    def get_fingerprint(cls, host):
+        """
+        Get the fingerprint of the fields and location that are compared to detect
+        host changes
+
+        :param host: Host data or host information
+
+        :return: Fingerprint
+        """
+
+        return json.dumps(
+            [host.get(key) for key in cls.COMPARED_KEYS]
+            + [geometry.quantize(host.get("longitude"), host.get("latitude"))],
+            default=str,
         )
 
-        if "success" in response:
+    @staticmethod
+    def on_active_host_updated(host_info, response):
+        """
+        Handle the ArcGIS result of updating an active host
+
+        :param host_info: Host information
+        :param response: ArcGIS update result
+        """
+
+        if utils.is_edit_success(response):
             logging.info(
                 f"Successfully updated feature with objectId: {host_info['objectId']}"
             )
@@ -223,200 +1161,510 @@ class HostProcessor:
         :param host_ref: Host Firestore reference
         """
 
-        host_ref.set({"endtime": host["timestamp"]}, merge=True)
+        # The formatted host carries its converted timestamp as starttime
+        self.writes.set(host_ref, {"endtime": host["starttime"]}, merge=True)
         arcgis_updates = {
             "objectid": host_info["objectId"],
-            "endtime": zulu.parse(host["timestamp"]).timestamp() * 1000,
+            "endtime": host["starttime"],
         }
 
-        response = self.arcgis_processor.update_feature(
-            host_info["longitude"],
-            host_info["latitude"],
+        self.arcgis_processor.queue_update(
+            None,
+            None,
             arcgis_updates,
             config.LAYER["hosts"],
+            callback=partial(self.on_decommissioned_host_updated, host),
+            key=host["id"],
         )
 
-        if "success" in response:
+    @staticmethod
+    def on_decommissioned_host_updated(host, response):
+        """
+        Handle the ArcGIS result of updating a decommissioned host
+
+        :param host: Host data
+        :param response: ArcGIS update result
+        """
+
+        if utils.is_edit_success(response):
             logging.info(f"Successfully updated decommissioned host: {host['id']}")
         else:
             logging.error(
                 f"Failed updating decommissioned host: {json.dumps(response)}"
             )
 
-    def add_new_host(self, host, host_ref):
-        """
-        Add new host to ArcGIS and Firestore
+    def add_new_host(self, host, host_ref):
+        """
+        Add new host to ArcGIS and Firestore
+
+        :param host: Host data
+        :param host_ref: Host Firestore reference
+        """
+
+        self.arcgis_processor.queue_add(
+            host["longitude"],
+            host["latitude"],
+            host,
+            config.LAYER["hosts"],
+            callback=partial(self.on_new_host_added, host, host_ref),
+            key=host["id"],
+        )
+
+    def on_new_host_added(self, host, host_ref, response):
+        """
+        Handle the ArcGIS result of adding a new host
+
+        :param host: Host data
+        :param host_ref: Host Firestore reference
+        :param response: ArcGIS add result
+        """
+
+        if utils.is_edit_success(response):
+            logging.info(
+                f"Successfully added '{host['id']}' as feature with objectId: {response['objectId']}"
+            )
+
+            host["objectId"] = response["objectId"]
+            self.writes.set(host_ref, host)
+        else:
+            logging.error(f"Error while adding new host: {json.dumps(response)}")
+
+    def get_host_object(self, host):
+        """
+        Get host object
+
+        :param host: Host data
+
+        :return: Host data or None if the host data is invalid
+        """
+
+        return self.SCHEMA.extract(host, self.report)
+
+
+class EventProcessor:
+    SCHEMA = schema.Schema(
+        "event",
+        [
+            schema.Field("id"),
+            schema.Field("sitename"),
+            schema.Field("type"),
+            schema.Field("hostname"),
+            schema.Field("servicedescription", "service_description"),
+            schema.Field("statetype", "state_type"),
+            schema.Field("output"),
+            schema.Field("longoutput", "long_output"),
+            schema.Field("eventstate", "event_state"),
+            schema.Field("timestamp", converter=utils.parse_timestamp),
+        ],
+    )
+
+    def __init__(self, arcgis_processor, documents, writes, event_states=None):
+        self.arcgis_processor = arcgis_processor
+        self.documents = documents
+        self.writes = writes
+        self.report = schema.ValidationReport("event")
+        self.event_states = event_states
+        self.applied_states = {}
+
+    def skip_unchanged(self, events):
+        """
+        Remove events that repeat the known state of their event
+
+        An event is only skipped when it is not older than the known state and the
+        aggregate of its host was not written since the state became known, which is
+        checked by reading only the update times of the aggregates. Events written by
+        other instances change the aggregate, so those events are processed. Only the
+        first record of an event in the batch is compared with the known state, as the
+        records before it in the batch may change that state.
+
+        :param events: List of event data
+
+        :return: List of event data that may change an event state
+        """
+
+        if self.event_states is None:
+            return events
+
+        with metrics.timed("event_states", events=len(events)) as sizes:
+            known_versions = {}
+            seen = set()
+            for index, event in enumerate(events):
+                known = self.get_known_version(event, seen)
+                if known is not None:
+                    known_versions[index] = known
+
+            versions = {}
+            if known_versions:
+                versions = self.documents.read_versions(
+                    (ref for ref, _ in known_versions.values()),
+                    field_paths=["host_state"],
+                )
+
+            changed = []
+            for index, event in enumerate(events):
+                known = known_versions.get(index)
+                if known is None or versions.get(known[0].path) != known[1]:
+                    changed.append(event)
+
+            sizes["skipped"] = len(events) - len(changed)
+
+        return changed
+
+    def get_known_version(self, event, seen):
+        """
+        Get the version of the host aggregate at which an event repeats the known
+        state of its event
+
+        :param event: Event data
+        :param seen: Unique IDs of the events of earlier records in the batch, which
+            the unique ID of this event is added to
+
+        :return: Host aggregate reference and update time, None if the state of the
+            event is not known, differs or is newer
+        """
+
+        try:
+            unique_id_event, _ = self.make_unique_identifier(event)
+            if unique_id_event in seen:
+                return None
+
+            seen.add(unique_id_event)
+            known = self.event_states.get(unique_id_event)
+
+            if known is None:
+                return None
+
+            state, timestamp, version = known
+            if (
+                event["event_state"] != state
+                or utils.parse_timestamp(event["timestamp"]) < timestamp
+            ):
+                return None
+
+            host_ref, _ = self.get_references(event)
+
+            return self.get_aggregate_reference(host_ref), version
+        except Exception:
+            return None  # Invalid events are logged by the processor
+
+    def store_event_states(self, failed_keys):
+        """
+        Keep the states of applied events in the event state index, once their writes
+        are committed and the host status is published, together with the update time
+        of the host aggregate at that moment
+
+        :param failed_keys: Keys of hosts of which edits or writes failed
+        """
+
+        if self.event_states is None:
+            return
+
+        applied_states, self.applied_states = self.applied_states, {}
+
+        for unique_id_event, (host_ref, state) in applied_states.items():
+            version = self.documents.get_version(
+                self.get_aggregate_reference(host_ref).path
+            )
+
+            if host_ref.id in failed_keys or version is None:
+                self.event_states.pop(unique_id_event)
+            else:
+                self.event_states.put(unique_id_event, (*state, version))
+
+    def take_conflicted(self, events):
+        """
+        Get the events of hosts of which writes conflicted with a concurrent change,
+        forgetting their cached documents so they are read again
+
+        :param events: List of event data
+
+        :return: List of event data to process again
+        """
+
+        conflicted_paths = set(self.writes.conflicted_paths)
+        if not conflicted_paths:
+            return []
+
+        event_paths = []
+        for event in events:
+            try:
+                host_ref, event_ref = self.get_references(event)
+            except (TypeError, KeyError):
+                continue
+
+            aggregate_ref = self.get_aggregate_reference(host_ref)
+            event_paths.append(
+                (
+                    event,
+                    host_ref.path,
+                    [host_ref.path, event_ref.path, aggregate_ref.path],
+                )
+            )
+
+        # All events of a host are applied again, as they share its aggregate
+        conflicted_hosts = {
+            host_path
+            for _, host_path, paths in event_paths
+            if conflicted_paths.intersection(paths)
+        }
+        conflicted = [
+            (event, paths)
+            for event, host_path, paths in event_paths
+            if host_path in conflicted_hosts
+        ]
+
+        self.documents.forget([path for _, paths in conflicted for path in paths])
+
+        return [event for event, _ in conflicted]
+
+    def prefetch(self, events):
+        """
+        Read the Firestore host and event documents of all events in bulk
+
+        :param events: List of event data
+        """
+
+        refs = []
+        for event in events:
+            try:
+                host_ref, event_ref = self.get_references(event)
+                refs.extend(
+                    [host_ref, event_ref, self.get_aggregate_reference(host_ref)]
+                )
+            except (TypeError, KeyError):
+                continue
+
+        self.documents.prefetch(refs)
+
+    def process_all(self, events):
+        """
+        Process events in order
+
+        :param events: List of event data
+        """
+
+        for event in events:
+            self.process(event)
+
+    def process(self, event):
+        """
+        Process each event data
+
+        :param event: Event data
+        """
+
+        try:
+            _, unique_id_host = self.make_unique_identifier(event)
+
+            # Make sure earlier edits for this host are applied before reading it
+            self.arcgis_processor.complete_pending(unique_id_host)
+
+            self.handle(event)
+        except Exception as e:
+            logging.exception(f"Error when processing event: {event['id']}: {e}")
 
-        :param host: Host data
-        :param host_ref: Host Firestore reference
+    def handle(self, event):
         """
+        Handle event data of which all earlier edits of the host are completed
 
-        response = self.arcgis_processor.add_feature(
-            host["longitude"], host["latitude"], host, config.LAYER["hosts"]
-        )
+        :param event: Event data
+        """
 
-        if "success" in response:
-            logging.info(
-                f"Successfully added '{host['id']}' as feature with objectId: {response['objectId']}"
-            )
+        applied = self.apply_event(event)
 
-            host["objectId"] = response["objectId"]
-            host_ref.set(host)
-        else:
-            logging.error(f"Error while adding new host: {json.dumps(response)}")
+        if applied:
+            self.publish_host_status(event, *applied)
 
-    def get_host_object(self, host):
+    def process_coalesced(self, events):
         """
-        Get host object
+        Process events grouped per host, publishing the host status once per host
 
-        :param host: Host data
+        All event states of a host are written first, after which the host status is
+        computed from the final host aggregate and published once with the event with
+        the latest timestamp.
 
-        :return: Host data
+        :param events: List of event data
         """
-        try:
-            bssglobalcoverage, bsshwfamily, bsslifecyclestatus = self.get_bss_variables(
-                host
-            )
-            start_time = zulu.parse(host["timestamp"]).timestamp() * 1000
-
-            host = {
-                "id": host["id"],
-                "sitename": host["sitename"],
-                "hostname": host["hostname"],
-                "decommissioned": host["decommissioned"],
-                "hostgroups": host["host_groups"],
-                "bssglobalcoverage": bssglobalcoverage,
-                "bsshwfamily": bsshwfamily,
-                "bsslifecyclestatus": bsslifecyclestatus,
-                "status": 0,  # OK
-                "giskleur": 0,  # GREEN
-                "type": "HOST",
-                "event_output": "Initial display - NS-TCC-GIS",
-                "starttime": start_time,
-                "longitude": get_from_dict(host, ["longitude", "value"]),
-                "latitude": get_from_dict(host, ["latitude", "value"]),
-            }
 
-            if host["longitude"] is None or host["latitude"] is None:
-                raise ValueError("Longitude and/or latitude is missing")
+        for unique_id_host, host_events in self.group_by_host(events).items():
+            self.arcgis_processor.complete_pending(unique_id_host)
+            self.handle_coalesced(host_events)
 
-        except (TypeError, ValueError, KeyError) as e:
-            logging.info(f"Invalid host feature data for host: {host}: {str(e)}")
-            return None
-        else:
-            return host
+    def group_by_host(self, events):
+        """
+        Group events by host, keeping their order
 
-    @staticmethod
-    def get_bss_variables(host):
+        :param events: List of event data
+
+        :return: Lists of event data per unique host ID
         """
-        Get BSS variables from host data
 
-        :param host: Host data
+        events_per_host = {}
+        for event in events:
+            try:
+                _, unique_id_host = self.make_unique_identifier(event)
+            except (TypeError, KeyError) as e:
+                logging.exception(f"Error when processing event: {event}: {e}")
+                continue
+
+            events_per_host.setdefault(unique_id_host, []).append(event)
 
-        :return: BSS global coverage, BSS HW family, BSS life cycle status
+        return events_per_host
+
+    def handle_coalesced(self, host_events):
         """
+        Handle the events of one host of which all earlier edits are completed
 
-        for field in ["bss_global_coverage/realvalue", "bss_global_coverage/value"]:
-            bssglobalcoverage = get_from_dict(host, field.split("/"))
-            if bssglobalcoverage:
-                break
+        :param host_events: List of event data of a single host
+        """
 
-        for field in ["bss_hw_family/realvalue", "bss_hw_family/value"]:
-            bsshwfamily = get_from_dict(host, field.split("/"))
-            if bsshwfamily:
-                break
+        latest = None
 
-        for field in ["bss_lifecycle_status/realvalue", "bss_lifecycle_status/value"]:
-            bsslifecyclestatus = get_from_dict(host, field.split("/"))
-            if bsslifecyclestatus:
-                break
+        for event in host_events:
+            try:
+                applied = self.apply_event(event)
+            except Exception as e:
+                logging.exception(f"Error when processing event: {event['id']}: {e}")
+                continue
 
-        return bssglobalcoverage, bsshwfamily, bsslifecyclestatus
+            # Attributes are the last item, their timestamp is already converted
+            if applied and (
+                latest is None or applied[-1]["timestamp"] >= latest[1][-1]["timestamp"]
+            ):
+                latest = (event, applied)
 
+        if latest is None:
+            return
 
-class EventProcessor:
-    def __init__(self, arcgis_processor):
-        self.arcgis_processor = arcgis_processor
+        # The aggregate of an event is a snapshot taken when it was applied, events
+        # after it in the list may be older but are part of the final aggregate
+        event, (host_ref, unique_id_event, _, attributes) = latest
+        try:
+            aggregate = self.documents.get(self.get_aggregate_reference(host_ref))
+            self.publish_host_status(
+                event, host_ref, unique_id_event, aggregate, attributes
+            )
+        except Exception as e:
+            logging.exception(f"Error when processing event: {event['id']}: {e}")
 
-    def process(self, event):
+    def apply_event(self, event):
         """
-        Process each event data
+        Write the state of an event to Firestore
 
         :param event: Event data
+
+        :return: Host reference, Unique ID event, Host aggregate, Event attributes
+            or None if the event cannot be applied
         """
 
-        try:
-            unique_id_event, unique_id_host = self.make_unique_identifier(event)
+        unique_id_event, unique_id_host = self.make_unique_identifier(event)
+
+        host_ref, event_ref = self.get_references(event)
+        host_info = self.documents.get(host_ref)
+        event_info = self.documents.get(event_ref)
 
-            host_ref = db_client.collection("hosts").document(unique_id_host)
-            host_doc = host_ref.get()
+        # Check if host exists
+        if host_info is None:
+            logging.info(
+                f"Trying to update host feature but no host info found with id: {unique_id_host}"
+            )
+            return None
+
+        attributes = self.get_attributes(event)
+        if not attributes:
+            return None
 
-            event_ref = db_client.collection("events").document(
-                unique_id_event.replace("/", "")
+        # Check if event exists and update firestore together with the host aggregate,
+        # which fails if another instance changed the event since it was read
+        with self.writes.atomic():
+            if event_info is not None:
+                if event["event_state"] != event_info["eventstate"]:
+                    self.writes.update(
+                        event_ref,
+                        attributes,
+                        last_update_time=self.documents.get_version(event_ref.path),
+                    )
+
+            if event_info is None:
+                self.writes.create(event_ref, attributes)
+
+            aggregate = self.update_host_aggregate(
+                event, host_ref, event_info, attributes
             )
-            event_doc = event_ref.get()
 
-            # Check if host exists
-            if not host_doc.exists:
-                logging.info(
-                    f"Trying to update host feature but no host info found with id: {unique_id_host}"
-                )
-                return
+        self.applied_states[unique_id_event] = (
+            host_ref,
+            (attributes["eventstate"], attributes["timestamp"]),
+        )
 
-            host_info = host_doc.to_dict()
+        return host_ref, unique_id_event, aggregate, attributes
 
-            attributes = self.get_attributes(event)
-            if not attributes:
-                return
+    def publish_host_status(
+        self, event, host_ref, unique_id_event, aggregate, attributes
+    ):
+        """
+        Publish the current host status to ArcGIS if it changed
 
-            # Check if event exists and update firestore
-            if event_doc.exists:
-                if event["event_state"] != event_doc.to_dict()["eventstate"]:
-                    event_ref.update(attributes)
+        :param event: Event data
+        :param host_ref: Host reference
+        :param unique_id_event: Unique ID event
+        :param aggregate: Host aggregate
+        :param attributes: Event attributes
+        """
 
-            if not event_doc.exists:
-                event_ref.set(attributes)
+        # Status transitions are decided on the current host, as the host may have been
+        # replaced by another instance since it was cached
+        host_info = self.documents.get_fresh(host_ref)
 
-            # Get current "worst" states from all events of host
+        # Get current "worst" states from all events of host
+        with metrics.timed("aggregates.get_worst_states"):
             (
                 event_status,
                 host_event_output,
                 host_status,
                 service_event_output,
-            ) = self.get_worst_states_of_host(event)
-
-            # Decide priority here...
-            if host_status == 1 or host_status == 2 or event_status == 0:
-                status = host_status
-                event_type = "HOST"
-                output = host_event_output
-            else:  # Service state is the most critical state
-                status = event_status
-                event_type = "SERVICE"
-                output = service_event_output
-
-            if host_info["status"] != status or host_info["type"] != event_type:
-                self.update_host_status(
-                    event,
-                    event_type,
-                    host_info,
-                    host_ref,
-                    output,
-                    status,
-                    unique_id_event,
-                )
-            else:
-                logging.info(
-                    f"Received event but host feature not updated. No new status for event: {unique_id_event}"
-                )
-        except Exception as e:
-            logging.exception(f"Error when processing event: {event['id']}: {e}")
+            ) = aggregates.get_worst_states(aggregate)
+
+        # Decide priority here...
+        if host_status == 1 or host_status == 2 or event_status == 0:
+            status = host_status
+            event_type = "HOST"
+            output = host_event_output
+        else:  # Service state is the most critical state
+            status = event_status
+            event_type = "SERVICE"
+            output = service_event_output
+
+        if host_info["status"] != status or host_info["type"] != event_type:
+            self.update_host_status(
+                event,
+                event_type,
+                host_info,
+                host_ref,
+                output,
+                status,
+                unique_id_event,
+                attributes["timestamp"],
+            )
+        else:
+            logging.info(
+                f"Received event but host feature not updated. No new status for event: {unique_id_event}"
+            )
 
     def update_host_status(
-        self, event, event_type, host_info, host_ref, output, status, unique_id_event
+        self,
+        event,
+        event_type,
+        host_info,
+        host_ref,
+        output,
+        status,
+        unique_id_event,
+        timestamp,
     ):
         """
-        Update host to new status
+        Update host to new status by closing the old host feature and adding a new
+        host feature in the same applyEdits request
 
         :param event: Event data
         :param event_type: Event type
@@ -425,137 +1673,174 @@ class EventProcessor:
         :param output: Output
         :param status: Status
         :param unique_id_event: Unique ID event
+        :param timestamp: Event timestamp in milliseconds since epoch
         """
 
-        # Update old host feature
+        # Close old host feature
         arcgis_updates = {
             "objectid": host_info["objectId"],
-            "endtime": zulu.parse(event["timestamp"]).timestamp() * 1000,
+            "endtime": timestamp,
+        }
+
+        gis_kleur = (
+            status if event_type == "HOST" else (status + 9)
+        )  # For colouring in GIS
+
+        # Add new host feature
+        attributes = {
+            "sitename": event["sitename"],
+            "hostname": event["hostname"],
+            "hostgroups": host_info["hostgroups"],
+            "bssglobalcoverage": host_info["bssglobalcoverage"],
+            "bsshwfamily": host_info["bsshwfamily"],
+            "bsslifecyclestatus": host_info["bsslifecyclestatus"],
+            "giskleur": gis_kleur,
+            "status": status,
+            "type": event_type,
+            "event_output": output,
+            "starttime": timestamp,
         }
-        response = self.arcgis_processor.update_feature(
+
+        self.arcgis_processor.queue_replace(
             host_info["longitude"],
             host_info["latitude"],
             arcgis_updates,
+            attributes,
             config.LAYER["hosts"],
+            callback=partial(
+                self.on_host_feature_replaced,
+                event_type,
+                host_ref,
+                output,
+                status,
+                unique_id_event,
+                timestamp,
+            ),
+            key=host_ref.id,
         )
 
-        if "success" in response:
-            gis_kleur = (
-                status if event_type == "HOST" else (status + 9)
-            )  # For colouring in GIS
-            start_time = (
-                zulu.parse(event["timestamp"]).timestamp() * 1000
-            )  # Format timestamp
-
-            # Add new host feature
-            attributes = {
-                "sitename": event["sitename"],
-                "hostname": event["hostname"],
-                "hostgroups": host_info["hostgroups"],
-                "bssglobalcoverage": host_info["bssglobalcoverage"],
-                "bsshwfamily": host_info["bsshwfamily"],
-                "bsslifecyclestatus": host_info["bsslifecyclestatus"],
-                "giskleur": gis_kleur,
+    def on_host_feature_replaced(
+        self,
+        event_type,
+        host_ref,
+        output,
+        status,
+        unique_id_event,
+        timestamp,
+        results,
+    ):
+        """
+        Handle the ArcGIS results of closing the old host feature and adding the new
+        host feature
+
+        :param event_type: Event type
+        :param host_ref: Host reference
+        :param output: Output
+        :param status: Status
+        :param unique_id_event: Unique ID event
+        :param timestamp: Event timestamp in milliseconds since epoch
+        :param results: ArcGIS update and add results
+        """
+
+        update_result = results["updates"][0]
+        add_result = results["adds"][0]
+
+        if not utils.is_edit_success(update_result):
+            logging.error(
+                f"Error when updating host feature for event: {json.dumps(update_result)}"
+            )
+
+            # Without rollback the new feature is added anyway, next to the old one
+            if utils.is_edit_success(add_result):
+                self.arcgis_processor.queue_delete(
+                    add_result["objectId"], config.LAYER["hosts"], key=host_ref.id
+                )
+        elif utils.is_edit_success(add_result):
+            host_updates = {
+                "objectId": add_result["objectId"],
                 "status": status,
                 "type": event_type,
                 "event_output": output,
-                "starttime": start_time,
+                "starttime": timestamp,
             }
-
-            response = self.arcgis_processor.add_feature(
-                host_info["longitude"],
-                host_info["latitude"],
-                attributes,
-                config.LAYER["hosts"],
+            self.writes.update(host_ref, host_updates)
+            logging.info(
+                f"Successfully updated host feature with event id: {unique_id_event}"
             )
-
-            if "success" in response:
-                host_ref.update(
-                    {
-                        "objectId": response["objectId"],
-                        "status": status,
-                        "type": event_type,
-                        "event_output": output,
-                        "starttime": zulu.parse(event["timestamp"]).timestamp() * 1000,
-                    }
-                )
-                logging.info(
-                    f"Successfully updated host feature with event id: {unique_id_event}"
-                )
-            else:
-                logging.error(
-                    f"Error when adding host feature for event: {json.dumps(response)}"
-                )
         else:
             logging.error(
-                f"Error when updating host feature for event: {json.dumps(response)}"
+                f"Error when adding host feature for event: {json.dumps(add_result)}"
             )
 
-    @staticmethod
-    def get_worst_states_of_host(event):
+    def update_host_aggregate(self, event, host_ref, event_info, attributes):
         """
-        Return current "worst" states from all events of host
+        Update the aggregate of event states of a host with an event
 
         :param event: Event data
+        :param host_ref: Host reference
+        :param event_info: Stored event information, None for a new event
+        :param attributes: Event attributes
 
-        :return: Event status, Host event output, Host status, Service event output
+        :return: Host aggregate
         """
 
-        host_status = 0
-        event_status = 0
-        host_event_output = ""
-        service_event_output = ""
+        aggregate_ref = self.get_aggregate_reference(host_ref)
+        aggregate = self.documents.get(aggregate_ref)
+
+        if aggregate is None:
+            # The aggregate is built from all events, which already includes this one
+            # and fails if another instance created the aggregate since it was read
+            aggregate = aggregates.build_aggregate(self.get_event_infos_of_host(event))
+            self.writes.create(aggregate_ref, aggregate)
+        elif event_info is None or event_info["eventstate"] != attributes["eventstate"]:
+            old_state = event_info["eventstate"] if event_info is not None else None
+            updates, aggregate = aggregates.apply_event(
+                aggregate, attributes, old_state
+            )
+            self.writes.update(aggregate_ref, updates, document=aggregate)
+
+        return aggregate
 
-        event_docs = (
-            db_client.collection("events")
-            .where("sitename", "==", event["sitename"])
-            .where("hostname", "==", event["hostname"])
-            .stream()
-        )
+    def get_event_infos_of_host(self, event):
+        """
+        Return all event information of the host of an event
 
-        for doc in event_docs:
-            event_info = doc.to_dict()
+        :param event: Event data
 
-            if event_info["servicedescription"] == "":
-                host_status = event_info["eventstate"]
-                host_event_output = event_info["output"]
-                continue
+        :return: List of event information
+        """
 
-            if event_info["eventstate"] > event_status:
-                service_event_output = event_info["output"]
-                event_status = event_info["eventstate"]
+        with metrics.timed("firestore.query") as sizes:
+            event_docs = (
+                get_db_client()
+                .collection("events")
+                .where("sitename", "==", event["sitename"])
+                .where("hostname", "==", event["hostname"])
+                .stream()
+            )
+            event_infos = {doc.reference.path: doc.to_dict() for doc in event_docs}
+            sizes["documents"] = len(event_infos)
 
-        return event_status, host_event_output, host_status, service_event_output
+        # Buffered event writes are not committed yet, so apply them on top
+        for path, event_info in self.writes.pending_documents("events"):
+            if (
+                event_info["sitename"] == event["sitename"]
+                and event_info["hostname"] == event["hostname"]
+            ):
+                event_infos[path] = event_info
 
-    @staticmethod
-    def get_attributes(event):
+        return list(event_infos.values())
+
+    def get_attributes(self, event):
         """
         Return event attributes
 
         :param event: Event Data
 
-        :return: Event attributes
+        :return: Event attributes or None if the event data is invalid
         """
 
-        try:
-            converted_time = zulu.parse(event["timestamp"]).timestamp() * 1000
-            attributes = {
-                "id": event["id"],
-                "sitename": event["sitename"],
-                "type": event["type"],
-                "hostname": event["hostname"],
-                "servicedescription": event["service_description"],
-                "statetype": event["state_type"],
-                "output": event["output"],
-                "longoutput": event["long_output"],
-                "eventstate": event["event_state"],
-                "timestamp": converted_time,
-            }
-        except (ValueError, KeyError):
-            logging.info(f"Invalid event feature data for event: {event}")
-            return None
-        else:
-            return attributes
+        return self.SCHEMA.extract(event, self.report)
 
     @staticmethod
     def make_unique_identifier(event):
@@ -574,42 +1859,387 @@ class EventProcessor:
 
         return unique_id_event, unique_id_host
 
+    @staticmethod
+    def make_delivery_key(event):
+        """
+        Make the key of a single delivery of an event, which is the same for a
+        redelivered event
 
-def get_from_dict(data_dict, map_list):
-    """Returns a dictionary based on a mapping"""
-    try:
-        return reduce(operator.getitem, map_list, data_dict)
-    except (KeyError, AttributeError, TypeError):
-        return None
+        :param event: Event Data
 
+        :return: Delivery key
+        """
 
-def main(request):
-    try:
-        envelope = json.loads(request.data.decode("utf-8"))
-        decoded = base64.b64decode(envelope["message"]["data"])
-        data = json.loads(decoded)
-        subscription = envelope["subscription"].split("/")[-1]
+        return f"{event['id']}_{event['timestamp']}"
 
-        logging.info(f"Read message from subscription {subscription}")
-    except Exception as e:
-        logging.error(f"Extracting of data failed: {e}")
-        return "Error", 500
+    def get_references(self, event):
+        """
+        Get Firestore references of the host and event of an event
+
+        :param event: Event Data
+
+        :return: Host reference, Event reference
+        """
+
+        unique_id_event, unique_id_host = self.make_unique_identifier(event)
+
+        host_ref = get_db_client().collection("hosts").document(unique_id_host)
+        event_ref = (
+            get_db_client()
+            .collection("events")
+            .document(unique_id_event.replace("/", ""))
+        )
+
+        return host_ref, event_ref
+
+    @staticmethod
+    def get_aggregate_reference(host_ref):
+        """
+        Get Firestore reference of the aggregate of event states of a host
+
+        :param host_ref: Host reference
+
+        :return: Host aggregate reference
+        """
+
+        return get_db_client().collection(aggregates.COLLECTION).document(host_ref.id)
+
+
+def process_sharded(records, get_key, process):
+    """
+    Process records in parallel shards, keeping records with the same key in order
+
+    :param records: List of records
+    :param get_key: Function returning the key of a record
+    :param process: Function processing a list of records in order
+    """
+
+    workers = getattr(config, "PROCESSING_WORKERS", 1)
+
+    if workers <= 1:
+        process(records)
+        return
+
+    shards = [[] for _ in range(workers)]
+    for record in records:
+        try:
+            key = get_key(record)
+        except (TypeError, KeyError):
+            key = None  # Invalid records are logged by the processor
+
+        shards[hash(key) % workers].append(record)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process, shard) for shard in shards if shard]
+
+        for future in futures:
+            future.result()
+
+
+def get_records_key(subscription):
+    """
+    Get the key of the records in the messages of a subscription
+
+    :param subscription: Subscription the message was received from
+
+    :return: Key of the records
+    """
+
+    return "ns_tcc_hosts" if subscription == config.SUBS["host"] else "ns_tcc_events"
+
+
+def process_batches(subscription, batches):
+    """
+    Process the records of a message one batch after another
+
+    :param subscription: Subscription the message was received from
+    :param batches: Iterable of lists of records
+
+    :return: Response
+    """
 
     arcgis_processor = ArcGISProcessor()
     if not arcgis_processor.arcgis_access_token:
         return "Error", 500
 
+    for records in batches:
+        with metrics.timed("batch", records=len(records)):
+            process_batch(subscription, arcgis_processor, records)
+
+    return "OK", 204
+
+
+def process_batch(subscription, arcgis_processor, records):
+    """
+    Process a batch of records, all edits and writes are completed on return
+
+    :param subscription: Subscription the message was received from
+    :param arcgis_processor: ArcGIS processor
+    :param records: List of host or event data
+
+    :return: Keys of records of which edits or writes failed for a transient reason
+    """
+
+    documents = DocumentCache(get_db_client(), {"hosts": get_host_cache()})
+    writes = WriteBuffer(get_db_client(), documents)
+    deduplicator = get_deduplicator(documents)
+
     if subscription == config.SUBS["host"]:
-        host_processor = HostProcessor(arcgis_processor=arcgis_processor)
+        host_processor = HostProcessor(
+            arcgis_processor=arcgis_processor, documents=documents, writes=writes
+        )
+        host_processor.prefetch(records)
+
+        process_sharded(
+            records,
+            partial(get_record_key, subscription),
+            host_processor.process_all,
+        )
+    elif subscription == config.SUBS["event"]:
+        # Redelivered events are skipped before anything is sent to ArcGIS
+        if deduplicator:
+            records = deduplicator.skip_processed(
+                "event", records, EventProcessor.make_delivery_key
+            )
 
-        for host in data["ns_tcc_hosts"]:
-            host_processor.process(host)
+        event_processor = EventProcessor(
+            arcgis_processor=arcgis_processor,
+            documents=documents,
+            writes=writes,
+            event_states=get_event_state_cache(),
+        )
+        records = event_processor.skip_unchanged(records)
+        event_processor.prefetch(records)
+
+        if getattr(config, "EVENT_COALESCING", False):
+            process_events = event_processor.process_coalesced
+        else:
+            process_events = event_processor.process_all
+
+        process_sharded(
+            records,
+            partial(get_record_key, subscription),
+            process_events,
+        )
+
+    arcgis_processor.flush()
+    failed_paths = writes.commit()
+
+    # Events of which documents changed concurrently are read and applied again
+    if subscription == config.SUBS["event"]:
+        for _ in range(getattr(config, "FIRESTORE_CONFLICT_RETRIES", 3)):
+            conflicted = event_processor.take_conflicted(records)
+            if not conflicted:
+                break
+
+            logging.warning(
+                f"Applying {len(conflicted)} events again after conflicting writes"
+            )
+            retried_paths = set(writes.conflicted_paths)
+            event_processor.prefetch(conflicted)
+            process_sharded(
+                conflicted,
+                partial(get_record_key, subscription),
+                process_events,
+            )
+
+            arcgis_processor.flush()
+            failed_paths = [
+                path for path in failed_paths if path not in retried_paths
+            ] + writes.commit()
+
+    failed_keys = get_failed_keys(arcgis_processor, failed_paths)
+
+    if subscription == config.SUBS["host"]:
+        host_processor.report.log()
     elif subscription == config.SUBS["event"]:
-        event_processor = EventProcessor(arcgis_processor=arcgis_processor)
+        event_processor.report.log()
+        event_processor.store_event_states(failed_keys)
+
+        if deduplicator:
+            mark_processed_events(deduplicator, records, failed_keys)
 
-        for event in data["ns_tcc_events"]:
-            event_processor.process(event)
-    else:
+    return failed_keys
+
+
+def get_failed_keys(arcgis_processor, failed_paths):
+    """
+    Get the keys of records of which edits or writes failed for a transient reason
+
+    :param arcgis_processor: ArcGIS processor
+    :param failed_paths: Paths of the documents whose batch failed to commit
+
+    :return: Set of keys
+    """
+
+    # Hosts and their aggregates are written together with the events of the host
+    failed_keys = arcgis_processor.take_failed_keys()
+    for path in failed_paths:
+        collection, document_id = path.split("/", 1)
+        if collection in ["hosts", aggregates.COLLECTION]:
+            failed_keys.add(document_id)
+
+    return failed_keys
+
+
+def mark_processed_events(deduplicator, events, failed_keys):
+    """
+    Mark the events of which no edit or write failed as processed
+
+    :param deduplicator: Deduplicator
+    :param events: List of event data
+    :param failed_keys: Keys of records of which edits or writes failed
+    """
+
+    keys = []
+    for event in events:
+        try:
+            if get_record_key(config.SUBS["event"], event) not in failed_keys:
+                keys.append(EventProcessor.make_delivery_key(event))
+        except (TypeError, KeyError):
+            continue
+
+    deduplicator.mark_processed("event", keys)
+
+
+def get_record_key(subscription, record):
+    """
+    Get the key of a record, records with the same key are processed in order
+
+    :param subscription: Subscription the record was received from
+    :param record: Host or event data
+
+    :return: Host ID
+    """
+
+    if subscription == config.SUBS["host"]:
+        return record["id"]
+
+    return EventProcessor.make_unique_identifier(record)[1]
+
+
+def read_message(request):
+    """
+    Read the subscription and batches of records of a Pub/Sub push request
+
+    With streaming decode enabled the records are decoded from the request while they
+    are processed, instead of decoding the whole message up front.
+
+    :param request: Request
+
+    :return: Subscription, Message ID, Function returning an iterable of lists of
+        records
+    """
+
+    envelope = None
+    if getattr(config, "STREAMING_DECODE", False):
+        envelope = streaming.read_envelope(request.data)
+
+    if envelope is not None:
+        subscription, start, end = envelope
+
+        def get_batches():
+            return streaming.stream_batches(
+                request.data,
+                start,
+                end,
+                get_records_key(subscription),
+                getattr(config, "STREAMING_BATCH_SIZE", 500),
+            )
+
+        return subscription, streaming.read_message_id(request.data), get_batches
+
+    envelope = json.loads(request.data.decode("utf-8"))
+    decoded = base64.b64decode(envelope["message"]["data"])
+    data = json.loads(decoded)
+    subscription = envelope["subscription"].split("/")[-1]
+    message_id = envelope["message"].get("messageId") or envelope["message"].get(
+        "message_id"
+    )
+
+    return subscription, message_id, lambda: [data[get_records_key(subscription)]]
+
+
+def main(request):
+    try:
+        subscription, message_id, get_batches = read_message(request)
+
+        logging.info(f"Read message from subscription {subscription}")
+    except Exception as e:
+        logging.error(f"Extracting of data failed: {e}")
+        return "Error", 500
+
+    # Invalid subscriptions are rejected before any client is initialised
+    if subscription not in [config.SUBS["host"], config.SUBS["event"]]:
         logging.info(f"Invalid subscription received: {subscription}")
+        return "OK", 204
 
-    return "OK", 204
+    metrics.reset()
+
+    # Redelivered messages are acknowledged without processing them again
+    deduplicator = get_deduplicator() if message_id else None
+    if deduplicator and deduplicator.is_processed("message", message_id):
+        logging.info(f"Message {message_id} was processed before")
+        return "OK", 204
+
+    try:
+        if getattr(config, "ASYNC_PROCESSING", False):
+            import async_processing
+
+            response = asyncio.run(
+                async_processing.process_batches(
+                    subscription, get_batches(), get_db_client()
+                )
+            )
+        else:
+            response = process_batches(subscription, get_batches())
+    except streaming.StreamingDecodeError as e:
+        logging.error(f"Extracting of data failed: {e}")
+        response = "Error", 500
+
+    if deduplicator and response[1] == 204:
+        deduplicator.mark_processed("message", [message_id])
+
+    metrics.log_summary(
+        subscription=subscription,
+        status=response[1],
+        host_cache=get_host_cache().stats(),
+        event_state_cache=get_event_state_cache().stats(),
+    )
+
+    return response
+
+
+def pull(request):
+    """
+    Pull messages from the host and event subscriptions and process them in
+    micro-batches, for example when triggered by Cloud Scheduler
+
+    :param request: Request
+
+    :return: Response
+    """
+
+    import pull as pull_consumer
+
+    metrics.reset()
+
+    consumer = pull_consumer.PullConsumer(
+        get_subscriber_client(), os.environ["PROJECT_ID"]
+    )
+    response = consumer.run(getattr(config, "PULL_DURATION", 240))
+
+    metrics.log_summary(
+        status=response[1],
+        acked=consumer.acked,
+        nacked=consumer.nacked,
+        host_cache=get_host_cache().stats(),
+        event_state_cache=get_event_state_cache().stats(),
+    )
+
+    return response
+
+
+logging.info(
+    f"Imported function module in {time.perf_counter() - _import_started:.3f}s"
+)
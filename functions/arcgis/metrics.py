@@ -0,0 +1,101 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    def reset(self):
+        """
+        Forget all recorded stages, for example at the start of an invocation
+        """
+
+        with self.lock:
+            self.stages = {}
+            self.started = time.perf_counter()
+
+    def record(self, stage, duration, **sizes):
+        """
+        Record a call of a stage
+
+        :param stage: Stage name
+        :param duration: Duration of the call in seconds
+        :param sizes: Sizes of the call to add up per stage, such as bytes or documents
+        """
+
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = {"calls": 0, "total_ms": 0.0, "max_ms": 0.0}
+                self.stages[stage] = stats
+
+            duration_ms = duration * 1000
+            stats["calls"] += 1
+            stats["total_ms"] += duration_ms
+            stats["max_ms"] = max(stats["max_ms"], duration_ms)
+
+            for name, size in sizes.items():
+                stats[name] = stats.get(name, 0) + size
+
+    @contextmanager
+    def timed(self, stage, **sizes):
+        """
+        Record the duration of the code within this context as a call of a stage
+
+        :param stage: Stage name
+        :param sizes: Sizes of the call, more can be added to the yielded dict
+        """
+
+        sizes = dict(sizes)
+        started = time.perf_counter()
+        try:
+            yield sizes
+        finally:
+            self.record(stage, time.perf_counter() - started, **sizes)
+
+    def summary(self, **fields):
+        """
+        Get a summary of all recorded stages
+
+        :param fields: Additional fields of the summary
+
+        :return: Summary
+        """
+
+        with self.lock:
+            stages = {
+                stage: {
+                    name: round(value, 3) if isinstance(value, float) else value
+                    for name, value in stats.items()
+                }
+                for stage, stats in self.stages.items()
+            }
+
+            duration_ms = (time.perf_counter() - self.started) * 1000
+
+        return {**fields, "duration_ms": round(duration_ms, 3), "stages": stages}
+
+    def log_summary(self, **fields):
+        """
+        Log the summary of all recorded stages as a single JSON line
+
+        :param fields: Additional fields of the summary
+        """
+
+        summary = {"message": "Invocation metrics", **self.summary(**fields)}
+        logging.info(json.dumps(summary))
+
+
+_metrics = Metrics()
+
+reset = _metrics.reset
+record = _metrics.record
+timed = _metrics.timed
+summary = _metrics.summary
+log_summary = _metrics.log_summary
@@ -0,0 +1,300 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+import main
+import metrics
+from google.api_core.exceptions import DeadlineExceeded
+
+
+class PulledMessage:
+    def __init__(self, ack_id, message_id, records, keys):
+        """
+        Message pulled from a subscription
+
+        :param ack_id: Acknowledgement ID of the message
+        :param message_id: Pub/Sub message ID
+        :param records: List of host or event data
+        :param keys: Keys of the records, see main.get_record_key
+        """
+
+        self.ack_id = ack_id
+        self.message_id = message_id
+        self.records = records
+        self.keys = keys
+
+
+class PullConsumer:
+    def __init__(self, subscriber, project_id):
+        """
+        Consumer pulling messages in micro-batches from the configured subscriptions
+
+        :param subscriber: Pub/Sub subscriber client
+        :param project_id: Project of the subscriptions
+        """
+
+        self.subscriber = subscriber
+        self.project_id = project_id
+        self.max_messages = getattr(config, "PULL_MAX_MESSAGES", 100)
+        self.batch_records = getattr(config, "PULL_BATCH_RECORDS", 1000)
+        self.batch_wait = getattr(config, "PULL_BATCH_WAIT", 2)
+        self.ack_deadline = getattr(config, "PULL_ACK_DEADLINE", 60)
+        self.acked = 0
+        self.nacked = 0
+
+    def run(self, duration):
+        """
+        Pull and process messages of all subscriptions until no messages are left or
+        the duration has passed
+
+        :param duration: Seconds to pull messages for
+
+        :return: Response
+        """
+
+        arcgis_processor = main.ArcGISProcessor()
+        if not arcgis_processor.arcgis_access_token:
+            return "Error", 500
+
+        deadline = time.monotonic() + duration
+        subscriptions = [config.SUBS["host"], config.SUBS["event"]]
+
+        # Subscriptions take turns, so a busy host subscription does not starve events
+        while subscriptions and time.monotonic() < deadline:
+            for subscription in list(subscriptions):
+                if not self.consume(subscription, arcgis_processor, deadline):
+                    subscriptions.remove(subscription)
+
+        return "OK", 204
+
+    def consume(self, subscription, arcgis_processor, deadline):
+        """
+        Pull and process a micro-batch of the messages of a subscription
+
+        :param subscription: Subscription name
+        :param arcgis_processor: ArcGIS processor
+        :param deadline: Monotonic time after which no more messages are pulled
+
+        :return: True if messages were pulled
+        """
+
+        if time.monotonic() >= deadline:
+            return False
+
+        path = self.subscriber.subscription_path(self.project_id, subscription)
+
+        messages = self.pull_batch(subscription, path, deadline)
+        if not messages:
+            return False
+
+        with self.leased(path, messages):
+            self.process_batch(subscription, path, arcgis_processor, messages)
+
+        return True
+
+    def pull_batch(self, subscription, path, deadline):
+        """
+        Pull messages until the batch holds enough records or the batch wait passed
+
+        :param subscription: Subscription name
+        :param path: Subscription path
+        :param deadline: Monotonic time after which no more messages are pulled
+
+        :return: List of pulled messages
+        """
+
+        messages, records = [], 0
+        batch_deadline = min(deadline, time.monotonic() + self.batch_wait)
+
+        while records < self.batch_records:
+            timeout = batch_deadline - time.monotonic()
+            if timeout <= 0:
+                break
+
+            try:
+                with metrics.timed("pubsub.pull") as sizes:
+                    response = self.subscriber.pull(
+                        request={
+                            "subscription": path,
+                            "max_messages": self.max_messages,
+                        },
+                        timeout=timeout,
+                    )
+                    sizes["messages"] = len(response.received_messages)
+            except DeadlineExceeded:
+                break
+
+            if not response.received_messages:
+                break
+
+            invalid = []
+            for received in response.received_messages:
+                message = self.read_message(subscription, received)
+
+                if message is None:
+                    invalid.append(received.ack_id)
+                else:
+                    messages.append(message)
+                    records += len(message.records)
+
+            # Invalid messages are redelivered, like failed push deliveries
+            self.nack(path, invalid)
+
+        return messages
+
+    @staticmethod
+    def read_message(subscription, received):
+        """
+        Read the records of a pulled message
+
+        :param subscription: Subscription name
+        :param received: Received message
+
+        :return: Pulled message or None if the message data is invalid
+        """
+
+        try:
+            data = json.loads(received.message.data)
+            records = data[main.get_records_key(subscription)]
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(
+                f"Extracting of data failed for message {received.message.message_id}: {e}"
+            )
+            return None
+
+        keys = set()
+        for record in records:
+            try:
+                keys.add(main.get_record_key(subscription, record))
+            except (TypeError, KeyError):
+                continue  # Invalid records are logged by the processor
+
+        return PulledMessage(
+            received.ack_id, received.message.message_id, records, keys
+        )
+
+    def process_batch(self, subscription, path, arcgis_processor, messages):
+        """
+        Process the records of pulled messages together, acknowledging the messages of
+        which all records succeeded
+
+        :param subscription: Subscription name
+        :param path: Subscription path
+        :param arcgis_processor: ArcGIS processor
+        :param messages: List of pulled messages
+        """
+
+        # Redelivered messages are acknowledged without processing them again
+        deduplicator = main.get_deduplicator()
+        if deduplicator:
+            processed = [
+                message
+                for message in messages
+                if deduplicator.is_processed("message", message.message_id)
+            ]
+            self.ack(path, [message.ack_id for message in processed])
+            messages = [message for message in messages if message not in processed]
+
+            if not messages:
+                return
+
+        records = [record for message in messages for record in message.records]
+
+        # The retry budget applies per micro-batch, like per pushed message
+        arcgis_processor.reset_retry_budget()
+
+        try:
+            with metrics.timed("batch", records=len(records)):
+                failed_keys = main.process_batch(
+                    subscription, arcgis_processor, records
+                )
+        except Exception as e:
+            logging.exception(f"Error when processing {len(messages)} messages: {e}")
+            self.nack(path, [message.ack_id for message in messages])
+            return
+
+        succeeded = [message for message in messages if not message.keys & failed_keys]
+
+        self.ack(path, [message.ack_id for message in succeeded])
+        self.nack(
+            path, [message.ack_id for message in messages if message.keys & failed_keys]
+        )
+
+        if deduplicator:
+            deduplicator.mark_processed(
+                "message", [message.message_id for message in succeeded]
+            )
+
+    @contextmanager
+    def leased(self, path, messages):
+        """
+        Keep extending the ack deadline of messages while they are processed, so they
+        are not redelivered to another instance meanwhile
+
+        :param path: Subscription path
+        :param messages: List of pulled messages
+        """
+
+        ack_ids = [message.ack_id for message in messages]
+        stopped = threading.Event()
+
+        def extend():
+            while True:
+                try:
+                    self.subscriber.modify_ack_deadline(
+                        request={
+                            "subscription": path,
+                            "ack_ids": ack_ids,
+                            "ack_deadline_seconds": self.ack_deadline,
+                        }
+                    )
+                except Exception as e:
+                    logging.warning(
+                        f"Failed to extend the ack deadline of {len(ack_ids)} messages: {e}"
+                    )
+
+                if stopped.wait(self.ack_deadline / 3):
+                    return
+
+        thread = threading.Thread(target=extend, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def ack(self, path, ack_ids):
+        """
+        Acknowledge messages
+
+        :param path: Subscription path
+        :param ack_ids: Acknowledgement IDs of the messages
+        """
+
+        if ack_ids:
+            self.subscriber.acknowledge(
+                request={"subscription": path, "ack_ids": ack_ids}
+            )
+            self.acked += len(ack_ids)
+
+    def nack(self, path, ack_ids):
+        """
+        Make messages available for redelivery
+
+        :param path: Subscription path
+        :param ack_ids: Acknowledgement IDs of the messages
+        """
+
+        if ack_ids:
+            self.subscriber.modify_ack_deadline(
+                request={
+                    "subscription": path,
+                    "ack_ids": ack_ids,
+                    "ack_deadline_seconds": 0,
+                }
+            )
+            self.nacked += len(ack_ids)
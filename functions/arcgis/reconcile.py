@@ -0,0 +1,432 @@
+import argparse
+import logging
+import time
+from collections import Counter
+from functools import partial
+
+import config
+import main
+import utils
+from firestore_utils import WriteBuffer
+
+# Host fields that are kept equal to the attributes of the current host feature
+RECONCILED_KEYS = [
+    "sitename",
+    "hostname",
+    "hostgroups",
+    "bssglobalcoverage",
+    "bsshwfamily",
+    "bsslifecyclestatus",
+    "status",
+    "type",
+    "event_output",
+    "endtime",
+]
+
+
+class ReconciliationError(Exception):
+    pass
+
+
+class Reconciler:
+    def __init__(self, arcgis_processor, db_client, page_size=None, dry_run=False):
+        """
+        Reconciliation of the hosts collection with the features of the hosts layer
+
+        Both sides are read in pages ordered by object ID and joined page by page, so
+        only a page of hosts is held in memory at a time. Features added after the run
+        started are not reconciled, and hosts are read again before they are fixed, as
+        the function keeps processing messages meanwhile.
+
+        :param arcgis_processor: ArcGIS processor
+        :param db_client: Firestore client
+        :param page_size: Number of hosts and features read per page
+        :param dry_run: Only count the differences without fixing them
+        """
+
+        self.arcgis_processor = arcgis_processor
+        self.db_client = db_client
+        self.page_size = page_size or getattr(config, "RECONCILE_PAGE_SIZE", 1000)
+        self.dry_run = dry_run
+        self.layer = config.LAYER["hosts"]
+        self.writes = WriteBuffer(db_client)
+        self.counts = Counter()
+        self.max_object_id = None
+
+    def run(self):
+        """
+        Reconcile all hosts and host features
+
+        :return: Number of hosts and features per outcome
+        """
+
+        self.max_object_id = self.get_max_object_id()
+
+        features = self.iter_features()
+        feature = next(features, None)
+
+        for hosts in self.iter_host_pages():
+            index = {host["objectId"]: (host_id, host) for host_id, host in hosts}
+            last_object_id = hosts[-1][1]["objectId"]
+
+            # Features up to the last object ID of the page belong to this page
+            while (
+                feature is not None
+                and feature["attributes"]["objectid"] <= last_object_id
+            ):
+                entry = index.pop(feature["attributes"]["objectid"], None)
+
+                if entry is None:
+                    self.check_orphaned(feature)
+                else:
+                    self.check_stale(*entry, feature)
+
+                feature = next(features, None)
+
+            for host_id, host in index.values():
+                # Features of hosts added after the run started were not read
+                if host["objectId"] > self.max_object_id:
+                    continue
+
+                self.fix_missing(host_id, host)
+
+            self.apply()
+
+        # Features after the last host are not referenced by any host
+        while feature is not None:
+            self.check_orphaned(feature)
+            feature = next(features, None)
+
+        self.apply()
+
+        return dict(self.counts)
+
+    def iter_host_pages(self):
+        """
+        Read the hosts with a feature in pages ordered by object ID
+
+        :return: Generator of lists of host ID and host information
+        """
+
+        query = self.db_client.collection("hosts").order_by("objectId")
+        last_snapshot = None
+
+        while True:
+            page_query = query.limit(self.page_size)
+            if last_snapshot is not None:
+                page_query = page_query.start_after(last_snapshot)
+
+            snapshots = list(page_query.stream())
+            if not snapshots:
+                return
+
+            self.counts["hosts"] += len(snapshots)
+            yield [(snapshot.id, snapshot.to_dict()) for snapshot in snapshots]
+
+            last_snapshot = snapshots[-1]
+
+    def get_max_object_id(self):
+        """
+        Get the highest object ID of the hosts layer when the run starts
+
+        :return: Object ID, 0 if the layer has no features
+        """
+
+        response = self.arcgis_processor.query(
+            self.layer,
+            {
+                "where": "objectid > 0",
+                "outFields": "objectid",
+                "orderByFields": "objectid DESC",
+                "resultRecordCount": 1,
+                "returnGeometry": "false",
+            },
+        )
+
+        if not isinstance(response, dict) or "features" not in response:
+            raise ReconciliationError(
+                f"Querying the highest object ID failed: {response}"
+            )
+
+        if not response["features"]:
+            return 0
+
+        return response["features"][0]["attributes"]["objectid"]
+
+    def iter_features(self):
+        """
+        Read the features of the hosts layer in pages ordered by object ID, up to the
+        highest object ID when the run started
+
+        :return: Generator of ArcGIS features
+        """
+
+        last_object_id = 0
+
+        while True:
+            response = self.arcgis_processor.query(
+                self.layer,
+                {
+                    "where": f"objectid > {last_object_id}",
+                    "outFields": ",".join(["objectid"] + RECONCILED_KEYS),
+                    "orderByFields": "objectid ASC",
+                    "resultRecordCount": self.page_size,
+                    "returnGeometry": "false",
+                },
+            )
+
+            if not isinstance(response, dict) or "features" not in response:
+                # Continuing would report all remaining hosts as missing
+                raise ReconciliationError(
+                    f"Querying features after {last_object_id} failed: {response}"
+                )
+
+            if not response["features"]:
+                return
+
+            for feature in response["features"]:
+                if feature["attributes"]["objectid"] > self.max_object_id:
+                    return
+
+                self.counts["features"] += 1
+                yield feature
+
+            last_object_id = response["features"][-1]["attributes"]["objectid"]
+
+    def check_orphaned(self, feature):
+        """
+        Close an open feature that is not the current feature of any host
+
+        :param feature: ArcGIS feature
+        """
+
+        attributes = feature["attributes"]
+
+        # Closed features are the history of a host
+        if attributes.get("endtime") is not None:
+            return
+
+        # A host may have been given the feature after its page was read
+        if self.is_referenced(attributes["objectid"]):
+            return
+
+        self.counts["orphaned"] += 1
+        logging.info(f"Feature {attributes['objectid']} is not referenced by any host")
+
+        if self.dry_run:
+            return
+
+        self.arcgis_processor.queue_update(
+            None,
+            None,
+            {
+                "objectid": attributes["objectid"],
+                "endtime": int(time.time() * 1000),
+            },
+            self.layer,
+            callback=partial(self.on_fixed, "orphaned", attributes["objectid"]),
+        )
+
+    def check_stale(self, host_id, host, feature):
+        """
+        Update the attributes of the current feature of a host that differ from the host
+
+        :param host_id: Host ID
+        :param host: Host information
+        :param feature: ArcGIS feature
+        """
+
+        if not self.get_differences(host, feature):
+            return
+
+        # The host may have changed after its page was read
+        host = self.read_host(host_id)
+        if host is None or host.get("objectId") != feature["attributes"]["objectid"]:
+            return
+
+        attributes = self.get_differences(host, feature)
+        if not attributes:
+            return
+
+        self.counts["stale"] += 1
+        logging.info(f"Feature of host {host_id} differs in {sorted(attributes)}")
+
+        if self.dry_run:
+            return
+
+        self.arcgis_processor.queue_update(
+            None,
+            None,
+            {"objectid": host["objectId"], **attributes},
+            self.layer,
+            callback=partial(self.on_fixed, "stale", host_id),
+            key=host_id,
+        )
+
+    def get_differences(self, host, feature):
+        """
+        Get the host fields that differ from the attributes of its feature
+
+        :param host: Host information
+        :param feature: ArcGIS feature
+
+        :return: Differing host fields
+        """
+
+        return {
+            key: host.get(key)
+            for key in RECONCILED_KEYS
+            if self.is_different(host.get(key), feature["attributes"].get(key))
+        }
+
+    def read_host(self, host_id):
+        """
+        Read the current information of a host
+
+        :param host_id: Host ID
+
+        :return: Host information, None if the host does not exist
+        """
+
+        snapshot = self.db_client.collection("hosts").document(host_id).get()
+
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def is_referenced(self, object_id):
+        """
+        Check if a host currently refers to a feature
+
+        :param object_id: Object ID
+
+        :return: True if a host refers to the feature
+        """
+
+        query = self.db_client.collection("hosts").where("objectId", "==", object_id)
+
+        return any(True for _ in query.limit(1).stream())
+
+    @staticmethod
+    def is_different(host_value, feature_value):
+        """
+        Check if a host field differs from the feature attribute, which may hold the
+        value as a string
+
+        :param host_value: Value of the host field
+        :param feature_value: Value of the feature attribute
+
+        :return: True if the values differ
+        """
+
+        return host_value != feature_value and str(host_value) != str(feature_value)
+
+    def fix_missing(self, host_id, host):
+        """
+        Add a feature for a host of which the feature does not exist
+
+        :param host_id: Host ID
+        :param host: Host information
+        """
+
+        # The host may have been given another feature after its page was read
+        current = self.read_host(host_id)
+        if current is None or current.get("objectId") != host["objectId"]:
+            return
+
+        host = current
+        self.counts["missing"] += 1
+        logging.info(f"Feature {host['objectId']} of host {host_id} does not exist")
+
+        if self.dry_run:
+            return
+
+        attributes = {key: value for key, value in host.items() if key != "objectId"}
+
+        self.arcgis_processor.queue_add(
+            host["longitude"],
+            host["latitude"],
+            attributes,
+            self.layer,
+            callback=partial(self.on_missing_added, host_id),
+            key=host_id,
+        )
+
+    def on_missing_added(self, host_id, response):
+        """
+        Handle the ArcGIS result of adding the feature of a host
+
+        :param host_id: Host ID
+        :param response: ArcGIS add result
+        """
+
+        if utils.is_edit_success(response):
+            self.writes.update(
+                self.db_client.collection("hosts").document(host_id),
+                {"objectId": response["objectId"]},
+            )
+
+        self.on_fixed("missing", host_id, response)
+
+    def on_fixed(self, outcome, identifier, response):
+        """
+        Count the ArcGIS result of a fix
+
+        :param outcome: Kind of difference that was fixed
+        :param identifier: Host ID or object ID
+        :param response: ArcGIS edit result
+        """
+
+        if utils.is_edit_success(response):
+            self.counts[f"{outcome}_fixed"] += 1
+        else:
+            self.counts[f"{outcome}_failed"] += 1
+            logging.error(f"Failed to fix {outcome} {identifier}: {response}")
+
+    def apply(self):
+        """
+        Apply the queued fixes in chunked applyEdits calls and commit the host updates
+        """
+
+        self.arcgis_processor.flush()
+        self.arcgis_processor.take_failed_keys()
+
+        failed_paths = self.writes.commit()
+        if failed_paths:
+            self.counts["missing_failed"] += len(failed_paths)
+
+
+def reconcile(page_size=None, dry_run=False):
+    """
+    Reconcile the hosts collection with the hosts layer
+
+    :param page_size: Number of hosts and features read per page
+    :param dry_run: Only count the differences without fixing them
+
+    :return: Number of hosts and features per outcome, None if no token was retrieved
+    """
+
+    arcgis_processor = main.ArcGISProcessor()
+    if not arcgis_processor.arcgis_access_token:
+        return None
+
+    reconciler = Reconciler(arcgis_processor, main.get_db_client(), page_size, dry_run)
+
+    return reconciler.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Reconcile the hosts collection with the hosts layer"
+    )
+    parser.add_argument("--page-size", type=int, help="Hosts and features per page")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only report the differences"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    counts = reconcile(args.page_size, args.dry_run)
+    if counts is None:
+        logging.error("Reconciliation failed, no ArcGIS token retrieved")
+    else:
+        logging.info(f"Reconciled hosts: {counts}")
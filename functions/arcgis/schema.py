@@ -0,0 +1,212 @@
+import logging
+import math
+import threading
+from collections import Counter
+
+MISSING = object()
+
+
+class ValidationError(ValueError):
+    pass
+
+
+class Field:
+    def __init__(
+        self, name, *paths, converter=None, required=True, nullable=True, value=MISSING
+    ):
+        """
+        Field of a record schema
+
+        :param name: Name of the field in the extracted record
+        :param paths: Source paths of the field like "latitude/value", later paths are
+            fallbacks used when the value of an earlier path is empty
+        :param converter: Function converting the source value
+        :param required: The source path has to exist
+        :param nullable: The value may be None
+        :param value: Constant value of a field without source paths
+        """
+
+        self.name = name
+        self.paths = paths or (name,)
+        self.converter = converter
+        self.required = required
+        self.nullable = nullable
+        self.value = value
+
+    def compile(self):
+        """
+        Compile the field into a function getting its value from a record
+
+        :return: Function returning the value of the field, raising ValidationError
+            when the record is invalid
+        """
+
+        if self.value is not MISSING:
+            value = self.value
+            return lambda record: value
+
+        getters = [compile_path(path) for path in self.paths]
+        get = getters[0] if len(getters) == 1 else compile_fallbacks(getters)
+
+        name, converter, required = self.name, self.converter, self.required
+        nullable = self.nullable
+
+        def get_value(record):
+            try:
+                value = get(record)
+            except (KeyError, TypeError, IndexError):
+                if required:
+                    raise ValidationError(f"Field '{name}' is missing")
+                value = None
+
+            if value is None:
+                if not nullable:
+                    raise ValidationError(f"Field '{name}' has no value")
+                return None
+
+            if converter is not None:
+                try:
+                    value = converter(value)
+                except (ValueError, TypeError) as e:
+                    raise ValidationError(f"Field '{name}' is invalid: {e}")
+
+            # JSON allows NaN and Infinity, which ArcGIS edits cannot hold
+            if isinstance(value, float) and not math.isfinite(value):
+                raise ValidationError(f"Field '{name}' is not finite")
+
+            return value
+
+        return get_value
+
+
+def compile_path(path):
+    """
+    Compile a source path into a function getting its value from a record
+
+    :param path: Source path, keys of nested values separated by "/"
+
+    :return: Function returning the value, raising KeyError or TypeError if the path
+        does not exist
+    """
+
+    keys = tuple(path.split("/"))
+
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda record: record[key]
+
+    if len(keys) == 2:
+        outer, inner = keys
+        return lambda record: record[outer][inner]
+
+    def get(record):
+        for key in keys:
+            record = record[key]
+        return record
+
+    return get
+
+
+def compile_fallbacks(getters):
+    """
+    Combine the getters of fallback paths into a single getter
+
+    :param getters: Getters of the source paths in order of preference
+
+    :return: Function returning the first non-empty value, or the value of the last
+        path when all are empty
+    """
+
+    def get(record):
+        value = None
+
+        for getter in getters:
+            try:
+                value = getter(record)
+            except (KeyError, TypeError, IndexError):
+                value = None
+
+            if value:
+                return value
+
+        return value
+
+    return get
+
+
+class Schema:
+    def __init__(self, kind, fields):
+        """
+        Declarative mapping of source records, of which the fields are compiled once
+
+        :param kind: Kind of record, used in validation reports
+        :param fields: Fields of the extracted record, in order
+        """
+
+        self.kind = kind
+        self.fields = fields
+        self.getters = [(field.name, field.compile()) for field in fields]
+
+    def extract(self, record, report=None):
+        """
+        Extract the fields of a record
+
+        :param record: Source record
+        :param report: Validation report collecting invalid records
+
+        :return: Extracted record or None if the record is invalid
+        """
+
+        try:
+            return {name: get(record) for name, get in self.getters}
+        except ValidationError as e:
+            if report is None:
+                logging.info(f"Invalid {self.kind} data: {record}: {e}")
+            else:
+                report.add(record, e)
+
+            return None
+
+
+class ValidationReport:
+    def __init__(self, kind, samples=5):
+        """
+        Invalid records of a batch, logged together once the batch is processed
+
+        :param kind: Kind of record
+        :param samples: Number of invalid records that are logged in full
+        """
+
+        self.kind = kind
+        self.max_samples = samples
+        self.errors = Counter()
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def add(self, record, error):
+        """
+        Add an invalid record
+
+        :param record: Source record
+        :param error: Validation error
+        """
+
+        with self.lock:
+            self.errors[str(error)] += 1
+
+            if len(self.samples) < self.max_samples:
+                self.samples.append(f"{record}: {error}")
+
+    def log(self):
+        """
+        Log the invalid records of the batch, if any
+        """
+
+        with self.lock:
+            if not self.errors:
+                return
+
+            logging.info(
+                f"Skipped {sum(self.errors.values())} invalid {self.kind} records: "
+                f"{dict(self.errors)}, for example {self.samples}"
+            )
@@ -1,7 +1,5 @@
 import os
 
-from google.cloud import secretmanager_v1
-
 
 def get_secret_token():
     """
@@ -11,6 +9,9 @@ def get_secret_token():
     :rtype: str
     """
 
+    # Imported on first use, as loading the Secret Manager library slows down cold starts
+    from google.cloud import secretmanager_v1
+
     secret_client = secretmanager_v1.SecretManagerServiceClient()
 
     secret_name = secret_client.secret_version_path(
@@ -0,0 +1,217 @@
+import base64
+import binascii
+import codecs
+import json
+import re
+
+DATA_PATTERN = re.compile(rb'"data"\s*:\s*"')
+SUBSCRIPTION_PATTERN = re.compile(rb'"subscription"\s*:\s*"([^"\\]*)"')
+MESSAGE_ID_PATTERN = re.compile(rb'"message_?[iI]d"\s*:\s*"([^"\\]*)"')
+ARRAY_START_PATTERN = re.compile(r"\s*:\s*\[")
+WHITESPACE = " \t\n\r"
+
+
+class StreamingDecodeError(ValueError):
+    pass
+
+
+def read_envelope(raw):
+    """
+    Locate the subscription and base64 message data in a raw Pub/Sub push envelope
+    without parsing the envelope as a whole
+
+    :param raw: Raw request body
+    :type raw: bytes
+
+    :return: Subscription, Start and end offset of the message data
+        or None if the envelope cannot be read this way
+    :rtype: tuple
+    """
+
+    message = raw.find(b'"message"')
+    subscription = SUBSCRIPTION_PATTERN.search(raw)
+    data = DATA_PATTERN.search(raw, message) if message >= 0 else None
+
+    if not subscription or not data:
+        return None
+
+    start = data.end()
+    end = raw.find(b'"', start)
+
+    # Base64 never needs escaping, an escaped value has to be parsed as a whole
+    if end < 0 or raw.find(b"\\", start, end) >= 0:
+        return None
+
+    return subscription.group(1).decode("utf-8").split("/")[-1], start, end
+
+
+def read_message_id(raw):
+    """
+    Locate the message ID in a raw Pub/Sub push envelope without parsing the envelope
+    as a whole
+
+    :param raw: Raw request body
+    :type raw: bytes
+
+    :return: Message ID or None if the envelope has none
+    :rtype: str
+    """
+
+    message_id = MESSAGE_ID_PATTERN.search(raw)
+
+    return message_id.group(1).decode("utf-8") if message_id else None
+
+
+def iter_base64(raw, start, end, chunk_size=65536):
+    """
+    Decode base64 data in chunks
+
+    :param raw: Raw request body
+    :type raw: bytes
+    :param start: Start offset of the base64 data
+    :type start: int
+    :param end: End offset of the base64 data
+    :type end: int
+    :param chunk_size: Number of base64 characters decoded at once
+    :type chunk_size: int
+
+    :return: Generator of decoded bytes
+    :rtype: generator
+    """
+
+    view = memoryview(raw)
+    chunk_size -= chunk_size % 4  # Chunks must not split a group of 4 characters
+
+    try:
+        for offset in range(start, end, chunk_size):
+            yield base64.b64decode(view[offset : min(offset + chunk_size, end)])
+    except binascii.Error as e:
+        raise StreamingDecodeError(f"Invalid base64 message data: {str(e)}")
+
+
+def iter_array(chunks, key):
+    """
+    Parse the records of a JSON array in an object one at a time
+
+    :param chunks: Iterable of UTF-8 encoded JSON chunks
+    :type chunks: iterable
+    :param key: Key of the array in the object
+    :type key: str
+
+    :return: Generator of records
+    :rtype: generator
+    """
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer, position = "", 0
+
+    def read():
+        nonlocal buffer, position
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+
+        # Drop parsed text so the buffer stays about the size of a chunk
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+        return True
+
+    # Find the start of the array
+    marker = json.dumps(key)
+    start = 0
+    while True:
+        index = buffer.find(marker, start)
+        if index >= 0:
+            match = ARRAY_START_PATTERN.match(buffer, index + len(marker))
+            if match:
+                position = match.end()
+                break
+
+            # The key also occurs elsewhere, such as in a value, unless the text
+            # before the array continues in the next chunk
+            if buffer[index + len(marker) :].strip(WHITESPACE + ":"):
+                start = index + 1
+                continue
+
+        if not read():
+            raise StreamingDecodeError(f"Message data contains no array '{key}'")
+
+    while True:
+        while True:
+            # Skip separators between records
+            while position < len(buffer) and buffer[position] in WHITESPACE + ",":
+                position += 1
+
+            if position < len(buffer):
+                break
+            if not read():
+                raise StreamingDecodeError(f"Array '{key}' is not terminated")
+
+        if buffer[position] == "]":
+            return
+
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as e:
+            # The record may continue in the next chunk
+            if read():
+                continue
+            raise StreamingDecodeError(f"Invalid record in array '{key}': {str(e)}")
+
+        # A record ending exactly at the buffer end may continue, like a number
+        if end == len(buffer) and read():
+            continue
+
+        position = end
+        yield record
+
+
+def iter_batches(records, batch_size):
+    """
+    Group records in lists of at most the batch size
+
+    :param records: Iterable of records
+    :type records: iterable
+    :param batch_size: Maximum number of records per batch
+    :type batch_size: int
+
+    :return: Generator of lists of records
+    :rtype: generator
+    """
+
+    batch = []
+
+    for record in records:
+        batch.append(record)
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def stream_batches(raw, start, end, key, batch_size):
+    """
+    Decode the records of a message in batches
+
+    :param raw: Raw request body
+    :type raw: bytes
+    :param start: Start offset of the base64 message data
+    :type start: int
+    :param end: End offset of the base64 message data
+    :type end: int
+    :param key: Key of the array of records in the message data
+    :type key: str
+    :param batch_size: Maximum number of records per batch
+    :type batch_size: int
+
+    :return: Generator of lists of records
+    :rtype: generator
+    """
+
+    return iter_batches(iter_array(iter_base64(raw, start, end), key), batch_size)
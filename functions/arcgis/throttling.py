@@ -0,0 +1,108 @@
+import random
+import threading
+import time
+
+import config
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, min_rate=None):
+        """
+        Token bucket that adapts its rate to throttling by the server
+
+        :param rate: Maximum number of requests per second
+        :param burst: Maximum number of requests sent at once
+        :param min_rate: Rate the bucket never slows down below
+        """
+
+        self.max_rate = rate
+        self.min_rate = min_rate or rate / 10
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token from the bucket
+
+        :return: Seconds to wait before the request may be sent
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        """
+        Wait until a request may be sent
+        """
+
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def on_throttled(self):
+        """
+        Halve the rate after the server throttled a request
+        """
+
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def on_success(self):
+        """
+        Recover the rate a little after a request that was not throttled
+        """
+
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+def get_rate_limiter():
+    """
+    Get the rate limiter shared by all applyEdits requests of this instance
+
+    :return: Token bucket or None if requests are not rate limited
+    """
+
+    global _rate_limiter
+
+    rate = getattr(config, "ARCGIS_RATE_LIMIT", None)
+    if not rate:
+        return None
+
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = TokenBucket(
+                rate,
+                getattr(config, "ARCGIS_RATE_BURST", 10),
+                getattr(config, "ARCGIS_RATE_LIMIT_MIN", None),
+            )
+
+        return _rate_limiter
+
+
+def get_backoff_delay(attempt):
+    """
+    Get the delay before retrying a request, growing exponentially with full jitter
+
+    :param attempt: Number of the retry, starting at 1
+
+    :return: Delay in seconds
+    """
+
+    base = getattr(config, "ARCGIS_RETRY_BACKOFF", 1)
+    cap = getattr(config, "ARCGIS_RETRY_BACKOFF_MAX", 30)
+
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
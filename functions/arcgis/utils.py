@@ -1,40 +1,243 @@
+import gzip
+import json
 import logging
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from json.decoder import JSONDecodeError
 
 import config
+import metrics
 import requests
-from requests.exceptions import ConnectionError, HTTPError
+import urllib3
+import zulu
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError, Timeout
 from retry import retry
 
+INVALID_TOKEN_CODES = (498, 499)
+THROTTLING_CODES = (429, 503)
+RETRYABLE_CODES = (429, 500, 502, 503, 504)
+# Codes of failed requests of which ArcGIS certainly applied none of the edits
+NOT_APPLIED_CODES = (429, 503)
+ROLLED_BACK_CODE = 1003
 
-def get_feature_service_token(secret):
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+TIMESTAMP_PATTERN = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?"
+    r"(Z|[+-]\d{2}:?\d{2})?$"
+)
+
+_token_cache = {"token": None, "expires": 0}
+_token_lock = threading.Lock()
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
     """
-    Request a new feature service token
+    Get the HTTP session shared by all ArcGIS REST traffic of this instance
+
+    :return: HTTP session with a keep-alive connection pool
+    :rtype: requests.Session
+    """
+
+    global _http_session
+
+    with _http_session_lock:
+        if _http_session is None:
+            adapter = HTTPAdapter(
+                pool_connections=getattr(config, "HTTP_POOL_CONNECTIONS", 4),
+                pool_maxsize=getattr(config, "HTTP_POOL_MAXSIZE", 10),
+            )
+
+            _http_session = requests.Session()
+            _http_session.mount("https://", adapter)
+            _http_session.mount("http://", adapter)
+
+        return _http_session
+
+
+def encode_json_value(value):
+    """
+    Encode values that JSON does not support, used by the edits encoder
+
+    :param value: Value
+
+    :return: Dates as milliseconds since epoch, which ArcGIS uses for date fields
+    """
+
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+
+        return int((value - EPOCH).total_seconds() * 1000)
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# Strict and compact, so edits are valid JSON and as small as possible
+_edits_encoder = json.JSONEncoder(
+    ensure_ascii=False,
+    check_circular=False,
+    allow_nan=False,
+    separators=(",", ":"),
+    default=encode_json_value,
+)
+
+
+def encode_edits(edits):
+    """
+    Encode ArcGIS edits as compact JSON
+
+    :param edits: ArcGIS features or object IDs
+    :type edits: list
+
+    :return: JSON
+    :rtype: str
+    """
+
+    return _edits_encoder.encode(edits)
+
+
+# Percent-encoding of every byte as done by urlencode, looked up instead of quoted
+_FORM_SAFE_BYTES = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_.-~"
+_form_quotes = [
+    chr(byte) if byte in _FORM_SAFE_BYTES else "+" if byte == 32 else f"%{byte:02X}"
+    for byte in range(256)
+]
+
+
+def quote_form_value(value):
+    """
+    Quote a form value like urlencode does, which is faster for large edit lists
+
+    :param value: Form value
+    :type value: str
+
+    :return: Quoted value
+    :rtype: str
+    """
+
+    return "".join(map(_form_quotes.__getitem__, str(value).encode("utf-8")))
+
+
+def encode_form(data):
+    """
+    Encode form data, compressing bodies above the configured size
+
+    :param data: Form data
+    :type data: dict
+
+    :return: Body, Headers
+    :rtype: tuple
+    """
+
+    body = "&".join(
+        f"{quote_form_value(key)}={quote_form_value(value)}"
+        for key, value in data.items()
+    ).encode("ascii")
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+    gzip_min_bytes = getattr(config, "HTTP_GZIP_MIN_BYTES", None)
+    if gzip_min_bytes is not None and len(body) >= gzip_min_bytes:
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = "gzip"
+
+    return body, headers
+
+
+def post_form(session, url, data):
+    """
+    Post form data, compressing bodies above the configured size
+
+    :param session: HTTP session
+    :type session: requests.Session
+    :param url: Url
+    :type url: str
+    :param data: Form data
+    :type data: dict
+
+    :return: Response
+    :rtype: requests.Response
+    """
+
+    body, headers = encode_form(data)
+
+    return session.post(
+        url,
+        data=body,
+        headers=headers,
+        timeout=getattr(config, "HTTP_TIMEOUT", (10, 60)),
+    )
+
+
+def get_feature_service_token(secret, invalid_token=None):
+    """
+    Get the cached feature service token, requesting a new one shortly before it expires
 
     :param secret: ArcGIS secret
     :type secret: str
+    :param invalid_token: Token rejected by ArcGIS, which is refreshed if still cached
+    :type invalid_token: str
 
     :return: Token
     :rtype: str
     """
 
+    refresh_margin = getattr(config, "ARCGIS_TOKEN_REFRESH_MARGIN", 300) * 1000
+
+    # Concurrent callers wait for a single refresh instead of each requesting a token
+    with _token_lock:
+        token = _token_cache["token"]
+
+        if (
+            token
+            and token != invalid_token
+            and time.time() * 1000 < _token_cache["expires"] - refresh_margin
+        ):
+            return token
+
+        token, expires = request_feature_service_token(secret)
+
+        if token:
+            _token_cache.update({"token": token, "expires": expires})
+
+        return token
+
+
+def request_feature_service_token(secret):
+    """
+    Request a new feature service token
+
+    :param secret: ArcGIS secret
+    :type secret: str
+
+    :return: Token, Expiry in milliseconds since epoch
+    :rtype: tuple
+    """
+
     try:
-        return get_arcgis_token(secret)
+        with metrics.timed("arcgis.token"):
+            return get_arcgis_token(secret)
     except KeyError as e:
         logging.error(
             f"Function is missing authentication configuration for retrieving ArcGIS token: {str(e)}"
         )
-        return None
-    except (ConnectionError, HTTPError) as e:
+        return None, None
+    except (ConnectionError, HTTPError, Timeout) as e:
         logging.error(f"An error occurred when retrieving ArcGIS token: {str(e)}")
-        return None
+        return None, None
     except JSONDecodeError as e:
         logging.debug(f"An error occurred when retrieving ArcGIS token: {str(e)}")
-        return None
+        return None, None
 
 
 @retry(
-    (ConnectionError, HTTPError, JSONDecodeError),
+    (ConnectionError, HTTPError, Timeout, JSONDecodeError),
     tries=3,
     delay=5,
     logger=None,
@@ -47,8 +250,8 @@ def get_arcgis_token(secret):
     :param secret: ArcGIS secret
     :type secret: str
 
-    :return: ArcGIS access token
-    :rtype: str
+    :return: ArcGIS access token, Expiry in milliseconds since epoch
+    :rtype: tuple
     """
 
     data = {
@@ -59,15 +262,280 @@ def get_arcgis_token(secret):
         "referer": config.CLIENT_REFERER,
     }
 
-    gis_r = requests.post(config.OAUTH_URL, data=data)
+    gis_r = post_form(get_http_session(), config.OAUTH_URL, data)
     gis_r.raise_for_status()
 
     r_json = gis_r.json()
 
     if "token" in r_json:
-        return r_json["token"]
+        expires = r_json.get("expires")
+        if not expires:
+            expires = (
+                time.time() + getattr(config, "ARCGIS_TOKEN_LIFETIME", 3600)
+            ) * 1000
+
+        return r_json["token"], expires
 
     logging.error(
         f"An error occurred when retrieving ArcGIS token: {r_json.get('error', gis_r.content)}"
     )
-    return None
+    return None, None
+
+
+def is_invalid_token_response(response):
+    """
+    Check if an ArcGIS response rejected the used token
+
+    :param response: ArcGIS response
+    :type response: dict
+
+    :return: True if the token was invalid or missing
+    :rtype: bool
+    """
+
+    return get_error_code(response) in INVALID_TOKEN_CODES
+
+
+def get_error_response(code, message, sent=True):
+    """
+    Get an ArcGIS style error response for a request that failed without one
+
+    :param code: Error code, such as the HTTP status code, or None
+    :type code: int
+    :param message: Error message
+    :type message: str
+    :param sent: False if the request failed before it reached ArcGIS
+    :type sent: bool
+
+    :return: Error response
+    :rtype: dict
+    """
+
+    error = {"code": code, "message": message}
+    if not sent:
+        error["sent"] = False
+
+    return {"error": error}
+
+
+def is_connect_error(e):
+    """
+    Check if a request failed because no connection to ArcGIS could be made, so it
+    was never sent
+
+    :param e: Exception raised by the request
+    :type e: requests.exceptions.RequestException
+
+    :return: True if the request was not sent
+    :rtype: bool
+    """
+
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+
+    # Connection errors while the request was sent or answered may have applied it
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+
+    return isinstance(e, ConnectionError) and isinstance(
+        reason, urllib3.exceptions.NewConnectionError
+    )
+
+
+def is_not_applied_response(response):
+    """
+    Check if ArcGIS certainly applied none of the edits of a failed request
+
+    :param response: ArcGIS response
+    :type response: dict
+
+    :return: True if the request was not sent, throttled or refused
+    :rtype: bool
+    """
+
+    if get_error_code(response) in NOT_APPLIED_CODES:
+        return True
+
+    return isinstance(response, dict) and response.get("error", {}).get("sent") is False
+
+
+def get_error_code(response):
+    """
+    Get the error code of an ArcGIS response or edit result
+
+    :param response: ArcGIS response or edit result
+    :type response: dict
+
+    :return: Error code or None
+    :rtype: int
+    """
+
+    if not isinstance(response, dict) or not isinstance(response.get("error"), dict):
+        return None
+
+    return response["error"].get("code")
+
+
+def is_throttled_response(response):
+    """
+    Check if ArcGIS rejected a request because of too many requests
+
+    :param response: ArcGIS response
+    :type response: dict
+
+    :return: True if the request was throttled
+    :rtype: bool
+    """
+
+    return get_error_code(response) in THROTTLING_CODES
+
+
+def is_retryable_result(result, adds=False):
+    """
+    Check if a failed edit result may succeed when the edit is sent again
+
+    :param result: ArcGIS edit result, or the response if it has no results
+    :type result: dict
+    :param adds: The edits queued together with the edit include adds
+    :type adds: bool
+
+    :return: True if the edit can be retried
+    :rtype: bool
+    """
+
+    if is_edit_success(result) or not isinstance(result, dict):
+        return False
+
+    code = get_error_code(result)
+
+    if "success" not in result:
+        # Adds that may have been applied without a response, such as after a read
+        # timeout, are not sent again as that would add a second feature
+        if adds:
+            return is_not_applied_response(result)
+
+        # The whole request failed, which is transient for network and server errors
+        return code is None or code in RETRYABLE_CODES
+
+    # Only known transient errors are retried, others such as 1000 and 1019 are not
+    return code in getattr(config, "ARCGIS_RETRYABLE_CODES", RETRYABLE_CODES)
+
+
+def is_rolled_back_result(result):
+    """
+    Check if an edit was not applied because another edit of its request failed
+
+    :param result: ArcGIS edit result
+    :type result: dict
+
+    :return: True if the edit was rolled back
+    :rtype: bool
+    """
+
+    return (
+        isinstance(result, dict)
+        and result.get("success") is False
+        and get_error_code(result) in (None, ROLLED_BACK_CODE)
+    )
+
+
+def is_edit_success(result):
+    """
+    Check if a single ArcGIS edit result reports success
+
+    :param result: ArcGIS edit result
+    :type result: dict
+
+    :return: True if the edit succeeded
+    :rtype: bool
+    """
+
+    return isinstance(result, dict) and result.get("success") is True
+
+
+def is_edits_response_success(response):
+    """
+    Check if all edits of an applyEdits response succeeded
+
+    :param response: ArcGIS response
+    :type response: dict
+
+    :return: True if the response reports success for every edit
+    :rtype: bool
+    """
+
+    if not isinstance(response, dict) or "error" in response:
+        return False
+
+    return all(
+        is_edit_success(result)
+        for key in ("addResults", "updateResults", "deleteResults")
+        for result in response.get(key) or []
+    )
+
+
+def parse_timestamp(timestamp):
+    """
+    Convert a timestamp to milliseconds since epoch
+
+    :param timestamp: Timestamp
+    :type timestamp: str
+
+    :return: Milliseconds since epoch
+    :rtype: float
+
+    :raises ValueError: If the timestamp cannot be parsed
+    """
+
+    try:
+        if isinstance(timestamp, str):
+            return _parse_timestamp_string(timestamp)
+
+        return zulu.parse(timestamp).timestamp() * 1000
+    except zulu.ParseError as e:
+        raise ValueError(str(e)) from None
+
+
+@lru_cache(maxsize=getattr(config, "TIMESTAMP_CACHE_SIZE", 1024))
+def _parse_timestamp_string(timestamp):
+    """
+    Convert an ISO-8601 timestamp to milliseconds since epoch, falling back to zulu
+    for formats other than the common ones
+
+    :param timestamp: Timestamp
+    :type timestamp: str
+
+    :return: Milliseconds since epoch
+    :rtype: float
+    """
+
+    match = TIMESTAMP_PATTERN.match(timestamp)
+
+    if match:
+        year, month, day, hour, minute, second, fraction, offset = match.groups()
+
+        tz = timezone.utc
+        if offset and offset != "Z":
+            sign = -1 if offset[0] == "-" else 1
+            offset = offset[1:].replace(":", "")
+            tz = timezone(
+                sign * timedelta(hours=int(offset[:2]), minutes=int(offset[2:]))
+            )
+
+        try:
+            dt = datetime(
+                int(year),
+                int(month),
+                int(day),
+                int(hour),
+                int(minute),
+                int(second),
+                int(fraction.ljust(6, "0")) if fraction else 0,
+                tzinfo=tz,
+            )
+        except ValueError:
+            pass  # Let zulu decide on invalid dates
+        else:
+            # Same computation as zulu, so results are identical
+            return (dt - EPOCH).total_seconds() * 1000
+
+    return zulu.parse(timestamp).timestamp() * 1000